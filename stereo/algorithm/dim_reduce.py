@@ -4,11 +4,17 @@
 @author: Ping Qiu  qiuping1@genomics.cn
 """
 
+import time
 import numpy as np
+from scipy.sparse import issparse, csr_matrix
+from scipy.sparse.linalg import LinearOperator, svds
+from sklearn.utils.extmath import svd_flip
 # import umap
 from sklearn.decomposition import FactorAnalysis
 from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
+from ..core.backed_matrix import BackedCSRMatrix
+from ..log_manager import logger
 
 
 def low_variance(x, threshold=0.01):
@@ -40,21 +46,184 @@ def factor_analysis(x, n_pcs):
     return tran_x
 
 
-def pca(x, n_pcs, random_state=0):
+def pca(x, n_pcs, random_state=0, svd_solver='auto', dtype=np.float32):
     """
     Principal component analysis.
 
-    :param x: 2D array, shape (M, N)
+    :param x: 2D array or sparse matrix, shape (M, N). The sparse matrix is not densified, see `sparse_pca`.
     :param n_pcs: the number of features for a return array after reducing.
     :param random_state : int, RandomState instance
-    :return:  ndarray of shape (n_samples, n_components) Embedding of the training data in low-dimensional space.
+    :param svd_solver: the solver of sparse matrix, 'randomized' or 'arpack', 'auto' is 'arpack'.
+                       The array is solved by sklearn PCA.
+    :param dtype: the float type of computing the sparse matrix.
+    :return:  a dict of x_pca, the ndarray of shape (n_samples, n_components) Embedding of the training data in
+              low-dimensional space, variance, variance_ratio, pcs, the loadings of shape (n_features, n_components),
+              and mean, the mean of each feature.
     """
+    if issparse(x):
+        return sparse_pca(x, n_pcs, random_state=random_state,
+                          svd_solver='arpack' if svd_solver == 'auto' else svd_solver, dtype=dtype)
     pca_obj = PCA(n_components=n_pcs, random_state=random_state)
     x_pca = pca_obj.fit_transform(x)
     variance = pca_obj.explained_variance_
     variance_ratio = pca_obj.explained_variance_ratio_
     pcs = pca_obj.components_.T
-    return dict([('x_pca', x_pca), ('variance', variance), ('variance_ratio', variance_ratio), ('pcs', pcs)])
+    return dict([('x_pca', x_pca), ('variance', variance), ('variance_ratio', variance_ratio), ('pcs', pcs),
+                 ('mean', pca_obj.mean_)])
+
+
+def centered_operator(x, mean):
+    """
+    get the linear operator of the centered matrix `x - mean`, which is not computed, so that x is kept sparse.
+
+    :param x: sparse matrix, shape (M, N)
+    :param mean: the mean of each column, shape (N,)
+    :return: a LinearOperator of shape (M, N)
+    """
+    ones = np.ones(x.shape[0], dtype=x.dtype)
+    x_t = x.T
+
+    def matvec(v):
+        v = np.ravel(v)
+        return x @ v - mean @ v
+
+    def matmat(v):
+        return x @ v - np.outer(ones, mean @ v)
+
+    def rmatvec(u):
+        u = np.ravel(u)
+        return x_t @ u - mean * u.sum()
+
+    def rmatmat(u):
+        return x_t @ u - np.outer(mean, u.sum(axis=0))
+
+    return LinearOperator(x.shape, matvec=matvec, matmat=matmat, rmatvec=rmatvec, rmatmat=rmatmat, dtype=x.dtype)
+
+
+def sparse_pca(x, n_pcs, random_state=0, svd_solver='arpack', dtype=np.float32, n_iter=7, n_oversamples=10):
+    """
+    Principal component analysis of sparse matrix, the columns are centered implicitly by a linear operator
+    instead of densifying the matrix.
+
+    :param x: sparse matrix, shape (M, N)
+    :param n_pcs: the number of features for a return array after reducing.
+    :param random_state: int, RandomState instance
+    :param svd_solver: 'randomized', the randomized svd with power iterations, or 'arpack', the Lanczos svd.
+    :param dtype: the float type of computing.
+    :param n_iter: the number of power iterations of the randomized svd.
+    :param n_oversamples: the number of additional random vectors of the randomized svd.
+    :return: the same dict as `pca`.
+    """
+    if svd_solver not in ('randomized', 'arpack'):
+        raise ValueError(f"svd_solver must be 'randomized' or 'arpack', got {svd_solver}.")
+    x = csr_matrix(x, dtype=dtype)
+    n_samples = x.shape[0]
+    mean = np.bincount(x.indices, weights=x.data, minlength=x.shape[1]) / n_samples
+    sq_mean = np.bincount(x.indices, weights=np.square(x.data, dtype=np.float64), minlength=x.shape[1]) / n_samples
+    total_var = (sq_mean - mean ** 2).sum() * n_samples / (n_samples - 1)
+    operator = centered_operator(x, mean.astype(dtype))
+    random_state = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) \
+        else random_state
+
+    if svd_solver == 'arpack':
+        v0 = random_state.uniform(-1, 1, min(x.shape)).astype(dtype)
+        u, s, vt = svds(operator, k=n_pcs, solver='arpack', v0=v0)
+        # svds returns the singular values in the ascending order
+        u, s, vt = u[:, ::-1], s[::-1], vt[::-1]
+    else:
+        # range finder with the power iterations, normalized by QR
+        q = random_state.normal(size=(x.shape[1], n_pcs + n_oversamples)).astype(dtype)
+        q, _ = np.linalg.qr(operator @ q)
+        for _ in range(n_iter):
+            q, _ = np.linalg.qr(operator.rmatmat(q))
+            q, _ = np.linalg.qr(operator @ q)
+        b = operator.rmatmat(q).T
+        u_b, s, vt = np.linalg.svd(b, full_matrices=False)
+        u = q @ u_b[:, :n_pcs]
+        s, vt = s[:n_pcs], vt[:n_pcs]
+    u, vt = svd_flip(u, vt)
+    variance = s.astype(np.float64) ** 2 / (n_samples - 1)
+    return dict([('x_pca', u * s), ('variance', variance), ('variance_ratio', variance / total_var),
+                 ('pcs', vt.T), ('mean', mean)])
+
+
+def iter_row_chunks(x, chunk_size):
+    """
+    iterate the rows of the matrix chunk by chunk, the backed matrix is read from the file chunk by chunk.
+
+    :param x: 2D array, sparse matrix or BackedCSRMatrix, shape (M, N)
+    :param chunk_size: the number of rows per chunk.
+    :return: an iterator of (start, end, chunk), the chunk is the rows [start, end) of x.
+    """
+    if isinstance(x, BackedCSRMatrix):
+        yield from x.iter_chunks(chunk_size)
+        return
+    x = csr_matrix(x) if issparse(x) else x
+    for start in range(0, x.shape[0], chunk_size):
+        end = min(start + chunk_size, x.shape[0])
+        yield start, end, x[start:end]
+
+
+def incremental_pca(x, n_pcs, chunk_size=10000, dtype=np.float32, max_gram_memory=4.0):
+    """
+    Incremental principal component analysis. The column sums and the gram matrix of the genes are updated by the
+    row chunks, the components are solved from the covariance, then the rows are projected chunk by chunk in a second
+    pass, so that only a chunk of the matrix and the gram matrix of shape (N, N) are in memory at a time.
+
+    The gram matrix is float64 and takes N * N * 8 bytes whatever the number of rows, about 7GB for 30000 genes, so
+    the genes are usually subset to the highly variable genes first.
+
+    :param x: 2D array, sparse matrix or BackedCSRMatrix, shape (M, N). The backed matrix is streamed from the file.
+    :param n_pcs: the number of features for a return array after reducing.
+    :param chunk_size: the number of rows per chunk.
+    :param dtype: the float type of the projection.
+    :param max_gram_memory: the max memory in GB of the gram matrix, a ValueError is raised before reading any chunk
+                            if the gram matrix of the N columns needs more.
+    :return: the same dict as `pca`.
+    """
+    from scipy.linalg import eigh
+
+    n_rows, n_cols = x.shape
+    gram_memory = n_cols ** 2 * 8 / 1024 ** 3
+    if gram_memory > max_gram_memory:
+        raise ValueError(f'the gram matrix of {n_cols} genes needs {gram_memory:.2f}GB, more than max_gram_memory '
+                         f'{max_gram_memory}GB, please use the highly variable genes or raise max_gram_memory.')
+    col_sums = np.zeros(n_cols, dtype=np.float64)
+    gram = np.zeros((n_cols, n_cols), dtype=np.float64)
+    start_time = time.time()
+    for _, _, chunk in iter_row_chunks(x, chunk_size):
+        if issparse(chunk):
+            chunk = csr_matrix(chunk, dtype=np.float64)
+            col_sums += np.bincount(chunk.indices, weights=chunk.data, minlength=n_cols)
+            gram += (chunk.T @ chunk).toarray()
+        else:
+            chunk = np.asarray(chunk, dtype=np.float64)
+            col_sums += chunk.sum(axis=0)
+            gram += chunk.T @ chunk
+    elapsed = time.time() - start_time
+    logger.info(f'incremental pca fitted {n_rows} rows in {elapsed:.2f}s, {n_rows / max(elapsed, 1e-6):.0f} rows/s.')
+
+    mean = col_sums / n_rows
+    gram -= n_rows * np.outer(mean, mean)
+    gram /= n_rows - 1
+    total_var = np.trace(gram)
+    variance, pcs = eigh(gram, subset_by_index=[n_cols - n_pcs, n_cols - 1], overwrite_a=True)
+    del gram
+    variance, pcs = variance[::-1], pcs[:, ::-1]
+    # make the loading of the biggest absolute value positive
+    pcs *= np.sign(pcs[np.argmax(np.abs(pcs), axis=0), np.arange(n_pcs)])
+
+    start_time = time.time()
+    x_pca = np.zeros((n_rows, n_pcs), dtype=dtype)
+    pcs_dtype = pcs.astype(dtype)
+    offset = (mean @ pcs).astype(dtype)
+    for start, end, chunk in iter_row_chunks(x, chunk_size):
+        chunk = csr_matrix(chunk, dtype=dtype) if issparse(chunk) else np.asarray(chunk, dtype=dtype)
+        x_pca[start:end] = chunk @ pcs_dtype - offset
+    elapsed = time.time() - start_time
+    logger.info(f'incremental pca projected {n_rows} rows in {elapsed:.2f}s, {n_rows / max(elapsed, 1e-6):.0f} rows/s.')
+    return dict([('x_pca', x_pca), ('variance', variance), ('variance_ratio', variance / total_var), ('pcs', pcs),
+                 ('mean', mean)])
 
 
 def t_sne(x, n_pcs, n_iter=200):
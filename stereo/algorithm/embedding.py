@@ -0,0 +1,162 @@
+"""The fitted pca and umap embedding of a reference, which projects new samples without refitting."""
+from typing import Optional, Sequence
+import h5py
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse
+from .dim_reduce import iter_row_chunks
+from ..log_manager import logger
+
+
+class EmbeddingModel(object):
+    """
+    the fitted embedding of a reference. The cells of a new sample are projected onto the pcs of the reference by the
+    gene means and loadings, placed in the umap of the reference by the weighted mean of their nearest reference cells,
+    and labeled by the weighted vote of these cells, so that the time only depends on the number of new cells.
+
+    :param genes: the genes of the pca.
+    :param mean: the mean of each gene of the reference.
+    :param pcs: the loadings of shape (n_genes, n_pcs).
+    :param x_pca: the pca of the reference cells, shape (n_cells, n_pcs).
+    :param x_umap: the umap of the reference cells, shape (n_cells, n_components), None if the umap is not fitted.
+    :param n_neighbors: the number of nearest reference cells to place the new cells in the umap and vote the labels.
+    :param n_pcs: the number of pcs used to find the nearest cells, default is all pcs.
+    :param metric: the distance metric of finding the nearest cells.
+    """
+    def __init__(self, genes: Sequence[str], mean: np.ndarray, pcs: np.ndarray, x_pca: np.ndarray,
+                 x_umap: Optional[np.ndarray] = None, n_neighbors: int = 15, n_pcs: Optional[int] = None,
+                 metric: str = 'euclidean'):
+        self.genes = pd.Index(np.asarray(genes))
+        self.mean = np.asarray(mean)
+        self.pcs = np.asarray(pcs)
+        self.x_pca = np.asarray(x_pca)
+        self.x_umap = None if x_umap is None else np.asarray(x_umap)
+        self.n_neighbors = n_neighbors
+        self.n_pcs = n_pcs
+        self.metric = metric
+        self._index = None
+
+    def with_umap(self, x_umap: np.ndarray, n_neighbors: int, n_pcs: Optional[int] = None,
+                  metric: str = 'euclidean') -> 'EmbeddingModel':
+        """
+        get a model of the same pca with the umap of the reference cells.
+
+        :param x_umap: the umap of the reference cells.
+        :param n_neighbors: the number of neighbors of the umap.
+        :param n_pcs: the number of pcs of the neighbors.
+        :param metric: the distance metric of the neighbors.
+        :return: an object of EmbeddingModel.
+        """
+        return EmbeddingModel(self.genes, self.mean, self.pcs, self.x_pca, x_umap, n_neighbors, n_pcs, metric)
+
+    def project(self, exp_matrix, gene_names: Sequence[str], chunk_size: int = 10000) -> np.ndarray:
+        """
+        project the cells onto the pcs, the genes of the model which are not in the matrix are taken as zeros.
+
+        :param exp_matrix: the express matrix of the new cells, preprocessed as the reference. The backed matrix is
+                           streamed from the file.
+        :param gene_names: the genes of the matrix.
+        :param chunk_size: the number of cells projected at a time.
+        :return: the pca of the new cells, shape (n_cells, n_pcs).
+        """
+        positions = self.genes.get_indexer(np.asarray(gene_names))
+        found = positions >= 0
+        if not found.any():
+            raise ValueError('none of the genes of the model is in the data.')
+        logger.info(f'{found.sum()} of {len(self.genes)} genes of the model are found in the data.')
+        # the loadings at the positions of the genes of the matrix
+        weights = np.zeros((len(positions), self.pcs.shape[1]), dtype=self.pcs.dtype)
+        weights[found] = self.pcs[positions[found]]
+        offset = self.mean @ self.pcs
+        x_pca = np.zeros((exp_matrix.shape[0], self.pcs.shape[1]), dtype=self.x_pca.dtype)
+        for start, end, chunk in iter_row_chunks(exp_matrix, chunk_size):
+            x_pca[start:end] = (chunk @ weights if issparse(chunk) else np.asarray(chunk) @ weights) - offset
+        return x_pca
+
+    def kneighbors(self, x_pca: np.ndarray):
+        """
+        find the nearest reference cells of the new cells, the index of the reference is built at the first call.
+
+        :param x_pca: the pca of the new cells.
+        :return: the indices and the distances of shape (n_cells, n_neighbors).
+        """
+        if self._index is None:
+            from sklearn.neighbors import NearestNeighbors
+            self._index = NearestNeighbors(n_neighbors=self.n_neighbors, metric=self.metric).fit(
+                self.x_pca[:, :self.n_pcs])
+        distances, indices = self._index.kneighbors(x_pca[:, :self.n_pcs])
+        return indices, distances
+
+    def neighbor_weights(self, distances: np.ndarray) -> np.ndarray:
+        """
+        get the weights of the nearest reference cells, the membership strengths of umap normalized by each cell.
+
+        :param distances: the distances of the nearest reference cells.
+        :return: the weights of shape (n_cells, n_neighbors).
+        """
+        from umap.umap_ import smooth_knn_dist
+        sigmas, rhos = smooth_knn_dist(distances, float(self.n_neighbors), local_connectivity=0.0)
+        weights = np.exp(-np.maximum(distances - rhos[:, None], 0) / sigmas[:, None])
+        weights /= weights.sum(axis=1, keepdims=True)
+        return weights
+
+    def transform(self, new_data, labels: Optional[Sequence] = None, chunk_size: int = 10000) -> dict:
+        """
+        embed the new data into the reference.
+
+        :param new_data: the StereoExpData of the new sample, preprocessed as the reference.
+        :param labels: the labels of the reference cells, such as the group of the cluster result, to transfer to the
+                       new cells.
+        :param chunk_size: the number of cells projected at a time.
+        :return: a dict of 'pca', the DataFrame of the pca, 'umap', the DataFrame of the umap if it is fitted, and
+                 'cluster', the DataFrame of the bins and the transferred group if the labels are set.
+        """
+        x_pca = self.project(new_data.exp_matrix, new_data.gene_names, chunk_size)
+        res = {'pca': pd.DataFrame(x_pca)}
+        if self.x_umap is None and labels is None:
+            return res
+        indices, distances = self.kneighbors(x_pca)
+        weights = self.neighbor_weights(distances)
+        if self.x_umap is not None:
+            res['umap'] = pd.DataFrame(np.einsum('ij,ijk->ik', weights, self.x_umap[indices]))
+        if labels is not None:
+            labels = pd.Categorical(labels)
+            if len(labels) != self.x_pca.shape[0]:
+                raise ValueError(f'the length of labels {len(labels)} does not match the reference cells.')
+            votes = np.zeros((x_pca.shape[0], len(labels.categories)))
+            np.add.at(votes, (np.arange(x_pca.shape[0])[:, None], labels.codes[indices]), weights)
+            group = pd.Categorical.from_codes(np.argmax(votes, axis=1), labels.categories)
+            res['cluster'] = pd.DataFrame({'bins': new_data.cell_names, 'group': group})
+        return res
+
+    def save(self, path: str):
+        """
+        save the model as a h5 file.
+
+        :param path: the path of the h5 file.
+        :return:
+        """
+        with h5py.File(path, mode='w') as f:
+            f.create_dataset('genes', data=self.genes.values.astype(object), dtype=h5py.special_dtype(vlen=str))
+            for key in ['mean', 'pcs', 'x_pca', 'x_umap']:
+                if getattr(self, key) is not None:
+                    f.create_dataset(key, data=getattr(self, key))
+            f.attrs['n_neighbors'] = self.n_neighbors
+            f.attrs['metric'] = self.metric
+            if self.n_pcs is not None:
+                f.attrs['n_pcs'] = self.n_pcs
+
+    @classmethod
+    def load(cls, path: str) -> 'EmbeddingModel':
+        """
+        load the model saved by `save`.
+
+        :param path: the path of the h5 file.
+        :return: an object of EmbeddingModel.
+        """
+        with h5py.File(path, mode='r') as f:
+            genes = f['genes'].asstr()[...]
+            arrays = {key: f[key][...] if key in f else None for key in ['mean', 'pcs', 'x_pca', 'x_umap']}
+            n_pcs = f.attrs.get('n_pcs')
+            return cls(genes, n_neighbors=int(f.attrs['n_neighbors']), metric=str(f.attrs['metric']),
+                       n_pcs=None if n_pcs is None else int(n_pcs), **arrays)
@@ -32,6 +32,38 @@ def highly_variable_genes_single_batch(
         # data = np.expm1(data)
 
     mean, var = materialize_as_ndarray(get_mean_var(data))
+    return highly_variable_genes_from_mean_var(
+        mean,
+        var,
+        min_disp=min_disp,
+        max_disp=max_disp,
+        min_mean=min_mean,
+        max_mean=max_mean,
+        n_top_genes=n_top_genes,
+        n_bins=n_bins,
+        method=method,
+    )
+
+
+def highly_variable_genes_from_mean_var(
+    mean: np.ndarray,
+    var: np.ndarray,
+    min_disp: Optional[float] = 0.5,
+    max_disp: Optional[float] = np.inf,
+    min_mean: Optional[float] = 0.0125,
+    max_mean: Optional[float] = 3,
+    n_top_genes: Optional[int] = None,
+    n_bins: int = 20,
+    method: Optional[str] = 'seurat',
+) -> pd.DataFrame:
+    """\
+    See `highly_variable_genes_single_batch`, from the means and the variances of the genes, which are modified.
+
+    Returns
+    -------
+    A DataFrame that contains the columns
+    `highly_variable`, `means`, `dispersions`, and `dispersions_norm`.
+    """
     # now actually compute the dispersion
     mean[mean == 0] = 1e-12  # set entries equal to zero to small value
     dispersion = var / mean
@@ -94,9 +126,9 @@ def highly_variable_genes_single_batch(
         dispersion_norm[
             ::-1
         ].sort()  # interestingly, np.argpartition is slightly slower
-        if n_top_genes > data.shape[1]:
+        if n_top_genes > len(mean):
             logger.info('`n_top_genes` > `adata.n_var`, returning all genes.')
-            n_top_genes = data.shape[1]
+            n_top_genes = len(mean)
         disp_cut_off = dispersion_norm[n_top_genes - 1]
         gene_subset = np.nan_to_num(df['dispersions_norm'].values) >= disp_cut_off
         logger.debug(
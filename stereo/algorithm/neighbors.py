@@ -56,6 +56,7 @@ def find_neighbors(
     metric_kwds: Mapping[str, Any] = MappingProxyType({}),
     knn: bool = True,
     random_state: AnyRandom = 0,
+    index: Optional['NeighborIndex'] = None,
 ):
     """
 
@@ -99,6 +100,9 @@ def find_neighbors(
         `n_neighbors` nearest neighbor.
     :param random_state:
         A state capable being used as a numpy random state.
+    :param index:
+        A built `NeighborIndex` of the pcs of x, which is queried for the nearest neighbors instead of computing
+        the distances. Only works with knn=True.
     :return:
         neighbor: Neighbors object
         dists: sparse
@@ -115,6 +119,16 @@ def find_neighbors(
     )
     neighbor.check_setting()
     neighbor.x = neighbor.choose_x()
+    if index is not None:
+        if not knn:
+            raise ValueError('the neighbor index only works with knn=True.')
+        knn_indices, knn_distances = index.kneighbors(n_neighbors)
+        dists = neighbor.get_parse_distances_umap(knn_indices, knn_distances)
+        if method == 'gauss':
+            connectivities = neighbor.compute_connectivities_diffmap(dists)
+        else:
+            connectivities = neighbor.compute_connectivities_umap(knn_indices, knn_distances)
+        return neighbor, dists, connectivities
     use_dense_distances = (neighbor.metric == 'euclidean' and neighbor.x.shape[0] < 8192) or not neighbor.knn
     dists = neighbor.x
     if use_dense_distances:
@@ -125,11 +139,13 @@ def find_neighbors(
                 knn_indices, knn_distances, neighbor.x.shape[0],
             )
     else:
+        search_metric = neighbor.metric
         if neighbor.x.shape[0] < 4096:
             dists = pairwise_distances(neighbor.x, metric=neighbor.metric, **metric_kwds)
-            neighbor.metric = 'precomputed'
+            # the neighbor keeps the metric of the user, only the search uses the precomputed distances
+            search_metric = 'precomputed'
         knn_indices, knn_distances, forest = neighbor.compute_neighbors_umap(
-            dists, random_state=neighbor.random_state, metric_kwds=metric_kwds)
+            dists, random_state=neighbor.random_state, metric_kwds=metric_kwds, metric=search_metric)
     if not use_dense_distances or neighbor.method in {'umap'}:
         connectivities = neighbor.compute_connectivities_umap(knn_indices, knn_distances)
         dists = neighbor.get_parse_distances_umap(knn_indices, knn_distances, )
@@ -203,22 +219,14 @@ class Neighbors(object):
 
     def get_parse_distances_umap(self, nn_idx, nn_dist):
         n_obs = self.x.shape[0]
-        rows = np.zeros((n_obs * self.n_neighbors), dtype=np.int64)
-        cols = np.zeros((n_obs * self.n_neighbors), dtype=np.int64)
-        vals = np.zeros((n_obs * self.n_neighbors), dtype=np.float64)
-
-        for i in range(nn_idx.shape[0]):
-            for j in range(self.n_neighbors):
-                if nn_idx[i, j] == -1:
-                    continue  # We didn't get the full knn for i
-                if nn_idx[i, j] == i:
-                    val = 0.0
-                else:
-                    val = nn_dist[i, j]
-
-                rows[i * self.n_neighbors + j] = i
-                cols[i * self.n_neighbors + j] = nn_idx[i, j]
-                vals[i * self.n_neighbors + j] = val
+        nn_idx = np.asarray(nn_idx)[:, :self.n_neighbors]
+        rows = np.repeat(np.arange(nn_idx.shape[0], dtype=np.int64), nn_idx.shape[1])
+        cols = nn_idx.ravel().astype(np.int64)
+        vals = np.asarray(nn_dist)[:, :self.n_neighbors].ravel().astype(np.float64)
+        vals[cols == rows] = 0.0
+        # We didn't get the full knn for the rows of -1
+        missing = cols == -1
+        rows[missing], cols[missing], vals[missing] = 0, 0, 0.0
 
         distances = coo_matrix((vals, (rows, cols)), shape=(n_obs, n_obs))
         distances.eliminate_zeros()
@@ -231,14 +239,16 @@ class Neighbors(object):
             angular: bool = False,
             verbose: bool = False,
             metric_kwds: Mapping[str, Any] = MappingProxyType({}),
+            metric: Optional[str] = None,
     ):
         from umap.umap_ import nearest_neighbors
         random_state = check_random_state(random_state)
+        metric = self.metric if metric is None else metric
         knn_indices, knn_dists, forest = nearest_neighbors(
             x,
             self.n_neighbors,
             random_state=random_state,
-            metric=self.metric,
+            metric=metric,
             metric_kwds=metric_kwds,
             angular=angular,
             verbose=verbose,
@@ -247,7 +257,7 @@ class Neighbors(object):
         return knn_indices, knn_dists, forest
 
     def find_n_neighbors(self,):
-        nbrs = NearestNeighbors(n_neighbors=self.n_neighbors+1, algorithm='ball_tree').fit(self.x)
+        nbrs = NearestNeighbors(n_neighbors=self.n_neighbors+1, algorithm='ball_tree', n_jobs=-1).fit(self.x)
         dists, indices = nbrs.kneighbors(self.x)
         nn_idx = indices[:, 1:]
         nn_dist = dists[:, 1:]
@@ -362,3 +372,90 @@ class Neighbors(object):
             W = W.tocsr()
         connectivities = W
         return connectivities
+
+
+class NeighborIndex(object):
+    """
+    the index of the nearest neighbors search, which is built once and queried with any number of neighbors, so that
+    the neighbors of different `n_neighbors` reuse it instead of rebuilding.
+
+    :param x: the data to search, such as the pcs, shape (n_samples, n_features).
+    :param algorithm: 'exact', the exact search of sklearn, 'nndescent', the nearest neighbor descent of pynndescent,
+                      initialized by a random projection forest, or 'hnsw', the hierarchical navigable small world
+                      graph of hnswlib, which supports the 'euclidean' and 'cosine' metric.
+    :param metric: the distance metric.
+    :param metric_kwds: the arguments of the metric.
+    :param n_neighbors: the number of neighbors of the graph built by 'nndescent', the queries of no more neighbors
+                        take the graph directly.
+    :param n_jobs: the number of threads of building and querying, -1 is all cores.
+    :param random_state: the random state of building.
+    """
+    def __init__(self, x: np.ndarray, algorithm: str = 'nndescent', metric: str = 'euclidean',
+                 metric_kwds: Mapping[str, Any] = MappingProxyType({}), n_neighbors: int = 30, n_jobs: int = -1,
+                 random_state: int = 0):
+        if algorithm not in ('exact', 'nndescent', 'hnsw'):
+            raise ValueError(f"algorithm must be 'exact', 'nndescent' or 'hnsw', got {algorithm}.")
+        self.x = np.ascontiguousarray(x, dtype=np.float32)
+        self.algorithm = algorithm
+        self.metric = metric
+        self.n_jobs = n_jobs
+        if algorithm == 'exact':
+            self.index = NearestNeighbors(metric=metric, metric_params=dict(metric_kwds) or None,
+                                          n_jobs=n_jobs).fit(self.x)
+        elif algorithm == 'nndescent':
+            from pynndescent import NNDescent
+            n_neighbors = min(n_neighbors, self.x.shape[0] - 1)
+            self.index = NNDescent(self.x, metric=metric, metric_kwds=dict(metric_kwds), n_neighbors=n_neighbors,
+                                   random_state=random_state, n_jobs=n_jobs, low_memory=True)
+        else:
+            try:
+                import hnswlib
+            except ImportError:
+                raise ImportError('Please install hnswlib package via `pip install hnswlib`')
+            spaces = {'euclidean': 'l2', 'cosine': 'cosine'}
+            if metric not in spaces:
+                raise ValueError(f"the metric of hnsw must be 'euclidean' or 'cosine', got {metric}.")
+            self.index = hnswlib.Index(space=spaces[metric], dim=self.x.shape[1])
+            self.index.init_index(max_elements=self.x.shape[0], ef_construction=200, M=16, random_seed=random_state)
+            self.index.add_items(self.x, num_threads=n_jobs)
+
+    def match(self, x: np.ndarray, algorithm: str, metric: str) -> bool:
+        """
+        check the index is built on the data by the algorithm and metric, so that it can be reused.
+
+        :param x: the data to search.
+        :param algorithm: the algorithm of the index.
+        :param metric: the distance metric.
+        :return: bool
+        """
+        return algorithm == self.algorithm and metric == self.metric and x.shape == self.x.shape and \
+            np.array_equal(np.asarray(x, dtype=np.float32), self.x)
+
+    def kneighbors(self, n_neighbors: int, x: Optional[np.ndarray] = None):
+        """
+        find the nearest neighbors in the index.
+
+        :param n_neighbors: the number of neighbors.
+        :param x: the data to query, default is the data of the index, whose first neighbor is itself.
+        :return: the indices and distances of the neighbors, shape (n_samples, n_neighbors), sorted by the distances.
+        """
+        query = self.x if x is None else np.ascontiguousarray(x, dtype=np.float32)
+        if self.algorithm == 'exact':
+            distances, indices = self.index.kneighbors(query, n_neighbors)
+        elif self.algorithm == 'nndescent':
+            indices, distances = self.index.neighbor_graph
+            if x is None and n_neighbors <= indices.shape[1]:
+                indices, distances = indices[:, :n_neighbors], distances[:, :n_neighbors]
+            else:
+                indices, distances = self.index.query(query, k=n_neighbors)
+        else:
+            self.index.set_ef(max(2 * n_neighbors, 50))
+            indices, distances = self.index.knn_query(query, k=n_neighbors, num_threads=self.n_jobs)
+            indices = indices.astype(np.int64)
+            if self.metric == 'euclidean':
+                # hnswlib returns the squared euclidean distances
+                distances = np.sqrt(np.maximum(distances, 0))
+        if x is None:
+            # the rounding error of the distance to itself changes the local connectivity of umap
+            distances[indices == np.arange(len(indices))[:, None]] = 0
+        return indices, distances
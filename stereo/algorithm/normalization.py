@@ -9,87 +9,257 @@ import numpy as np
 from scipy import stats
 import scipy.spatial as spatial
 from functools import singledispatch
-from scipy.sparse import spmatrix
-from sklearn.utils import sparsefuncs
+from scipy.sparse import spmatrix, issparse, csr_matrix, csc_matrix
+import numba
+
+
+def _working_dtype(x, dtype):
+    """
+    the floating matrix keeps its dtype, the integer matrix is converted to `dtype`.
+    """
+    return x.dtype if np.issubdtype(x.dtype, np.floating) else np.dtype(dtype)
+
+
+def _working_matrix(x, dtype, inplace):
+    """
+    get the matrix whose values can be written in place, only the value buffer is converted or copied if needed, the
+    indices and indptr of the sparse matrix are reused when the matrix is changed in place.
+    """
+    dtype = _working_dtype(x, dtype)
+    values = x.data if issparse(x) else x
+    if not inplace or not values.flags.writeable:
+        return x.astype(dtype, copy=True)
+    if x.dtype == dtype:
+        return x
+    if issparse(x):
+        x.data = x.data.astype(dtype)
+        return x
+    return x.astype(dtype)
+
+
+@numba.njit(cache=True, parallel=True)
+def _csr_normalize_kernel(data, indptr, target_sum):
+    """
+    scale each row of the csr matrix to `target_sum` in place.
+    """
+    for i in numba.prange(len(indptr) - 1):
+        row_sum = 0.0
+        for j in range(indptr[i], indptr[i + 1]):
+            row_sum += data[j]
+        if row_sum <= 0:
+            continue
+        scale = target_sum / row_sum
+        for j in range(indptr[i], indptr[i + 1]):
+            data[j] = data[j] * scale
+
+
+def _sparse_normalize(x, target_sum, log):
+    # the log1p of numpy is vectorized, so it is applied on the scaled buffer rather than value by value in the kernel
+    if isinstance(x, csr_matrix):
+        _csr_normalize_kernel(x.data, x.indptr, float(target_sum))
+        if log:
+            np.log1p(x.data, out=x.data)
+        return x
+    counts = np.ravel(x.sum(1)).astype(np.float64)
+    scale = np.divide(target_sum, counts, out=np.zeros_like(counts), where=counts > 0).astype(x.dtype)
+    x = x.tocsc() if not isinstance(x, csc_matrix) else x
+    x.data *= scale[x.indices]
+    if log:
+        np.log1p(x.data, out=x.data)
+    return x
+
+
+def _dense_normalize(x, target_sum, log):
+    counts = x.sum(axis=1, dtype=np.float64)
+    scale = np.divide(target_sum, counts, out=np.full_like(counts, np.nan), where=counts > 0).astype(x.dtype)
+    x *= scale[:, np.newaxis]
+    if log:
+        np.log1p(x, out=x)
+    return x
 
 
 @singledispatch
-def normalize_total(x, target_sum):
+def normalize_total(x, target_sum, inplace=False, dtype=np.float64):
     """
         total count normalize the data to `target_sum` reads per cell, so that counts become comparable among cells.
 
         :param x: 2D array, shape (M, N), which row is cells and column is genes.
         :param target_sum: the number of reads per cell after normalization.
+        :param inplace: scale the values of `x` in place, only the integer values are converted to `dtype` first.
+        :param dtype: the working dtype for the integer matrix, the floating matrix keeps its own dtype.
         :return: the normalized data.
         """
     pass
 
 
 @normalize_total.register(np.ndarray)
-def _(x, target_sum):
-    nor_x = x * target_sum / x.sum(axis=1)[:, np.newaxis]
-    return nor_x
+def _(x, target_sum, inplace=False, dtype=np.float64):
+    return _dense_normalize(_working_matrix(x, dtype, inplace), target_sum, log=False)
 
 
 @normalize_total.register(spmatrix)
-def _(x, target_sum):
-    x = x.astype(np.float64)
-    counts = target_sum / np.ravel(x.sum(1))
-    sparsefuncs.inplace_row_scale(x, counts)
-    return x
+def _(x, target_sum, inplace=False, dtype=np.float64):
+    return _sparse_normalize(_working_matrix(x, dtype, inplace), target_sum, log=False)
+
+
+def normalize_log1p(x, target_sum, inplace=False, dtype=np.float64):
+    """
+    total count normalize the data to `target_sum` reads per cell, then logarithmize it, both steps work on the same
+    value buffer without any temporary matrix.
+
+    :param x: 2D array or sparse matrix, shape (M, N), which row is cells and column is genes.
+    :param target_sum: the number of reads per cell after normalization.
+    :param inplace: change the values of `x` in place, only the integer values are converted to `dtype` first.
+    :param dtype: the working dtype for the integer matrix, the floating matrix keeps its own dtype.
+    :return: the normalized and logarithmized data.
+    """
+    x = _working_matrix(x, dtype, inplace)
+    if issparse(x):
+        return _sparse_normalize(x, target_sum, log=True)
+    return _dense_normalize(x, target_sum, log=True)
 
 
+@singledispatch
 def quantile_norm(x):
     """
     Normalize the columns of X to each have the same distribution. Given an expression matrix  of M genes by N samples,
     quantile normalization ensures all samples have the same spread of data (by construction).
 
-    :param x: 2D array of float, shape (M, N)
+    :param x: 2D array of float or sparse matrix, shape (M, N)
     :return: The normalized data.
     """
+    pass
+
+
+@quantile_norm.register(np.ndarray)
+def _(x):
     quantiles = np.mean(np.sort(x, axis=0), axis=1)
-    ranks = np.apply_along_axis(stats.rankdata, 0, x)
+    ranks = stats.rankdata(x, axis=0)
     rank_indices = ranks.astype(int) - 1
     xn = quantiles[rank_indices]
     return xn
 
 
-def log1p(x):
+@numba.njit(cache=True, parallel=True)
+def _csc_rank_kernel(data, indptr, n_rows, sorted_data, ranks):
+    """
+    sort the non-zero values of each column, and rank them with the average rank of ties, the zeros of the column
+    take the lowest ranks.
+    """
+    for j in numba.prange(len(indptr) - 1):
+        begin, end = indptr[j], indptr[j + 1]
+        order = np.argsort(data[begin:end], kind='mergesort')
+        n_zeros = n_rows - (end - begin)
+        for k in range(end - begin):
+            sorted_data[begin + k] = data[begin + order[k]]
+        k = 0
+        while k < end - begin:
+            tie_end = k
+            while tie_end + 1 < end - begin and sorted_data[begin + tie_end + 1] == sorted_data[begin + k]:
+                tie_end += 1
+            rank = n_zeros + (k + tie_end) / 2 + 1
+            for t in range(k, tie_end + 1):
+                ranks[begin + order[t]] = rank
+            k = tie_end + 1
+
+
+@quantile_norm.register(spmatrix)
+def _(x):
+    x = x.tocsc(copy=True)
+    x.eliminate_zeros()
+    if x.nnz and x.data.min() < 0:
+        return quantile_norm(x.toarray())
+    n_rows, n_cols = x.shape
+    sorted_data = np.empty(x.nnz, dtype=np.float64)
+    ranks = np.empty(x.nnz, dtype=np.float64)
+    _csc_rank_kernel(x.data, x.indptr, n_rows, sorted_data, ranks)
+    # the zeros fill the first positions of each sorted column, so only the non-zeros add to the mean quantiles
+    n_nonzero = np.diff(x.indptr)
+    n_zeros = n_rows - n_nonzero
+    sorted_pos = np.repeat(n_zeros - x.indptr[:-1], n_nonzero) + np.arange(x.nnz)
+    quantiles = np.bincount(sorted_pos, weights=sorted_data, minlength=n_rows) / n_cols
+    # the zeros of a column share the average rank (n_zeros + 1) / 2
+    zero_quantiles = np.where(n_zeros > 0, quantiles[np.maximum((n_zeros + 1) // 2 - 1, 0)], 0)
+    xn = x.copy()
+    xn.data = quantiles[ranks.astype(int) - 1]
+    if np.any(zero_quantiles != 0):
+        res = np.repeat(zero_quantiles[np.newaxis, :], n_rows, axis=0)
+        xn = xn.tocoo()
+        res[xn.row, xn.col] = xn.data
+        return res
+    xn.eliminate_zeros()
+    return xn.tocsr()
+
+
+def log1p(x, inplace=True, dtype=np.float64):
     """
     Logarithmize the data. log(1 + x)
 
-    :param x: 2D array, shape (M, N).
+    :param x: 2D array or sparse matrix, shape (M, N).
+    :param inplace: change the values of `x` in place, only the integer values are converted to `dtype` first.
+    :param dtype: the working dtype for the integer matrix, the floating matrix keeps its own dtype.
     :return:
     """
-    log_x = np.log1p(x, out=x)
-    return log_x
+    x = _working_matrix(x, dtype, inplace)
+    values = x.data if issparse(x) else x
+    np.log1p(values, out=values)
+    return x
+
 
+def radius_neighbor_graph(position, r):
+    """
+    build the graph of the positions within the radius of each other, the position itself is not its neighbor.
 
-def zscore_disksmooth(x, position, r):
+    :param position: each cell's position , [[x1, y1], [x2, y2], ..., M]
+    :param r: radius
+    :return: a csr matrix of shape (M, M), the value is 1 if the two positions are neighbors.
+    """
+    point_tree = spatial.cKDTree(position)
+    pairs = point_tree.query_pairs(r, output_type='ndarray')
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    n = len(position)
+    return csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(n, n))
+
+
+def zscore_disksmooth(x, position, r, chunk_size=10000):
     """
     for each position, given a radius, calculate the z-score within this circle as final normalized value.
 
-    :param x: 2D array, shape (M, N), which row is cells and column is genes.
+    :param x: 2D array or sparse matrix, shape (M, N), which row is cells and column is genes.
     :param position: each cell's position , [[x1, y1], [x2, y2], ..., M]
     :param r: radius
+    :param chunk_size: the number of rows converted to the dense result at a time, the sparse matrix is never
+                       densified as a whole.
     :return: normalized data, shape (M, N), which row is cells and column is genes.
     """
     position = position.astype(np.int32)
-    point_tree = spatial.cKDTree(position)
-    x = x.astype(np.float32)
-    mean_bin = x.mean(1)
-    mean_bin = np.array(mean_bin)
-    std_bin = np.std(x, axis=1)
-    zscore = []
-    for i in range(len(position)):
-        current_neighbor = point_tree.query_ball_point(position[i], r)
-        current_neighbor.remove(i)
-        if len(current_neighbor) > 0:
-            mean_bins = np.mean(mean_bin[current_neighbor])
-            std_bins = np.mean(std_bin[current_neighbor])
-            zscore.append((x[i] - mean_bins) / std_bins + 1)
-        else:
-            mean_bins = mean_bin[i]
-            std_bins = std_bin[i]
-            zscore.append((x[i] - mean_bins) / std_bins + 1)
-    return np.array(zscore)
+    n_genes = x.shape[1]
+    # the mean and std of each bin
+    if issparse(x):
+        x = x.tocsr()
+        mean_bin = np.ravel(x.sum(1, dtype=np.float64)) / n_genes
+        sq_mean = np.ravel(x.multiply(x).sum(1, dtype=np.float64)) / n_genes
+    else:
+        mean_bin = x.mean(1, dtype=np.float64)
+        sq_mean = np.square(x, dtype=np.float64).mean(1)
+    std_bin = np.sqrt(np.maximum(sq_mean - mean_bin ** 2, 0))
+    # average them over the neighbors of each bin, the bin without any neighbor uses its own
+    graph = radius_neighbor_graph(position, r)
+    n_neighbor = np.ravel(graph.sum(1))
+    has_neighbor = n_neighbor > 0
+    mean_bins, std_bins = mean_bin.copy(), std_bin.copy()
+    mean_bins[has_neighbor] = (graph @ mean_bin)[has_neighbor] / n_neighbor[has_neighbor]
+    std_bins[has_neighbor] = (graph @ std_bin)[has_neighbor] / n_neighbor[has_neighbor]
+    # (x - mean) / std + 1 = x * scale + offset
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = (1 / std_bins).astype(np.float32)
+        offset = (1 - mean_bins / std_bins).astype(np.float32)
+    zscore = np.empty(x.shape, dtype=np.float32)
+    for start in range(0, x.shape[0], chunk_size):
+        end = min(start + chunk_size, x.shape[0])
+        chunk = x[start:end]
+        chunk = chunk.toarray() if issparse(chunk) else chunk
+        np.multiply(chunk, scale[start:end, np.newaxis], out=zscore[start:end], casting='unsafe')
+        zscore[start:end] += offset[start:end, np.newaxis]
+    return zscore
@@ -4,3 +4,4 @@ __email__ = "saketkc@gmail.com"
 __version__ = "0.1.1"
 
 from .pysctransform import get_hvg_residuals, vst, SCTransform
+from .sct_model import SCTModel
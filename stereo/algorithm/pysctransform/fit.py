@@ -177,3 +177,132 @@ def theta_lbfgs(y, mu, maxoverdispersion=1e5):
         nll, init_theta, bounds=[(1 / maxoverdispersion, None)], method="L-BFGS-B"
     )
     return theta.x[0]
+
+
+def estimate_mu_poisson_batch(umi, model_matrix, max_iters=50, tol=1e-8):
+    """Fit the Poisson GLM of a block of genes at once by vectorized IRLS.
+
+    The log link is canonical for Poisson, so IRLS is the Newton method
+    of the log likelihood, each step solves a p x p system per gene.
+
+    Parameters
+    ----------
+    umi: sparse matrix
+         genes x cells, the counts are never densified
+    model_matrix: matrix
+                  cells x p design matrix
+    max_iters: int
+               maximum number of IRLS steps
+    tol: float
+         the genes stop once the largest change of their coefficients is below tol
+
+    Returns
+    -------
+    coef: array of genes x p
+    mu: array of genes x cells
+    """
+    x = npy.asarray(model_matrix, dtype=float)
+    n_genes = umi.shape[0]
+    n_coef = x.shape[1]
+    # the sufficient statistics of the counts
+    yx = npy.asarray(umi @ x)
+    y_mean = npy.ravel(umi.sum(1)) / umi.shape[1]
+    # start from the mean of each gene, projected on the design
+    coef = npy.outer(npy.log(npy.maximum(y_mean, 1e-12)), npy.linalg.pinv(x) @ npy.ones(x.shape[0]))
+    xx = (x[:, :, None] * x[:, None, :]).reshape(x.shape[0], -1)
+    active = npy.ones(n_genes, dtype=bool)
+    for _ in range(max_iters):
+        if not active.any():
+            break
+        mu = npy.exp(npy.minimum(coef[active] @ x.T, 50))
+        hessian = (mu @ xx).reshape(-1, n_coef, n_coef)
+        gradient = yx[active] - mu @ x
+        delta = npy.linalg.solve(hessian, gradient[:, :, None])[:, :, 0]
+        coef[active] += delta
+        converged = npy.abs(delta).max(1) < tol * (1 + npy.abs(coef[active]).max(1))
+        active[npy.flatnonzero(active)[converged]] = False
+    mu = npy.exp(npy.minimum(coef @ x.T, 50))
+    return coef, mu
+
+
+def theta_ml_batch(umi, mu, max_iters=20, tol=1e-4):
+    """Estimate theta of a block of genes at once by vectorized Newton steps.
+
+    The digamma and trigamma terms are zero for zero counts, so they are
+    summed over the distinct non-zero counts of each gene only.
+
+    Parameters
+    ----------
+    umi: sparse matrix
+         genes x cells of integer counts
+    mu: array
+        genes x cells fitted means
+    max_iters: int
+               maximum number of Newton steps
+    tol: float
+         the genes stop once the change of theta is below tol
+
+    Returns
+    -------
+    theta: array of genes, inf if there is no maximum
+    """
+    n_genes, n_cells = mu.shape
+    umi = umi.tocoo()
+    rows, cols, y = umi.row, umi.col, npy.asarray(umi.data, dtype=float)
+    y_mu = y / mu[rows, cols]
+    # sum((y / mu - 1) ** 2) with each zero count adding 1
+    dispersion = n_cells + npy.bincount(rows, weights=(y_mu - 1) ** 2 - 1, minlength=n_genes)
+    theta = n_cells / dispersion
+    # the lookup table of the distinct counts of each gene, inspired from glmGamPoi
+    max_y = int(y.max()) + 1 if len(y) else 1
+    lookup, lookup_count = npy.unique(rows.astype(npy.int64) * max_y + y.astype(npy.int64), return_counts=True)
+    lookup_rows, lookup_y = lookup // max_y, (lookup % max_y).astype(float)
+    n_nonzero = npy.bincount(rows, minlength=n_genes)
+    active = npy.ones(n_genes, dtype=bool)
+    for _ in range(max_iters):
+        if not active.any():
+            break
+        theta = npy.abs(theta)
+        index = npy.flatnonzero(active)
+        t = theta[index]
+        mu_t = mu[index] + t[:, None]
+        position = npy.cumsum(active) - 1
+        # the non-zeros and the lookup table of the active genes, with the rows mapped to the position in index
+        nz = active[rows]
+        nz_pos = position[rows[nz]]
+        nz_y, nz_mu_t = y[nz], mu_t[nz_pos, cols[nz]]
+        lk = active[lookup_rows]
+        lk_pos = position[lookup_rows[lk]]
+        lk_y, lk_count = lookup_y[lk], lookup_count[lk]
+        lk_t = t[lk_pos]
+
+        def nz_sum(values, pos=nz_pos):
+            return npy.bincount(pos, weights=values, minlength=len(index))
+
+        log_mu_t = npy.log(mu_t).sum(1)
+        npy.reciprocal(mu_t, out=mu_t)
+        inv_mu_t = mu_t.sum(1)
+        inv_mu_t2 = npy.einsum("ij,ij->i", mu_t, mu_t)
+        score = (
+            nz_sum(digamma(lk_y + lk_t) * lk_count, lk_pos)
+            - digamma(t) * n_nonzero[index]
+            + n_cells * (npy.log(t) + 1)
+            - log_mu_t
+            - nz_sum(nz_y / nz_mu_t)
+            - t * inv_mu_t
+        )
+        hessian = (
+            nz_sum(trigamma(lk_y + lk_t) * lk_count, lk_pos)
+            - trigamma(t) * n_nonzero[index]
+            + n_cells / t
+            - 2 * inv_mu_t
+            + nz_sum(nz_y / nz_mu_t ** 2)
+            + t * inv_mu_t2
+        )
+        # if first diff is negative, there is no maximum
+        no_max = score < 0
+        delta = score / hessian
+        theta[index] = npy.where(no_max, npy.inf, t - delta)
+        active[index[no_max | (npy.abs(delta) <= tol)]] = False
+    theta[theta < 0] = npy.inf
+    return theta
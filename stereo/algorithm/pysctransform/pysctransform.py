@@ -29,8 +29,10 @@ logging.captureWarnings(True)
 
 from .fit import alpha_lbfgs
 from .fit import estimate_mu_poisson
+from .fit import estimate_mu_poisson_batch
 from .fit import theta_lbfgs
 from .fit import theta_ml
+from .fit import theta_ml_batch
 from .fit_glmgp import fit_glmgp
 from .fit_glmgp import fit_glmgp_offset
 
@@ -72,8 +74,9 @@ def bwSJ(genes_log10_gmean_step1, bw_adjust=3):
 
 
 def robust_scale(x):
+    # median_absolute_deviation was removed from scipy 1.9, its default scale is the normal one
     return (x - npy.median(x)) / (
-        stats.median_absolute_deviation(x) + npy.finfo(float).eps
+        stats.median_abs_deviation(x, scale="normal") + npy.finfo(float).eps
     )
 
 
@@ -83,7 +86,7 @@ def robust_scale_binned(y, x, breaks):
     # categories = bins.categories
     # bins = npy.digitize(x=x, bins=breaks)
     df = pd.DataFrame({"x": y, "bins": bins})
-    tmp = df.groupby(["bins"]).apply(robust_scale)
+    tmp = df.groupby(["bins"], group_keys=False)[["x"]].apply(robust_scale)
     order = df["bins"].argsort()
     tmp = tmp.loc[order]  # sort_values(by=["bins"])
     score = tmp["x"]
@@ -274,6 +277,49 @@ def get_model_params_allgene(
     return params_df
 
 
+def get_model_params_allgene_batch(
+    umi, model_matrix, fix_slope=False, batch_size=256, verbosity=0
+):
+    """Estimate the theta_ml model parameters of blocks of genes at once.
+
+    The Poisson GLM of each block is fit by vectorized IRLS and theta by
+    vectorized Newton steps, directly on the sparse rows of the block.
+
+    Parameters
+    ----------
+    umi: sparse matrix
+         genes x cells
+    model_matrix: matrix
+                  GLM model matrix
+    fix_slope: bool
+               fix the slope to log(10) and only estimate theta
+    batch_size: int
+                number of genes fitted at once, the memory of a block is batch_size x cells
+    """
+    umi = csr_matrix(umi)
+    column_names = model_matrix.design_info.column_names
+    if fix_slope:
+        gene_mean = npy.ravel(umi.mean(1))
+        cell_umi = npy.log10(npy.ravel(umi.sum(0)))
+        offset_intercept = npy.log(gene_mean) - npy.log(npy.mean(cell_umi))
+    params = []
+    blocks = range(0, umi.shape[0], batch_size)
+    for start in tqdm(blocks) if verbosity else blocks:
+        block = umi[start:start + batch_size]
+        if fix_slope:
+            intercept = offset_intercept[start:start + batch_size]
+            mu = npy.exp(intercept[:, None] + npy.log(10) * cell_umi[None, :])
+            block_params = pd.DataFrame({"theta": npy.nan, "Intercept": intercept, "log10_umi": npy.log(10)})
+        else:
+            coef, mu = estimate_mu_poisson_batch(block, model_matrix)
+            block_params = pd.DataFrame(coef, columns=column_names)
+        theta = theta_ml_batch(block, mu)
+        theta[theta >= 1e5] = npy.inf
+        block_params["theta"] = theta
+        params.append(block_params)
+    return pd.concat(params, ignore_index=True)
+
+
 def dds(genes_log10_gmean_step1, grid_points=2 ** 10):
     # density dependent downsampling
     # print(genes_log10_gmean_step1.shape)
@@ -441,6 +487,105 @@ def get_residuals(
     return residuals
 
 
+def get_clip_range(res_clip_range, total_cells):
+    """Get the [min, max] range to clip the residuals.
+
+    Parameters
+    ----------
+    res_clip_range: string or list
+                    options: 1)"seurat": Clips residuals to -sqrt(ncells/30), sqrt(ncells/30)
+                             2)"default": Clips residuals to -sqrt(ncells), sqrt(ncells)
+    total_cells: int
+                 Number of cells
+    """
+    if res_clip_range == "seurat":
+        return [-npy.sqrt(total_cells / 30), npy.sqrt(total_cells / 30)]
+    if res_clip_range == "default":
+        return [-npy.sqrt(total_cells), npy.sqrt(total_cells)]
+    if not isinstance(res_clip_range, list):
+        raise RuntimeError("res_clip_range should be a list or string")
+    return res_clip_range
+
+
+def stream_residuals(
+    umi,
+    model_matrix,
+    model_parameters_fit,
+    genes=None,
+    residual_type="pearson",
+    clip_range=None,
+    batch_size=None,
+    residual_path=None,
+):
+    """Compute the residuals block of genes by block of genes.
+
+    Only the residuals of `genes` are kept, as a float32 cell x gene matrix,
+    the mean and variance of the residuals are computed for all genes.
+
+    Parameters
+    ----------
+    umi: sparse matrix
+         genes x cells, in the same order as model_parameters_fit
+    model_matrix: matrix
+                  GLM model matrix
+    model_parameters_fit: DataFrame
+                          dataframe of model fit parameters
+    genes: list
+           positions of the genes to keep the residuals, in the order of the columns of the result;
+           default is all genes
+    residual_type: string
+                   "pearson" or "deviance" residuals
+    clip_range: list
+                [min, max] to clip the kept residuals, after the "default" clipping of all residuals
+    batch_size: int
+                Number of genes per block, default is about 2^22 values per block
+    residual_path: string
+                   Path of a .npy file to write the kept residuals block by block, they are returned as a
+                   read-only memmap of the file; default keeps them in memory
+
+    Returns
+    -------
+    residuals: array of cells x genes
+    residual_mean: array of all genes
+    residual_variance: array of all genes
+    """
+    n_genes, n_cells = umi.shape
+    genes = npy.arange(n_genes) if genes is None else npy.asarray(genes, dtype=int)
+    if batch_size is None:
+        batch_size = max(1, 2 ** 22 // max(n_cells, 1))
+    umi = csr_matrix(umi)
+    shape = (n_cells, len(genes))
+    if residual_path is None:
+        residuals = npy.empty(shape, dtype=npy.float32)
+    else:
+        residuals = npy.lib.format.open_memmap(residual_path, mode="w+", dtype=npy.float32, shape=shape)
+    residual_mean = npy.empty(n_genes)
+    residual_variance = npy.empty(n_genes)
+    for start in range(0, n_genes, batch_size):
+        end = min(start + batch_size, n_genes)
+        block = npy.asarray(
+            get_residuals(
+                umi[start:end],
+                model_matrix,
+                model_parameters_fit.iloc[start:end],
+                residual_type,
+            )
+        )
+        residual_mean[start:end] = block.mean(1)
+        residual_variance[start:end] = block.var(1, ddof=1)
+        keep = npy.flatnonzero((genes >= start) & (genes < end))
+        if len(keep):
+            kept = block[genes[keep] - start]
+            if clip_range is not None:
+                kept = npy.clip(kept, clip_range[0], clip_range[1])
+            residuals[:, keep] = kept.T
+    if residual_path is not None:
+        residuals.flush()
+        del residuals
+        residuals = npy.load(residual_path, mmap_mode="r")
+    return residuals, residual_mean, residual_variance
+
+
 def correct(residuals, cell_attr, latent_var, model_parameters_fit, umi):
     # replace value of latent variables with its median
     cell_attr = cell_attr.copy()
@@ -482,10 +627,14 @@ def vst(
     exclude_poisson=False,
     fix_slope=False,
     verbosity=0,
+    batch_size=256,
+    residual_features="all",
+    residual_batch_size=None,
+    residual_path=None,
 ):
     """Perform variance stabilizing transformation.
 
-    Residuals are currently stored for all genes (might be memory intensive for larger datasets).
+    Residuals are computed block by block, and stored as float32 for `residual_features` only.
 
     Parameters
     ----------
@@ -519,6 +668,17 @@ def vst(
                Whether to fix the slope; default is False
     verbosity: bool
                Print verbose messages
+    batch_size: int
+                Number of genes fitted at once by the vectorized engine of method "theta_ml";
+                None to fit the genes one by one; default is 256
+    residual_features: "all", None or list
+                       Genes to store the residuals for; None only computes the residual mean and variance of
+                       the genes, e.g. to select the highly variable genes first; default is "all"
+    residual_batch_size: int
+                         Number of genes per block when computing the residuals; default is about 2^22 values
+    residual_path: string
+                   Path of a .npy file to write the stored residuals incrementally, then "residuals" is a
+                   cell x gene memmap of the file rather than a gene x cell DataFrame
     """
     umi = umi.copy()
     if n_cells is None:
@@ -637,6 +797,11 @@ def vst(
             umi_step1, data_step1, threads=4, use_offset=True
         )
         model_parameters.index = genes_step1
+    elif method == "theta_ml" and batch_size:
+        model_parameters = get_model_params_allgene_batch(
+            umi_step1, model_matrix, fix_slope, batch_size, verbosity
+        )
+        model_parameters.index = genes_step1
     elif method in ["theta_ml", "theta_lbfgs", "alpha_lbfgs"]:
         model_parameters = get_model_params_allgene(
             umi_step1, model_matrix, method, threads, fix_slope
@@ -744,28 +909,47 @@ def vst(
         print("Running Step3")
 
     start = time.time()
-    residuals = pd.DataFrame(
-        get_residuals(umi, model_matrix, model_parameters_fit, residual_type)
+    if residual_features is None:
+        residual_genes = npy.array([], dtype=int)
+    elif isinstance(residual_features, str) and residual_features == "all":
+        residual_genes = npy.arange(len(genes))
+    else:
+        residual_genes = pd.Index(genes).get_indexer(residual_features)
+        if (residual_genes < 0).any():
+            raise ValueError("residual_features has genes not in the fitted genes")
+    residuals, residual_mean, residual_variance = stream_residuals(
+        umi,
+        model_matrix,
+        model_parameters_fit,
+        residual_genes,
+        residual_type,
+        batch_size=residual_batch_size,
+        residual_path=residual_path,
     )
-    residuals.index = genes
-    residuals.columns = cell_names
+    if residual_path is None:
+        residuals = pd.DataFrame(
+            residuals.T, index=genes[residual_genes], columns=cell_names
+        )
     end = time.time()
     step3_time = npy.ceil(end - start)
     if verbosity:
         print("Step3 done. Took {} seconds.".format(npy.ceil(end - start)))
 
     gene_attr["theta_regularized"] = model_parameters_fit["theta"]
-    gene_attr["residual_mean"] = residuals.mean(1)
-    gene_attr["residual_variance"] = residuals.var(1)
+    gene_attr["residual_mean"] = residual_mean
+    gene_attr["residual_variance"] = residual_variance
 
     corrected_counts = None
     if correct_counts:
+        if not isinstance(residuals, pd.DataFrame) or len(residual_genes) != len(genes):
+            raise ValueError('correct_counts needs the residuals of all genes in memory')
         corrected_counts = correct(
             residuals, cell_attr, latent_var, model_parameters_fit, umi
         )
 
     return {
         "residuals": residuals,
+        "residual_genes": genes[residual_genes],
         "model_parameters": model_parameters_to_return,
         "model_parameters_fit": model_parameters_fit,
         "corrected_counts": corrected_counts,
@@ -783,7 +967,7 @@ def vst(
     }
 
 
-def get_hvg_residuals(vst_out, var_features_n=3000, res_clip_range="seurat"):
+def get_hvg_residuals(vst_out, var_features_n=3000, res_clip_range="seurat", umi=None):
     """Get residuals for highly variable genes (hvg)
     Get residuals for n highly variable genes (sorted by decreasing residual variance)
 
@@ -797,11 +981,14 @@ def get_hvg_residuals(vst_out, var_features_n=3000, res_clip_range="seurat"):
                              2)"default": Clips residuals to -sqrt(ncells), sqrt(ncells)
     var_features_n: int
                     Number of variable features to select (for calculating a subset of pearson residuals)
+    umi: sparse matrix
+         genes x cells matrix of the fitted genes, in the order of vst_out["gene_attr"]; needed when
+         vst() did not store the residuals of the hvg, which are then computed block by block
 
     Returns
     -------
     hvg_residuals: matrix
-                   A gene x cell matrix of hvg residuals
+                   A cell x gene matrix of hvg residuals
 
     """
 
@@ -809,14 +996,22 @@ def get_hvg_residuals(vst_out, var_features_n=3000, res_clip_range="seurat"):
     total_cells = vst_out["total_cells"]
     gene_attr = gene_attr.sort_values(by=["residual_variance"], ascending=False)
     highly_variable = gene_attr.index[:var_features_n].tolist()
-    if res_clip_range == "seurat":
-        clip_range = [-npy.sqrt(total_cells / 30), npy.sqrt(total_cells / 30)]
-    elif res_clip_range == "default":
-        clip_range = [-npy.sqrt(total_cells), npy.sqrt(total_cells)]
-    else:
-        if not isinstance(res_clip_range, list):
-            raise RuntimeError("res_clip_range should be a list or string")
-        clip_range = res_clip_range
+    clip_range = get_clip_range(res_clip_range, total_cells)
+    if not isinstance(vst_out["residuals"], pd.DataFrame) or not set(
+        highly_variable
+    ).issubset(vst_out["residuals"].index):
+        if umi is None:
+            raise ValueError("umi is needed to compute the residuals of the hvg")
+        residuals, _, _ = stream_residuals(
+            umi,
+            vst_out["model_matrix"],
+            vst_out["model_parameters_fit"],
+            vst_out["gene_attr"].index.get_indexer(highly_variable),
+            clip_range=clip_range,
+        )
+        return pd.DataFrame(
+            residuals, index=vst_out["cell_attr"].index, columns=highly_variable
+        )
     hvg_residuals = vst_out["residuals"].T[highly_variable]
     hvg_residuals = npy.clip(hvg_residuals, clip_range[0], clip_range[1])
     return hvg_residuals
@@ -0,0 +1,180 @@
+"""Reusable regularized sctransform model."""
+import h5py
+import numpy as npy
+import pandas as pd
+from patsy import dmatrix
+from scipy.sparse import csr_matrix
+
+from .pysctransform import get_clip_range
+from .pysctransform import make_cell_attr
+from .pysctransform import stream_residuals
+
+
+class SCTModel(object):
+    """Regularized sctransform model of a tissue.
+
+    The model keeps the regularized parameters of the genes and the design
+    of the cell attributes, so the residuals of new samples are computed
+    without fitting the genes and regularizing the parameters again.
+
+    Parameters
+    ----------
+    model_parameters_fit: DataFrame
+                          genes x parameters, the regularized parameters of vst(),
+                          with a column for each design column and "theta"
+    design: string
+            patsy formula of the cell attributes, e.g. "1 + log10_umi"
+    features: list
+              genes whose residuals are returned by apply(); default is all genes
+    residual_type: string
+                   "pearson" or "deviance" residuals; default is "pearson"
+    """
+
+    def __init__(
+        self, model_parameters_fit, design, features=None, residual_type="pearson"
+    ):
+        self.model_parameters_fit = model_parameters_fit
+        self.design = design
+        self.features = (
+            list(model_parameters_fit.index) if features is None else list(features)
+        )
+        self.residual_type = residual_type
+
+    @classmethod
+    def from_vst(cls, vst_out, features=None, residual_type="pearson"):
+        """Get the model from the output of vst().
+
+        Parameters
+        ----------
+        vst_out: dict
+                 output of vst()
+        features: list
+                  genes whose residuals are returned by apply(); default is all fitted genes
+        residual_type: string
+                       the residual_type of vst()
+        """
+        design = vst_out["model_matrix"].design_info.describe()
+        return cls(vst_out["model_parameters_fit"], design, features, residual_type)
+
+    @property
+    def genes(self):
+        return self.model_parameters_fit.index
+
+    def model_matrix(self, umi, cell_names=None):
+        """Get the GLM model matrix of the cells.
+
+        Parameters
+        ----------
+        umi: sparse matrix
+             genes x cells matrix of all genes of the sample
+        cell_names: list
+                    List of cell names for umi matrix
+        """
+        if cell_names is None:
+            cell_names = npy.arange(umi.shape[1]).astype(str)
+        return dmatrix(self.design, make_cell_attr(umi, cell_names))
+
+    def apply(
+        self,
+        umi,
+        gene_names,
+        cell_names=None,
+        features=None,
+        res_clip_range="seurat",
+        batch_size=None,
+        residual_path=None,
+    ):
+        """Compute the residuals of a new sample with the model.
+
+        The genes of the model which are not in the sample are taken as zero counts.
+
+        Parameters
+        ----------
+        umi: sparse matrix
+             cells x genes matrix of the new sample
+        gene_names: list
+                    List of gene names for umi matrix
+        cell_names: list
+                    List of cell names for umi matrix
+        features: list
+                  genes to return the residuals; default is self.features
+        res_clip_range: string, list or None
+                        options: 1)"seurat": Clips residuals to -sqrt(ncells/30), sqrt(ncells/30)
+                                 2)"default": Clips residuals to -sqrt(ncells), sqrt(ncells)
+                        None only clips by "default", the same as the residuals of vst()
+        batch_size: int
+                    Number of genes per block, see stream_residuals()
+        residual_path: string
+                       Path of a .npy file to write the residuals incrementally
+
+        Returns
+        -------
+        residuals: array of cells x features, float32
+        features: list of the genes of the residuals
+        """
+        umi = csr_matrix(umi)
+        model_matrix = self.model_matrix(umi.T, cell_names)
+        # take the rows of the model genes, the missing genes are left empty
+        positions = pd.Index(npy.asarray(gene_names)).get_indexer(self.genes)
+        found = npy.flatnonzero(positions >= 0)
+        selection = csr_matrix(
+            (npy.ones(len(found)), (found, positions[found])),
+            shape=(len(self.genes), umi.shape[1]),
+        )
+        model_umi = (selection @ umi.T).tocsr()
+        features = self.features if features is None else list(features)
+        feature_positions = self.genes.get_indexer(features)
+        if (feature_positions < 0).any():
+            raise ValueError("features has genes not in the model")
+        residuals, _, _ = stream_residuals(
+            model_umi,
+            model_matrix,
+            self.model_parameters_fit,
+            feature_positions,
+            self.residual_type,
+            clip_range=None
+            if res_clip_range is None
+            else get_clip_range(res_clip_range, umi.shape[0]),
+            batch_size=batch_size,
+            residual_path=residual_path,
+        )
+        return residuals, features
+
+    def save(self, path):
+        """Save the model as a h5 file.
+
+        Parameters
+        ----------
+        path: string
+              Path of the h5 file
+        """
+        from stereo.io.h5ad import write_dataframe
+
+        with h5py.File(path, mode="w") as f:
+            write_dataframe(f, "model_parameters_fit", self.model_parameters_fit)
+            f.create_dataset(
+                "features",
+                data=npy.asarray(self.features, dtype=object),
+                dtype=h5py.special_dtype(vlen=str),
+            )
+            f.attrs["design"] = self.design
+            f.attrs["residual_type"] = self.residual_type
+
+    @classmethod
+    def load(cls, path):
+        """Load the model saved by save().
+
+        Parameters
+        ----------
+        path: string
+              Path of the h5 file
+        """
+        from stereo.io.h5ad import read_dataframe
+        from stereo.io.h5ad import read_dataset
+
+        with h5py.File(path, mode="r") as f:
+            model_parameters_fit = read_dataframe(f["model_parameters_fit"])
+            features = read_dataset(f["features"])
+            design = f.attrs["design"]
+            residual_type = f.attrs["residual_type"]
+        return cls(model_parameters_fit, design, list(features), residual_type)
@@ -10,7 +10,6 @@
 change log:
     2021/10/14 create file.
 """
-import copy
 import pandas as pd
 import hotspot
 
@@ -39,7 +38,7 @@ def spatial_hotspot(data, model='normal', n_neighbors=30, n_jobs=20, fdr_thresho
 
     """
 
-    hit_data = copy.deepcopy(data)
+    hit_data = data.view()
     counts = hit_data.to_df().T  # gene x cell
     pos = pd.DataFrame(hit_data.position, index=counts.columns)  # cell name as index
     num_umi = counts.sum(axis=0)  # total counts per cell
@@ -0,0 +1,159 @@
+"""The on-disk csr matrix, which is lazily sliced and read chunk by chunk."""
+from typing import Optional
+import h5py
+import numpy as np
+from scipy import sparse
+
+
+class BackedCSRMatrix(object):
+    """
+    a lazy csr view over the `data`, `indices` and `indptr` datasets of a csr group in a h5 file. Slicing only records
+    the row and column indexes, the values are read from the file chunk by chunk when they are needed.
+
+    :param file_path: the path of h5 file.
+    :param key: the key of the csr group in the h5 file.
+    :param row_index: the selected rows of the csr group, default all rows.
+    :param col_index: the selected columns of the csr group, default all columns.
+    :param chunk_size: the number of rows read from the file per chunk.
+    """
+    def __init__(self, file_path: str, key: str = 'exp_matrix', row_index: Optional[np.ndarray] = None,
+                 col_index: Optional[np.ndarray] = None, chunk_size: int = 10000):
+        self.file_path = str(file_path)
+        self.key = key
+        self.chunk_size = chunk_size
+        with h5py.File(self.file_path, mode='r') as f:
+            group = f[key]
+            if group.attrs.get('encoding-type') != 'csr_matrix':
+                raise ValueError(f'{key} is not a csr matrix, only the csr matrix supports backed mode.')
+            self._full_shape = tuple(int(i) for i in group.attrs['shape'])
+            self.dtype = group['data'].dtype
+        self.row_index = row_index
+        self.col_index = col_index
+
+    ndim = 2
+
+    @property
+    def shape(self):
+        n_rows = self._full_shape[0] if self.row_index is None else len(self.row_index)
+        n_cols = self._full_shape[1] if self.col_index is None else len(self.col_index)
+        return n_rows, n_cols
+
+    @property
+    def nnz(self):
+        return int(self.getnnz())
+
+    def __repr__(self):
+        return f'<{self.shape[0]}x{self.shape[1]} backed csr matrix of type {self.dtype} in {self.file_path}:{self.key}>'
+
+    @staticmethod
+    def _normalize_index(index, length: int, current: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """
+        compose the new index with the current selected index.
+        """
+        if isinstance(index, slice) and index == slice(None):
+            return current
+        positions = np.arange(length)[index]
+        positions = np.atleast_1d(positions)
+        return positions if current is None else current[positions]
+
+    def __getitem__(self, index):
+        row, col = index if isinstance(index, tuple) else (index, slice(None))
+        n_rows, n_cols = self.shape
+        return BackedCSRMatrix(self.file_path, self.key,
+                               row_index=self._normalize_index(row, n_rows, self.row_index),
+                               col_index=self._normalize_index(col, n_cols, self.col_index),
+                               chunk_size=self.chunk_size)
+
+    def _read_rows(self, group, rows: np.ndarray) -> sparse.csr_matrix:
+        """
+        read the rows of the csr group, the contiguous rows are read as one hyperslab.
+        """
+        uniq_rows, inverse = np.unique(rows, return_inverse=True)
+        if len(uniq_rows) == 0:
+            return sparse.csr_matrix((0, self._full_shape[1]), dtype=self.dtype)
+        indptr = group['indptr']
+        starts = np.asarray(indptr[uniq_rows[0]:uniq_rows[-1] + 2])
+        breaks = np.where(np.diff(uniq_rows) > 1)[0] + 1
+        data, indices, row_nnz = [], [], []
+        for run in np.split(uniq_rows, breaks):
+            begin, end = starts[run[0] - uniq_rows[0]], starts[run[-1] - uniq_rows[0] + 1]
+            data.append(group['data'][begin:end])
+            indices.append(group['indices'][begin:end])
+            row_nnz.append(np.diff(starts[run[0] - uniq_rows[0]:run[-1] - uniq_rows[0] + 2]))
+        row_nnz = np.concatenate(row_nnz)
+        mtx_indptr = np.zeros(len(uniq_rows) + 1, dtype=np.int64)
+        mtx_indptr[1:] = np.cumsum(row_nnz)
+        mtx = sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), mtx_indptr),
+                                shape=(len(uniq_rows), self._full_shape[1]))
+        return mtx if len(uniq_rows) == len(rows) and (inverse == np.arange(len(rows))).all() else mtx[inverse]
+
+    def iter_chunks(self, chunk_size: Optional[int] = None):
+        """
+        iterate the selected rows chunk by chunk.
+
+        :param chunk_size: the number of rows per chunk, default is self.chunk_size.
+        :return: an iterator of (start, end, csr_matrix), the chunk is the rows [start, end) of this matrix.
+        """
+        chunk_size = self.chunk_size if chunk_size is None else chunk_size
+        n_rows = self.shape[0]
+        with h5py.File(self.file_path, mode='r') as f:
+            group = f[self.key]
+            for start in range(0, n_rows, chunk_size):
+                end = min(start + chunk_size, n_rows)
+                rows = np.arange(start, end) if self.row_index is None else self.row_index[start:end]
+                chunk = self._read_rows(group, rows)
+                if self.col_index is not None:
+                    chunk = chunk[:, self.col_index]
+                yield start, end, chunk
+
+    def to_memory(self) -> sparse.csr_matrix:
+        """
+        read the selected rows and columns into memory.
+
+        :return: a csr matrix.
+        """
+        chunks = [chunk for _, _, chunk in self.iter_chunks()]
+        if not chunks:
+            return sparse.csr_matrix(self.shape, dtype=self.dtype)
+        return sparse.vstack(chunks, format='csr')
+
+    def tocsr(self):
+        return self.to_memory()
+
+    def toarray(self):
+        return self.to_memory().toarray()
+
+    def _reduce(self, func, axis, dtype):
+        if axis is None:
+            return self._reduce(func, 1, dtype).sum()
+        if axis not in (0, 1):
+            raise ValueError(f'axis {axis} out of range.')
+        res = np.zeros(self.shape[1 - axis], dtype=dtype)
+        for start, end, chunk in self.iter_chunks():
+            if axis == 1:
+                res[start:end] = np.ravel(func(chunk, 1))
+            else:
+                res += np.ravel(func(chunk, 0))
+        return res
+
+    def sum(self, axis=None):
+        """
+        sum the matrix over the given axis by streaming the chunks.
+
+        :param axis: None, 0 or 1.
+        :return: the sum, a np.matrix like scipy sparse matrix if axis is not None.
+        """
+        res_dtype = np.float64 if self.dtype.kind == 'f' else np.int64
+        res = self._reduce(lambda x, ax: x.sum(ax), axis, res_dtype)
+        if axis is None:
+            return res
+        return np.asmatrix(res).T if axis == 1 else np.asmatrix(res)
+
+    def getnnz(self, axis=None):
+        """
+        count the number of stored values over the given axis by streaming the chunks.
+
+        :param axis: None, 0 or 1.
+        :return: the count of stored values.
+        """
+        return self._reduce(lambda x, ax: x.getnnz(axis=ax), axis, np.int64)
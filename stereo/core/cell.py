@@ -11,18 +11,45 @@ change log:
     2021/06/29  create file.
     2021/08/17  add get_property and to_df function to file, by wuyiran.
 """
-from typing import Optional
+from typing import Optional, Union
 
 import numpy as np
 import pandas as pd
+from .name_index import NameIndex
+
+
+def encode_coor_id(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    pack the coordinates into uint64 ids, x in the high 32 bits and y in the low 32 bits, like the cell ids of gef.
+
+    :param x: the x coordinates.
+    :param y: the y coordinates.
+    :return: a numpy array of uint64 ids.
+    """
+    return np.bitwise_or(np.left_shift(np.asarray(x).astype(np.uint64), np.uint64(32)),
+                         np.asarray(y).astype(np.uint64))
+
+
+def decode_coor_id(ids: np.ndarray):
+    """
+    unpack the uint64 ids into the coordinates.
+
+    :param ids: the uint64 ids.
+    :return: the x and y coordinates.
+    """
+    ids = np.asarray(ids, dtype=np.uint64)
+    return np.right_shift(ids, np.uint64(32)).astype(np.int64), \
+        np.bitwise_and(ids, np.uint64(0xffffffff)).astype(np.int64)
 
 
 class Cell(object):
     def __init__(self, cell_name: Optional[np.ndarray] = None):
         self._cell_name = cell_name
+        self._name_index = None
         self.total_counts = None
         self.pct_counts_mt = None
         self.n_genes_by_counts = None
+        self.sample = None
 
     @property
     def cell_name(self):
@@ -44,6 +71,52 @@ class Cell(object):
         if not isinstance(name, np.ndarray):
             raise TypeError('cell name must be a np.ndarray object.')
         self._cell_name = name
+        self._name_index = None
+
+    def get_indexer(self, names: Union[np.ndarray, list]) -> np.ndarray:
+        """
+        get the positions of the cell names by a hash index, which is built at the first lookup and rebuilt after the
+        cell names are set.
+
+        :param names: a list of cell names, the `x_y` strings are accepted if the cell names are packed ids.
+        :return: a numpy array of positions.
+        """
+        if self._name_index is None:
+            self._name_index = NameIndex(self.cell_name)
+        return self._name_index.get_positions(self.encode_names(names), kind='cell')
+
+    @property
+    def is_coor_id(self):
+        """
+        whether the cell names are the uint64 ids packed by the coordinates of bins.
+
+        :return:
+        """
+        return self._cell_name is not None and self._cell_name.dtype == np.uint64
+
+    def get_str_names(self) -> np.ndarray:
+        """
+        get the cell names as strings, the packed ids are formatted as `x_y`.
+
+        :return: a numpy array of names.
+        """
+        if not self.is_coor_id:
+            return self.cell_name.astype(str)
+        x, y = decode_coor_id(self.cell_name)
+        return np.char.add(np.char.add(x.astype(str), '_'), y.astype(str))
+
+    def encode_names(self, names: Union[np.ndarray, list]) -> np.ndarray:
+        """
+        convert the names to the type of cell names, the `x_y` strings are packed into ids if the cell names are ids.
+
+        :param names: a list of names.
+        :return: a numpy array of names.
+        """
+        names = np.asarray(names)
+        if not self.is_coor_id or names.dtype.kind not in {'U', 'S', 'O'}:
+            return names
+        coor = pd.Series(names.astype(str)).str.split('_', n=1, expand=True).values.astype(np.int64).reshape(-1, 2)
+        return encode_coor_id(coor[:, 0], coor[:, 1])
 
     def sub_set(self, index):
         """
@@ -60,6 +133,8 @@ class Cell(object):
             self.pct_counts_mt = self.pct_counts_mt[index]
         if self.n_genes_by_counts is not None:
             self.n_genes_by_counts = self.n_genes_by_counts[index]
+        if self.sample is not None:
+            self.sample = self.sample[index]
         return self
 
     def get_property(self, name):
@@ -75,6 +150,8 @@ class Cell(object):
             return self.pct_counts_mt
         if name == 'n_genes_by_counts':
             return self.n_genes_by_counts
+        if name == 'sample':
+            return self.sample
 
     def to_df(self):
         """
@@ -87,5 +164,7 @@ class Cell(object):
             'pct_counts_mt': self.pct_counts_mt,
             'n_genes_by_counts': self.n_genes_by_counts
         }
+        if self.sample is not None:
+            attributes['sample'] = self.sample
         df = pd.DataFrame(attributes, index=self.cell_name)
         return df
@@ -10,14 +10,16 @@
 change log:
     2021/06/29  create file.
 """
-from typing import Optional
+from typing import Optional, Union
 import numpy as np
 import pandas as pd
+from .name_index import NameIndex
 
 
 class Gene(object):
     def __init__(self, gene_name: Optional[np.ndarray]):
         self._gene_name = gene_name if gene_name is None else gene_name.astype('U')
+        self._name_index = None
         self.n_cells = None
         self.n_counts = None
 
@@ -41,6 +43,19 @@ class Gene(object):
         if not isinstance(name, np.ndarray):
             raise TypeError('gene name must be a np.ndarray object.')
         self._gene_name = name.astype('U')
+        self._name_index = None
+
+    def get_indexer(self, names: Union[np.ndarray, list]) -> np.ndarray:
+        """
+        get the positions of the gene names by a hash index, which is built at the first lookup and rebuilt after the
+        gene names are set.
+
+        :param names: a list of gene names.
+        :return: a numpy array of positions.
+        """
+        if self._name_index is None:
+            self._name_index = NameIndex(self.gene_name)
+        return self._name_index.get_positions(np.asarray(names).astype('U'), kind='gene')
 
     def sub_set(self, index):
         """
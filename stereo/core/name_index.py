@@ -0,0 +1,45 @@
+"""The hash index from names to positions, used by Cell and Gene."""
+import numpy as np
+import pandas as pd
+
+
+class NameIndex(object):
+    """
+    the hash index from the names to their positions, only the first position is kept for the duplicated names.
+
+    :param names: a numpy array of names.
+    """
+    def __init__(self, names: np.ndarray):
+        index = pd.Index(names)
+        if index.is_unique:
+            self._index, self._positions = index, None
+        else:
+            keep = ~index.duplicated()
+            self._index, self._positions = index[keep], np.flatnonzero(keep)
+
+    def get_indexer(self, names) -> np.ndarray:
+        """
+        look up the positions of the names.
+
+        :param names: a list of names.
+        :return: a numpy array of positions, -1 for the missing names.
+        """
+        indexer = self._index.get_indexer(names)
+        if self._positions is not None:
+            indexer = np.where(indexer >= 0, self._positions[indexer], -1)
+        return indexer
+
+    def get_positions(self, names, kind: str = 'name') -> np.ndarray:
+        """
+        look up the positions of the names, and raise KeyError if any name is missing.
+
+        :param names: a list of names.
+        :param kind: the kind of names in the error message.
+        :return: a numpy array of positions.
+        """
+        names = np.asarray(names)
+        indexer = self.get_indexer(names)
+        missing = indexer < 0
+        if missing.any():
+            raise KeyError(f'{missing.sum()} {kind}s are not found, such as {list(names[missing][:5])}.')
+        return indexer
@@ -12,13 +12,16 @@ change log:
 """
 from ..preprocess.qc import cal_qc
 from ..preprocess.filter import filter_cells, filter_genes, filter_coordinates
-from ..algorithm.normalization import normalize_total, quantile_norm, zscore_disksmooth
+from ..algorithm.normalization import normalize_total, normalize_log1p, log1p, quantile_norm, zscore_disksmooth
 import numpy as np
 from scipy.sparse import issparse
-from ..algorithm.dim_reduce import pca, u_map
+from ..algorithm.dim_reduce import pca, incremental_pca, u_map
+from .backed_matrix import BackedCSRMatrix
+from ..algorithm.embedding import EmbeddingModel
 from typing import Optional, Union
 import copy
-from ..algorithm.neighbors import find_neighbors
+from ..algorithm.neighbors import find_neighbors, NeighborIndex
+from ..log_manager import logger
 import phenograph as phe
 import pandas as pd
 from ..algorithm.leiden import leiden as le
@@ -118,44 +121,48 @@ class StPipeline(object):
         """
         return filter_coordinates(self.data, min_x, max_x, min_y, max_y, inplace)
 
-    def log1p(self, inplace=True, res_key='log1p'):
+    def log1p(self, inplace=True, res_key='log1p', dtype=np.float32):
         """
         log1p for express matrix.
 
         :param inplace: whether inplace the original data or get a new express matrix after log1p.
         :param res_key: the key for getting the result from the self.result.
+        :param dtype: the working dtype for the integer express matrix, the floating matrix keeps its own dtype.
         :return:
         """
         if inplace:
-            self.data.exp_matrix = np.log1p(self.data.exp_matrix)
+            self.data.exp_matrix = log1p(self.data.exp_matrix, inplace=True, dtype=dtype)
         else:
-            self.result[res_key] = np.log1p(self.data.exp_matrix)
+            self.result[res_key] = log1p(self.data.exp_matrix, inplace=False, dtype=dtype)
 
-    def normalize_total(self, target_sum=10000, inplace=True, res_key='normalize_total'):
+    def normalize_total(self, target_sum=10000, inplace=True, res_key='normalize_total', dtype=np.float32,
+                        log=False):
         """
         total count normalize the data to `target_sum` reads per cell, so that counts become comparable among cells.
 
         :param target_sum: the number of reads per cell after normalization.
         :param inplace: whether inplace the original data or get a new express matrix after normalize_total.
         :param res_key: the key for getting the result from the self.result.
+        :param dtype: the working dtype for the integer express matrix, the floating matrix keeps its own dtype.
+        :param log: log1p the normalized data in the same pass, the same as calling `log1p` after `normalize_total`.
         :return:
         """
+        func = normalize_log1p if log else normalize_total
         if inplace:
-            self.data.exp_matrix = normalize_total(self.data.exp_matrix, target_sum=target_sum)
+            self.data.exp_matrix = func(self.data.exp_matrix, target_sum=target_sum, inplace=True, dtype=dtype)
         else:
-            self.result[res_key] = normalize_total(self.data.exp_matrix, target_sum=target_sum)
+            self.result[res_key] = func(self.data.exp_matrix, target_sum=target_sum, inplace=False, dtype=dtype)
 
     def quantile(self, inplace=True, res_key='quantile'):
         """
         Normalize the columns of X to each have the same distribution. Given an expression matrix  of M genes by N
-        samples, quantile normalization ensures all samples have the same spread of data (by construction).
+        samples, quantile normalization ensures all samples have the same spread of data (by construction). The sparse
+        matrix stays sparse if its zeros are normalized to zero.
 
         :param inplace: whether inplace the original data or get a new express matrix after quantile.
         :param res_key: the key for getting the result from the self.result.
         :return:
         """
-        if issparse(self.data.exp_matrix):
-            self.data.exp_matrix = self.data.exp_matrix.toarray()
         if inplace:
             self.data.exp_matrix = quantile_norm(self.data.exp_matrix)
         else:
@@ -170,8 +177,6 @@ class StPipeline(object):
         :param res_key: the key for getting the result from the self.result.
         :return:
         """
-        if issparse(self.data.exp_matrix):
-            self.data.exp_matrix = self.data.exp_matrix.toarray()
         if inplace:
             self.data.exp_matrix = zscore_disksmooth(self.data.exp_matrix, self.data.position, r)
         else:
@@ -185,7 +190,10 @@ class StPipeline(object):
                     res_clip_range="seurat",
                     var_features_n=3000,
                     inplace=True,
-                    res_key='sctransform'):
+                    res_key='sctransform',
+                    residual_path=None,
+                    residual_batch_size=None,
+                    model=None):
         """
         scTransform reference Seruat.
 
@@ -200,16 +208,27 @@ class StPipeline(object):
         :param var_features_n: Number of variable features to select (for calculating a subset of pearson residuals).
         :param inplace: whether inplace the original data or get a new express matrix after sctransform.
         :param res_key: the key for getting the result from the self.result.
+        :param residual_path: the path of a .npy file to write the residuals incrementally, the express matrix is
+                    then a read-only memmap of the file; default keeps the residuals in memory.
+        :param residual_batch_size: the number of genes per block when computing the residuals, default is about
+                    2^22 values per block.
+        :param model: the SCTModel fitted on another chip of the same tissue, such as
+                    `self.result['sctransform_model']`, only the residuals of the data are computed with it. The
+                    fitted model is saved in `self.result[f'{res_key}_model']`, and can be saved by `model.save`.
         :return:
         """
         from ..preprocess.sc_transform import sc_transform
         if inplace:
-            sc_transform(self.data, method, n_cells, n_genes, filter_hvgs, res_clip_range, var_features_n)
+            _, vst_out = sc_transform(self.data, method, n_cells, n_genes, filter_hvgs, res_clip_range,
+                                      var_features_n, residual_path=residual_path,
+                                      residual_batch_size=residual_batch_size, model=model)
         else:
-            import copy
-            data = copy.deepcopy(self.data)
+            data = self.data.view()
             self.result[res_key] = sc_transform(data, method, n_cells, n_genes, filter_hvgs,
-                                                res_clip_range, var_features_n)
+                                                res_clip_range, var_features_n, residual_path=residual_path,
+                                                residual_batch_size=residual_batch_size, model=model)
+            vst_out = self.result[res_key][1]
+        self.result[f'{res_key}_model'] = vst_out['model']
 
     def highly_variable_genes(self,
                          groups=None,
@@ -266,7 +285,7 @@ class StPipeline(object):
                         data info of highly variable genes.
         :return: a StereoExpData object.
         """
-        data = self.data if inplace else copy.deepcopy(self.data)
+        data = self.data if inplace else self.data.view()
         if hvg_res_key not in self.result:
             raise Exception(f'{hvg_res_key} is not in the result, please check and run the normalization func.')
         df = self.result[hvg_res_key]
@@ -274,22 +293,41 @@ class StPipeline(object):
         data.sub_by_index(gene_index=genes_index)
         return data
 
-    def pca(self, use_highly_genes, n_pcs, hvg_res_key='highly_variable_genes', res_key='pca'):
+    def pca(self, use_highly_genes, n_pcs, hvg_res_key='highly_variable_genes', res_key='pca', svd_solver='auto',
+            dtype=np.float32, chunk_size=None, max_gram_memory=4.0):
         """
         Principal component analysis.
 
         :param use_highly_genes: Whether to use only the expression of hypervariable genes as input.
         :param n_pcs: the number of features for a return array after reducing.
         :param hvg_res_key: the key of highly varialbe genes to getting the result.
-        :param res_key: the key for getting the result from the self.result.
+        :param res_key: the key for getting the result from the self.result. The variance, variance ratio and
+                        loadings are set to the keys of `{res_key}_variance`, `{res_key}_variance_ratio` and
+                        `{res_key}_pcs`, the EmbeddingModel to project new data is set to `{res_key}_model`.
+        :param svd_solver: the solver of the sparse matrix, which is not densified, 'randomized' or 'arpack',
+                           'auto' is 'arpack'.
+        :param dtype: the float type of computing the sparse matrix.
+        :param chunk_size: run the incremental pca over the chunks of chunk_size rows if set, which only densifies a
+                           chunk at a time. The matrix of backed data is streamed from the file, by the chunk size of
+                           the matrix if chunk_size is not set.
+        :param max_gram_memory: the max memory in GB of the incremental pca, which keeps a float64 gram matrix of the
+                                genes, n_genes * n_genes * 8 bytes, so it raises a ValueError for too many genes.
         :return:
         """
         if use_highly_genes and hvg_res_key not in self.result:
             raise Exception(f'{hvg_res_key} is not in the result, please check and run the highly_var_genes func.')
         data = self.subset_by_hvg(hvg_res_key, inplace=False) if use_highly_genes else self.data
-        x = data.exp_matrix.toarray() if issparse(data.exp_matrix) else data.exp_matrix
-        res = pca(x, n_pcs)
+        if chunk_size is not None or isinstance(data.exp_matrix, BackedCSRMatrix):
+            chunk_size = data.exp_matrix.chunk_size if chunk_size is None else chunk_size
+            res = incremental_pca(data.exp_matrix, n_pcs, chunk_size=chunk_size, dtype=dtype,
+                                  max_gram_memory=max_gram_memory)
+        else:
+            res = pca(data.exp_matrix, n_pcs, svd_solver=svd_solver, dtype=dtype)
         self.result[res_key] = pd.DataFrame(res['x_pca'])
+        self.result[f'{res_key}_variance'] = res['variance']
+        self.result[f'{res_key}_variance_ratio'] = res['variance_ratio']
+        self.result[f'{res_key}_pcs'] = pd.DataFrame(res['pcs'], index=data.gene_names)
+        self.result[f'{res_key}_model'] = EmbeddingModel(data.gene_names, res['mean'], res['pcs'], res['x_pca'])
 
     # def umap(self, pca_res_key, n_pcs=None, n_neighbors=5, min_dist=0.3, res_key='dim_reduce'):
     #     if pca_res_key not in self.result:
@@ -316,7 +354,8 @@ class StPipeline(object):
         :param pca_res_key: the key of pca to getting the result. Usually, in spatial omics analysis, the results
                             after using pca are used for umap.
         :param neighbors_res_key: the key of neighbors to getting the connectivities of neighbors result for umap.
-        :param res_key: the key for getting the result from the self.result.
+        :param res_key: the key for getting the result from the self.result. The EmbeddingModel to project new data
+                        is set to `{res_key}_model` if the pca model is in the result.
         :param min_dist: The effective minimum distance between embedded points. Smaller values
                          will result in a more clustered/clumped embedding where nearby points on
                          the manifold are drawn closer together, while larger values will result
@@ -345,14 +384,39 @@ class StPipeline(object):
             raise Exception(f'{pca_res_key} is not in the result, please check and run the pca func.')
         if neighbors_res_key not in self.result:
             raise Exception(f'{neighbors_res_key} is not in the result, please check and run the neighbors func.')
-        _, connectivities, _ = self.get_neighbors_res(neighbors_res_key)
+        neighbor, connectivities, _ = self.get_neighbors_res(neighbors_res_key)
         x_umap = umap(x=self.result[pca_res_key], neighbors_connectivities=connectivities,
                       min_dist=min_dist, spread=spread, n_components=n_components, maxiter=maxiter, alpha=alpha,
                       gamma=gamma, negative_sample_rate=negative_sample_rate, init_pos=init_pos)
         self.result[res_key] = pd.DataFrame(x_umap)
+        if f'{pca_res_key}_model' in self.result:
+            self.result[f'{res_key}_model'] = self.result[f'{pca_res_key}_model'].with_umap(
+                x_umap, neighbor.n_neighbors, neighbor.n_pcs, neighbor.metric)
+
+    def project(self, model, labels=None, chunk_size=10000, pca_res_key='pca', umap_res_key='umap',
+                cluster_res_key='cluster'):
+        """
+        embed the data into the pca and umap of a reference by its fitted model, without rerunning the pca, neighbors
+        and umap of the reference. The data must be preprocessed as the reference.
+
+        :param model: the EmbeddingModel of the reference, the result of `{res_key}_model` of the pca or umap.
+        :param labels: the labels of the reference cells to transfer by the vote of the nearest reference cells, such
+                       as the group of the cluster result of the reference.
+        :param chunk_size: the number of cells projected at a time.
+        :param pca_res_key: the key of the projected pca result.
+        :param umap_res_key: the key of the umap result, set if the model has the umap.
+        :param cluster_res_key: the key of the transferred labels, set if the labels is set.
+        :return:
+        """
+        res = model.transform(self.data, labels=labels, chunk_size=chunk_size)
+        self.result[pca_res_key] = res['pca']
+        if 'umap' in res:
+            self.result[umap_res_key] = res['umap']
+        if 'cluster' in res:
+            self.result[cluster_res_key] = res['cluster']
 
     def neighbors(self, pca_res_key, method='umap', metric='euclidean', n_pcs=None, n_neighbors=10, knn=True,
-                  res_key='neighbors'):
+                  res_key='neighbors', algorithm='auto', n_jobs=-1, index_res_key='neighbors_index'):
         """
         run the neighbors.
 
@@ -388,12 +452,29 @@ class StPipeline(object):
                     Kernel to assign low weights to neighbors more distant than the
                     `n_neighbors` nearest neighbor.
         :param res_key: the key for getting the result from the self.result.
+        :param algorithm: 'auto', the dense distances of the small data and the umap search of the big data, or the
+                          search of a NeighborIndex, 'exact', 'nndescent' or 'hnsw', which is only built once for the
+                          same pcs and metric, and reused by the neighbors of different `n_neighbors`. The index only
+                          works with knn=True, otherwise the dense distances are used.
+        :param n_jobs: the number of threads of building and querying the index, -1 is all cores.
+        :param index_res_key: the key of the NeighborIndex in the self.result.
         :return:
         """
         if pca_res_key not in self.result:
             raise Exception(f'{pca_res_key} is not in the result, please check and run the pca func.')
-        neighbor, dists, connectivities = find_neighbors(x=self.result[pca_res_key].values, method=method, n_pcs=n_pcs,
-                                                         n_neighbors=n_neighbors, metric=metric, knn=knn)
+        x = self.result[pca_res_key].values
+        index = None
+        if algorithm != 'auto' and not knn:
+            logger.warning(f'the neighbor index only works with knn=True, the algorithm {algorithm} is ignored.')
+        elif algorithm != 'auto':
+            index = self.result.get(index_res_key)
+            if isinstance(index, NeighborIndex) and index.match(x[:, :n_pcs], algorithm, metric):
+                logger.info(f'reuse the neighbor index of {index_res_key}.')
+            else:
+                index = NeighborIndex(x[:, :n_pcs], algorithm=algorithm, metric=metric, n_jobs=n_jobs)
+                self.result[index_res_key] = index
+        neighbor, dists, connectivities = find_neighbors(x=x, method=method, n_pcs=n_pcs, n_neighbors=n_neighbors,
+                                                         metric=metric, knn=knn, index=index)
         res = {'neighbor': neighbor, 'connectivities': connectivities, 'nn_dist': dists}
         self.result[res_key] = res
 
@@ -630,7 +711,7 @@ class StPipeline(object):
         #data = self.subset_by_hvg(hvg_res_key, inplace=False) if use_highly_genes else self.data
         if use_raw and not self.raw:
             raise Exception(f'self.raw must be set if use_raw is True.')
-        data = copy.deepcopy(self.raw) if use_raw else copy.deepcopy(self.data)
+        data = self.raw.view() if use_raw else self.data.view()
         if use_highly_genes:
             df = self.result[hvg_res_key]
             genes_index = df['highly_variable'].values
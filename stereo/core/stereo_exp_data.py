@@ -14,9 +14,10 @@ from .data import Data
 import pandas as pd
 import numpy as np
 from typing import Optional, Union
-from scipy.sparse import spmatrix, issparse
-from .cell import Cell
+from scipy.sparse import spmatrix, issparse, csr_matrix, csc_matrix
+from .cell import Cell, encode_coor_id, decode_coor_id
 from .gene import Gene
+from .backed_matrix import BackedCSRMatrix
 from ..log_manager import logger
 import copy
 from .st_pipeline import StPipeline
@@ -59,6 +60,8 @@ class StereoExpData(Data):
         self._position = position
         self._bin_type = bin_type
         self.bin_size = bin_size
+        # the (x, y) where the grid of bins starts, which is the min coordinates of the file, None if it is unknown
+        self.bin_origin = None
         self.tl = StPipeline(self)
         self.plt = self.get_plot()
         self.raw = None
@@ -80,11 +83,25 @@ class StereoExpData(Data):
             self.exp_matrix = self.exp_matrix[cell_index, :]
             self.position = self.position[cell_index, :] if self.position is not None else None
             self.cells = self.cells.sub_set(cell_index)
+            # the per gene qc index is changed by removing cells, it is recomputed when needed
+            self.genes.n_cells, self.genes.n_counts = None, None
         if gene_index is not None:
             self.exp_matrix = self.exp_matrix[:, gene_index]
             self.genes = self.genes.sub_set(gene_index)
         return self
 
+    def view(self, cell_index=None, gene_index=None):
+        """
+        get a copy-on-write view of the data by cell index or gene index list. The view records the indexes over the
+        shared express matrix, and the subset of the matrix is only sliced when it is accessed. The view is detached
+        from this data once its exp_matrix is set.
+
+        :param cell_index: a list of cell index.
+        :param gene_index: a list of gene index.
+        :return: a StereoExpDataView object.
+        """
+        return StereoExpDataView(self, cell_index, gene_index)
+
     def sub_by_name(self, cell_name: Optional[Union[np.ndarray, list]] = None,
                     gene_name: Optional[Union[np.ndarray, list]] = None):
         """
@@ -94,12 +111,9 @@ class StereoExpData(Data):
         :param gene_name: a list of gene name.
         :return:
         """
-        data = copy.deepcopy(self)
-        cell_index = [np.argwhere(data.cells.cell_name == i)[0][0] for i in cell_name] \
-            if cell_name is not None else None
-        gene_index = [np.argwhere(data.genes.gene_name == i)[0][0] for i in
-                      gene_name] if gene_name is not None else None
-        return data.sub_by_index(cell_index, gene_index)
+        cell_index = self.cells.get_indexer(cell_name) if cell_name is not None else None
+        gene_index = self.genes.get_indexer(gene_name) if gene_name is not None else None
+        return self.view(cell_index, gene_index)
 
     def check(self):
         """
@@ -192,7 +206,7 @@ class StereoExpData(Data):
         """
         set the value of self._exp_matrix.
 
-        :param pos_array: np.ndarray or sparse.spmatrix.
+        :param pos_array: np.ndarray, sparse.spmatrix or BackedCSRMatrix.
         :return:
         """
         self._exp_matrix = pos_array
@@ -236,9 +250,18 @@ class StereoExpData(Data):
         """
         self._position = pos
 
+    @property
+    def is_backed(self):
+        """
+        whether the exp_matrix is a lazy view over the h5ad file.
+
+        :return:
+        """
+        return isinstance(self.exp_matrix, BackedCSRMatrix)
+
     def to_df(self):
         df = pd.DataFrame(
-            self.exp_matrix.toarray() if issparse(self.exp_matrix) else self.exp_matrix,
+            self.exp_matrix.toarray() if issparse(self.exp_matrix) or self.is_backed else self.exp_matrix,
             columns=self.gene_names,
             index=self.cell_names
         )
@@ -250,6 +273,243 @@ class StereoExpData(Data):
 
         :return:
         """
-        if issparse(self.exp_matrix):
+        if issparse(self.exp_matrix) or isinstance(self.exp_matrix, BackedCSRMatrix):
             self.exp_matrix = self.exp_matrix.toarray()
         return self.exp_matrix
+
+    def rebin(self, bin_size: int):
+        """
+        merge the bins into the bigger bins of bin_size by sparse aggregation, without re-reading the file. The grid
+        of the bigger bins starts at `bin_origin`, which is set by reading the gem file and kept in the h5ad file, so
+        the result is the same as reading the file with this bin size, even after the data is filtered. If the
+        bin_origin is unknown, the grid starts at the left edge of the smallest bin of the current data.
+
+        :param bin_size: the size of bin to merge, which must be a multiple of the current bin size.
+        :return: a new StereoExpData of the merged bins.
+        """
+        if self.bin_type == 'cell_bins':
+            raise ValueError('only the bins data can be rebinned.')
+        if bin_size % self.bin_size != 0:
+            raise ValueError(f'bin_size {bin_size} is not a multiple of the current bin size {self.bin_size}.')
+        # the position is the center of bin, the left edge of bin is at the int(bin_size / 2) before it
+        left = np.asarray(self.position, dtype=np.float64) - int(self.bin_size / 2)
+        origin = left.min(axis=0) if self.bin_origin is None else np.asarray(self.bin_origin, dtype=np.float64)
+        bin_coor = np.floor((left - origin) / bin_size)
+        rows, uniq_keys = pd.factorize(encode_coor_id(bin_coor[:, 0], bin_coor[:, 1]))
+        indicator = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, np.arange(len(rows)))),
+                               shape=(len(uniq_keys), len(rows)))
+        exp_matrix = self.exp_matrix.tocsr() if self.is_backed else self.exp_matrix
+        dtype = exp_matrix.dtype
+        exp_matrix = indicator.astype(dtype) @ exp_matrix
+        bin_x, bin_y = decode_coor_id(uniq_keys)
+        position = np.vstack([bin_x * bin_size + origin[0] + int(bin_size / 2),
+                              bin_y * bin_size + origin[1] + int(bin_size / 2)]).T
+        if self.cell_names is not None and self.cell_names.dtype.kind in {'U', 'S', 'O'}:
+            cell_names = np.char.add(np.char.add(bin_x.astype(str), '_'), bin_y.astype(str))
+        else:
+            cell_names = uniq_keys
+        data = StereoExpData(file_path=self.file, file_format=self.file_format, bin_type=self.bin_type,
+                             bin_size=bin_size, exp_matrix=exp_matrix, genes=Gene(gene_name=self.gene_names),
+                             cells=Cell(cell_name=cell_names), position=position.astype(self.position.dtype),
+                             output=self.output, partitions=self.partitions)
+        data.bin_origin = origin.astype(np.int64)
+        return data
+
+
+def _read_only(matrix):
+    """
+    get a read-only matrix sharing the buffers of the matrix, so that the inplace writing raises an error instead of
+    changing the shared matrix.
+    """
+    def read_only(arr):
+        arr = arr.view()
+        arr.flags.writeable = False
+        return arr
+
+    if isinstance(matrix, np.ndarray):
+        return read_only(matrix)
+    if isinstance(matrix, (csr_matrix, csc_matrix)):
+        return matrix.__class__((read_only(matrix.data), read_only(matrix.indices), read_only(matrix.indptr)),
+                                shape=matrix.shape)
+    if issparse(matrix):
+        return matrix.copy()
+    return matrix
+
+
+class _CopyOnReadResult(dict):
+    """
+    the results of a view. The mutable results shared with the parent, such as the DataFrame, array, sparse matrix and
+    dict, are deep copied at the first access, so that changing them in place does not change the parent. The other
+    results, such as the fitted models, are shared.
+    """
+    _MUTABLE_TYPES = (np.ndarray, pd.DataFrame, pd.Series, spmatrix, dict, list, tuple)
+
+    def __init__(self, parent_result=None):
+        parent_result = {} if parent_result is None else parent_result
+        super(_CopyOnReadResult, self).__init__(parent_result)
+        self._shared = {k for k, v in parent_result.items() if isinstance(v, self._MUTABLE_TYPES)}
+
+    def __getitem__(self, key):
+        value = super(_CopyOnReadResult, self).__getitem__(key)
+        if key in self._shared:
+            value = copy.deepcopy(value)
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._shared.discard(key)
+        super(_CopyOnReadResult, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._shared.discard(key)
+        super(_CopyOnReadResult, self).__delitem__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        if key not in self:
+            return super(_CopyOnReadResult, self).pop(key, *args)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        key = next(reversed(self))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self._shared.clear()
+        super(_CopyOnReadResult, self).clear()
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def copy(self):
+        return dict(self.items())
+
+
+class StereoExpDataView(StereoExpData):
+    def __init__(self, parent: StereoExpData, cell_index=None, gene_index=None):
+        """
+        a copy-on-write view of StereoExpData. It shares the express matrix of the parent, and records the cell and
+        gene indexes over it instead of copying the whole data. The cells, genes and position are subset like
+        `sub_by_index`, and the results of parent are copied at the first access, so that changing them in place does
+        not change the parent.
+
+        When the exp_matrix is accessed, a view without indexes returns the parent matrix in read-only mode, and a view
+        with indexes slices the subset once. Setting the exp_matrix detaches the view from the parent.
+
+        :param parent: the StereoExpData to view.
+        :param cell_index: a list of cell index.
+        :param gene_index: a list of gene index.
+        """
+        super(StereoExpDataView, self).__init__(bin_type=parent.bin_type, bin_size=parent.bin_size,
+                                                genes=copy.copy(parent.genes), cells=copy.copy(parent.cells),
+                                                position=parent.position, output=parent.output,
+                                                partitions=parent.partitions)
+        self._file = parent.file
+        self._file_format = parent.file_format
+        self.bin_origin = parent.bin_origin
+        if isinstance(parent, StereoExpDataView) and parent.is_view:
+            self._parent_matrix = parent._parent_matrix
+            self._cell_index, self._gene_index = parent._cell_index, parent._gene_index
+        else:
+            self._parent_matrix = parent.exp_matrix
+            self._cell_index, self._gene_index = None, None
+        self.tl.result = _CopyOnReadResult(parent.tl.result)
+        self.tl._raw = parent.tl.raw
+        self.sub_by_index(cell_index, gene_index)
+
+    @property
+    def is_view(self):
+        """
+        whether the data is still a view of the parent matrix.
+
+        :return:
+        """
+        return self._parent_matrix is not None
+
+    @property
+    def shape(self):
+        """
+        get the shape of the express matrix without slicing it.
+
+        :return:
+        """
+        if not self.is_view:
+            return self._exp_matrix.shape
+        n_cells, n_genes = self._parent_matrix.shape
+        return (n_cells if self._cell_index is None else len(self._cell_index),
+                n_genes if self._gene_index is None else len(self._gene_index))
+
+    @staticmethod
+    def _compose_index(current, index, length):
+        index = np.arange(length)[index]
+        return index if current is None else current[index]
+
+    def sub_by_index(self, cell_index=None, gene_index=None):
+        """
+        get sub data by cell index or gene index list, only the indexes are recorded while it is a view.
+
+        :param cell_index: a list of cell index.
+        :param gene_index: a list of gene index.
+        :return:
+        """
+        if not self.is_view:
+            return super(StereoExpDataView, self).sub_by_index(cell_index, gene_index)
+        n_cells, n_genes = self.shape
+        if cell_index is not None:
+            self._cell_index = self._compose_index(self._cell_index, cell_index, n_cells)
+            self.position = self.position[cell_index, :] if self.position is not None else None
+            self.cells = self.cells.sub_set(cell_index)
+            # the per gene qc index is changed by removing cells, it is recomputed when needed
+            self.genes.n_cells, self.genes.n_counts = None, None
+        if gene_index is not None:
+            self._gene_index = self._compose_index(self._gene_index, gene_index, n_genes)
+            self.genes = self.genes.sub_set(gene_index)
+        return self
+
+    @property
+    def exp_matrix(self):
+        """
+        get the express matrix, the subset of parent matrix is sliced at the first access.
+
+        :return:
+        """
+        if not self.is_view:
+            return self._exp_matrix
+        if self._cell_index is None and self._gene_index is None:
+            return _read_only(self._parent_matrix)
+        matrix = self._parent_matrix
+        # the integer indexes always copy the values, so the parent matrix is never changed by the view
+        if self._cell_index is not None:
+            matrix = matrix[self._cell_index, :]
+        if self._gene_index is not None:
+            matrix = matrix[:, self._gene_index]
+        self.exp_matrix = matrix
+        return matrix
+
+    @exp_matrix.setter
+    def exp_matrix(self, pos_array):
+        """
+        set the express matrix, and detach the view from the parent matrix.
+
+        :param pos_array: np.ndarray, sparse.spmatrix or BackedCSRMatrix.
+        :return:
+        """
+        self._exp_matrix = pos_array
+        self._parent_matrix = None
+        self._cell_index, self._gene_index = None, None
@@ -6,5 +6,7 @@
 @file:__init__.py.py
 @time:2021/03/05
 """
-from .reader import read_gef, read_gem, read_ann_h5ad, read_stereo_h5ad, anndata_to_stereo, stereo_to_anndata
+from .reader import read_gef, read_gem, read_ann_h5ad, read_stereo_h5ad, anndata_to_stereo, stereo_to_anndata, read_many
 from .writer import write, write_h5ad
+from .h5ad import WriteProfile
+from .multi_bin import MultiBinReader
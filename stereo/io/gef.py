@@ -1,6 +1,5 @@
 # coding: utf-8
-import gc
-
+import os
 import h5py
 import pandas as pd
 from scipy.sparse import csr_matrix
@@ -44,77 +43,218 @@ class GEF(object):
         if gene_lst is None and region is None:
             self.genes = self.df_gene['gene'].values
             self.gene_num = len(self.genes)
-            cols = np.zeros((self.df_exp.shape[0],), dtype='uint32')
-            gene_index = 0
-            exp_index = 0
-            for count in self.df_gene['count']:
-                for i in range(count):
-                    cols[exp_index] = gene_index
-                    exp_index += 1
-                gene_index += 1
-            self.df_exp['gene_index'] = cols
-
-        self.df_exp['cell_id'] = np.bitwise_or(
-            np.left_shift(self.df_exp['x'].astype('uint64'), 32), self.df_exp['y'])
-        self.cells = self.df_exp['cell_id'].unique()
+            self.df_exp['gene_index'] = self._get_gene_index(self.df_gene['count'].values)
+
+        cell_id = np.bitwise_or(
+            np.left_shift(self.df_exp['x'].values.astype('uint64'), np.uint64(32)),
+            self.df_exp['y'].values.astype('uint64'))
+        rows, self.cells = pd.factorize(cell_id)
         self.cell_num = len(self.cells)
-        rows = np.zeros((self.df_exp.shape[0],), dtype='uint32')
-        grp = self.df_exp.groupby('cell_id').groups
-        i = 0
-        for cell_id in self.cells:
-            for j in grp[cell_id]:
-                rows[j] = i
-            i += 1
-        self.df_exp['cell_index'] = rows
-        del grp
-        gc.collect()
+        self.df_exp['cell_index'] = rows.astype('uint32')
+
+    @staticmethod
+    def _get_gene_index(gene_count: np.ndarray) -> np.ndarray:
+        """
+        get the gene index of each expression record, the records of one gene are stored contiguously.
+
+        :param gene_count: the number of expression records of each gene.
+        :return: a numpy array of gene index.
+        """
+        return np.repeat(np.arange(len(gene_count), dtype='uint32'), gene_count)
 
     def _restrict_to_region(self, region):
         logger.info(f'restrict to region [{region[0]} <= x <= {region[1]}] and [{region[2]} <= y <= {region[3]}]')
-        gene_col = []
-        for row in self.df_gene.itertuples():
-            for i in range(getattr(row, 'count')):
-                gene_col.append(getattr(row, 'gene'))
+        gene_index = self._get_gene_index(self.df_gene['count'].values)
+        x = self.df_exp['x'].values
+        y = self.df_exp['y'].values
+        mask = (x >= region[0]) & (x <= region[1]) & (y >= region[2]) & (y <= region[3])
+        self.df_exp = self.df_exp[mask].reset_index(drop=True)
 
-        self.df_exp['gene'] = gene_col
-        self.df_exp = self.df_exp.query(f'{region[0]} <= x <= {region[1]} and {region[2]} <= y <= {region[3]}')
-
-        self.genes = self.df_exp['gene'].unique()
+        gene_index, uniq_index = pd.factorize(gene_index[mask])
+        self.genes = self.df_gene['gene'].values[uniq_index]
         self.df_gene = None
         self.gene_num = len(self.genes)
-        genes_dict = dict(zip(self.genes, range(0, self.gene_num)))
-        self.df_exp['gene_index'] = self.df_exp['gene'].map(genes_dict)
-        self.df_exp.drop(columns=['gene'])
-        self.df_exp = self.df_exp.reset_index(drop=True)
+        self.df_exp['gene_index'] = gene_index.astype('uint32')
 
     def _restrict_to_genes(self, gene_lst):
         logger.info('restrict to gene_lst')
-        cols = np.zeros((self.df_exp.shape[0],), dtype='uint32')
-        offset_indexes = np.zeros((self.df_exp.shape[0],), dtype='uint32')
         self.df_gene = self.df_gene.set_index('gene').loc[gene_lst].reset_index()
         self.genes = self.df_gene['gene'].values
         self.gene_num = len(self.genes)
 
-        gene_index = 0
-        exp_index = 0
-        for row in self.df_gene.itertuples():
-            for i in range(getattr(row, 'count')):
-                cols[exp_index] = gene_index
-                offset_indexes[exp_index] = getattr(row, 'offset') + i
-                exp_index += 1
-            gene_index += 1
+        gene_count = self.df_gene['count'].values.astype('int64')
+        gene_offset = self.df_gene['offset'].values.astype('int64')
+        cols = self._get_gene_index(gene_count)
+        # the position inside each gene plus the offset of the gene
+        start = np.cumsum(gene_count) - gene_count
+        offset_indexes = np.arange(len(cols), dtype='int64') + np.repeat(gene_offset - start, gene_count)
 
-        self.df_exp = self.df_exp.loc[offset_indexes[:exp_index]]
-        self.df_exp['gene_index'] = cols[:exp_index]
-        self.df_exp = self.df_exp.reset_index(drop=True)
+        self.df_exp = self.df_exp.iloc[offset_indexes].reset_index(drop=True)
+        self.df_exp['gene_index'] = cols
 
     def to_stereo_exp_data(self) -> StereoExpData:
         data = StereoExpData(file_path=self.file_path)
         logger.info(f'the martrix has {self.cell_num} cells, and {self.gene_num} genes.')
-        data.position = self.df_exp.loc[:, ['x', 'y']].drop_duplicates().values
+        cells = np.asarray(self.cells, dtype='uint64')
+        data.position = np.vstack([np.right_shift(cells, np.uint64(32)),
+                                   np.bitwise_and(cells, np.uint64(0xffffffff))]).T.astype(self.df_exp['x'].dtype)
         exp_matrix = csr_matrix((self.df_exp['count'], (self.df_exp['cell_index'], self.df_exp['gene_index'])),
                                 shape=(self.cell_num, self.gene_num), dtype=np.int32)
         data.cells = Cell(cell_name=self.cells)
         data.genes = Gene(gene_name=self.genes)
         data.exp_matrix = exp_matrix if self.is_sparse else exp_matrix.toarray()
         return data
+
+
+class GEFTileIndex(object):
+    """
+    a persistent spatial tile index of a GEF file, saved as a sidecar h5 file. The expression records of one bin size
+    are sorted by coarse tiles and stored with the tile offsets, so that a region query only reads the hyperslabs of
+    the tiles which overlap the region.
+
+    :param file_path: the path of GEF file.
+    :param bin_size: the bin size of the expression to index.
+    :param index_path: the path of the sidecar index file, default is `{file_path}.tile_index.h5`.
+    :param tile_size: the side length of a tile, in the coordinate unit of the bin size. Default makes about
+                      64 tiles along the longer side of the chip.
+    :param is_sparse: the matrix is sparse matrix if is_sparse is True else np.ndarray
+    """
+    # the version of the index format, the index of an older version is rebuilt
+    version = 2
+
+    def __init__(self, file_path: str, bin_size: int = 100, index_path: str = None, tile_size: int = None,
+                 is_sparse: bool = True):
+        self.file_path = file_path
+        self.bin_size = bin_size
+        self.index_path = index_path if index_path is not None else f'{file_path}.tile_index.h5'
+        self.tile_size = tile_size
+        self.is_sparse = is_sparse
+        self.bin_tag = 'bin{}'.format(bin_size)
+
+    def _source_stat(self):
+        stat = os.stat(self.file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def is_valid(self) -> bool:
+        """
+        check whether the index file exists and is built from the current GEF file.
+
+        :return: bool
+        """
+        if not os.path.exists(self.index_path):
+            return False
+        with h5py.File(self.index_path, mode='r') as h5f:
+            if self.bin_tag not in h5f.keys():
+                return False
+            attrs = h5f[self.bin_tag].attrs
+            if self.tile_size is not None and attrs['tile_size'] != self.tile_size:
+                return False
+            if attrs.get('version') != self.version:
+                return False
+            return (attrs['source_size'], attrs['source_mtime']) == self._source_stat()
+
+    def build(self):
+        """
+        build the tile index of the bin size, and save it into the index file.
+
+        :return:
+        """
+        logger.info(f'build the tile index of {self.bin_tag} into {self.index_path}')
+        with h5py.File(self.file_path, mode='r') as h5f:
+            if self.bin_tag not in h5f['geneExp'].keys():
+                raise Exception('The bin size {} info is not in the GEF file'.format(self.bin_size))
+            h5exp = h5f['geneExp'][self.bin_tag]['expression']
+            h5gene = h5f['geneExp'][self.bin_tag]['gene']
+            genes = h5gene['gene']
+            exp = np.zeros(h5exp.shape[0], dtype=[('x', 'uint32'), ('y', 'uint32'), ('count', 'uint32'),
+                                                   ('gene_index', 'uint32'), ('record', 'uint64')])
+            exp['x'] = h5exp['x']
+            exp['y'] = h5exp['y']
+            exp['count'] = h5exp['count']
+            exp['gene_index'] = GEF._get_gene_index(h5gene['count'])
+            # the position of the record in the GEF file, to restore the order of the full scan
+            exp['record'] = np.arange(h5exp.shape[0], dtype='uint64')
+        x_min, y_min = int(exp['x'].min()), int(exp['y'].min())
+        x_max, y_max = int(exp['x'].max()), int(exp['y'].max())
+        tile_size = self.tile_size if self.tile_size is not None \
+            else max(1, int(np.ceil((max(x_max - x_min, y_max - y_min) + 1) / 64)))
+        n_tile_x = (x_max - x_min) // tile_size + 1
+        n_tile_y = (y_max - y_min) // tile_size + 1
+        tile_id = ((exp['x'] - x_min) // tile_size).astype('int64') * n_tile_y + (exp['y'] - y_min) // tile_size
+        order = np.argsort(tile_id, kind='stable')
+        tile_ptr = np.zeros(n_tile_x * n_tile_y + 1, dtype='int64')
+        tile_ptr[1:] = np.cumsum(np.bincount(tile_id, minlength=n_tile_x * n_tile_y))
+        mode = 'a' if os.path.exists(self.index_path) else 'w'
+        with h5py.File(self.index_path, mode=mode) as h5f:
+            if self.bin_tag in h5f.keys():
+                del h5f[self.bin_tag]
+            grp = h5f.create_group(self.bin_tag)
+            grp.create_dataset('expression', data=exp[order], chunks=True)
+            grp.create_dataset('tile_ptr', data=tile_ptr)
+            grp.create_dataset('gene', data=genes)
+            source_size, source_mtime = self._source_stat()
+            grp.attrs.update(dict(version=self.version, tile_size=tile_size, x_min=x_min, y_min=y_min, n_tile_x=n_tile_x,
+                                  n_tile_y=n_tile_y, source_size=source_size, source_mtime=source_mtime))
+        self.tile_size = tile_size
+
+    def _read_region(self, grp, region):
+        attrs = grp.attrs
+        tile_size, n_tile_x, n_tile_y = int(attrs['tile_size']), int(attrs['n_tile_x']), int(attrs['n_tile_y'])
+        tile_x = np.clip((np.array(region[:2]) - int(attrs['x_min'])) // tile_size, 0, n_tile_x - 1)
+        tile_y = np.clip((np.array(region[2:]) - int(attrs['y_min'])) // tile_size, 0, n_tile_y - 1)
+        tile_ptr = grp['tile_ptr']
+        h5exp = grp['expression']
+        chunks = []
+        # the tiles of one column are contiguous, read them as one hyperslab
+        for tx in range(tile_x[0], tile_x[1] + 1):
+            start, end = tile_ptr[tx * n_tile_y + tile_y[0]], tile_ptr[tx * n_tile_y + tile_y[1] + 1]
+            if end > start:
+                chunks.append(h5exp[start:end])
+        exp = np.concatenate(chunks) if chunks else np.zeros(0, dtype=h5exp.dtype)
+        mask = (exp['x'] >= region[0]) & (exp['x'] <= region[1]) & (exp['y'] >= region[2]) & (exp['y'] <= region[3])
+        return exp[mask]
+
+    def query(self, region: list, gene_lst: list = None) -> StereoExpData:
+        """
+        read the expression in the region, the index will be built if it is not valid.
+
+        :param region: restrict to this region, [minX, maxX, minY, maxY]
+        :param gene_lst: restrict to this gene list
+        :return: an object of StereoExpData.
+        """
+        if not self.is_valid():
+            self.build()
+        logger.info(f'restrict to region [{region[0]} <= x <= {region[1]}] and [{region[2]} <= y <= {region[3]}]')
+        with h5py.File(self.index_path, mode='r') as h5f:
+            grp = h5f[self.bin_tag]
+            exp = self._read_region(grp, region)
+            all_genes = grp['gene'][...]
+        if gene_lst is not None:
+            lst_index = pd.Index(all_genes).get_indexer(gene_lst)
+            if (lst_index < 0).any():
+                raise KeyError(f'{np.array(gene_lst)[lst_index < 0]} not in the GEF file')
+            gene_order = np.full(len(all_genes), -1, dtype='int64')
+            gene_order[lst_index] = np.arange(len(lst_index))
+            exp = exp[gene_order[exp['gene_index']] >= 0]
+            # keep the genes in the order of gene_lst
+            gene_rank = gene_order[exp['gene_index']]
+        else:
+            gene_rank = exp['gene_index']
+        # the records are read tile by tile, sort them back to the order of the full scan, which keeps the cells in
+        # the order of their first record as GEF does
+        order = np.lexsort((exp['record'], gene_rank))
+        exp, gene_rank = exp[order], gene_rank[order]
+        uniq_rank, cols = np.unique(gene_rank, return_inverse=True)
+        genes = all_genes[lst_index[uniq_rank]] if gene_lst is not None else all_genes[uniq_rank]
+        cell_id = np.bitwise_or(np.left_shift(exp['x'].astype('uint64'), np.uint64(32)), exp['y'].astype('uint64'))
+        rows, cells = pd.factorize(cell_id)
+        cells = np.asarray(cells, dtype='uint64')
+        data = StereoExpData(file_path=self.file_path)
+        logger.info(f'the martrix has {len(cells)} cells, and {len(genes)} genes.')
+        data.position = np.vstack([np.right_shift(cells, np.uint64(32)),
+                                   np.bitwise_and(cells, np.uint64(0xffffffff))]).T.astype('uint32')
+        exp_matrix = csr_matrix((exp['count'], (rows, cols)), shape=(len(cells), len(genes)), dtype=np.int32)
+        data.cells = Cell(cell_name=cells)
+        data.genes = Gene(gene_name=genes)
+        data.exp_matrix = exp_matrix if self.is_sparse else exp_matrix.toarray()
+        return data
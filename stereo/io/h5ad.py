@@ -10,6 +10,7 @@
 change log:
     2021/06/18  create file.
 """
+import zlib
 import h5py
 import numpy as np
 import pandas as pd
@@ -20,8 +21,12 @@ from scipy import sparse
 from packaging import version
 from stereo.utils.spmatrix_helper import idx_chunks_along_axis
 from functools import singledispatch
+from concurrent.futures import ThreadPoolExecutor
 from stereo.core.gene import Gene
 from stereo.core.cell import Cell
+from stereo.core.backed_matrix import BackedCSRMatrix
+from stereo.algorithm.neighbors import Neighbors
+from stereo.log_manager import logger
 
 
 H5PY_V3 = version.parse(h5py.__version__).major >= 3
@@ -33,8 +38,8 @@ def write(v, f, k, *args, **kwargs):
 
 
 @write.register(np.ndarray)
-def _(v, f, k):
-    write_array(f, k, v)
+def _(v, f, k, profile=None):
+    write_array(f, k, v, profile=profile)
 
 
 @write.register(list)
@@ -48,8 +53,13 @@ def _(v, f, k):
 
 
 @write.register(sparse.spmatrix)
-def _(v, f, k, sp_format):
-    write_spmatrix(f, k, v, sp_format)
+def _(v, f, k, sp_format, profile=None):
+    write_spmatrix(f, k, v, sp_format, profile=profile)
+
+
+@write.register(BackedCSRMatrix)
+def _(v, f, k, sp_format='csr', profile=None):
+    write_backed_csr(f, k, v, profile=profile)
 
 
 @write.register(Gene)
@@ -62,7 +72,133 @@ def _(v, f, k):
     write_cells(f, k, v)
 
 
-def write_array(f, key, value, dataset_kwargs=MappingProxyType({})):
+@write.register(dict)
+def _(v, f, k):
+    write_dict(f, k, v)
+
+
+@write.register(Neighbors)
+def _(v, f, k):
+    write_neighbors(f, k, v)
+
+
+_WRITABLE_TYPES = (np.ndarray, np.generic, list, str, int, float, bool, pd.DataFrame, dict, Neighbors)
+_NEIGHBORS_PARAMS = ('n_neighbors', 'n_pcs', 'method', 'metric', 'knn', 'random_state')
+
+
+class WriteProfile(object):
+    """
+    the profile of writing the large numeric arrays, such as the express matrix, into the h5 file.
+
+    :param chunk_size: the max number of elements per chunk along the first axis.
+    :param chunk_bytes: the max bytes of a chunk. The rows of a chunk are reduced to keep it under chunk_bytes, and
+                        the columns of a wide matrix are split if one row is bigger, since a chunk is always read and
+                        decompressed whole, and hdf5 does not allow a chunk over 4GB.
+    :param compression: the compression filter, None, 'gzip' or 'lzf'.
+    :param compression_opts: the level of gzip compression, from 0 to 9.
+    :param shuffle: whether to apply the shuffle filter before compression, which usually improves the ratio.
+    :param float32: whether to downcast the float64 values to float32.
+    :param n_jobs: the number of threads compressing the chunks. It only takes effect with the gzip compression, the
+                   chunks are compressed by the threads and then written by h5py directly.
+    """
+    def __init__(self, chunk_size: int = 1 << 16, compression: str = 'gzip', compression_opts: int = 4,
+                 shuffle: bool = True, float32: bool = False, n_jobs: int = 1, chunk_bytes: int = 1 << 20):
+        if compression not in (None, 'gzip', 'lzf'):
+            raise ValueError(f"compression must be None, 'gzip' or 'lzf', got {compression}.")
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        self.compression = compression
+        self.compression_opts = compression_opts if compression == 'gzip' else None
+        self.shuffle = shuffle and compression is not None
+        self.float32 = float32
+        self.n_jobs = n_jobs
+
+    def prepare(self, value: np.ndarray) -> np.ndarray:
+        if self.float32 and value.dtype == np.float64:
+            value = value.astype(np.float32)
+        return np.ascontiguousarray(value)
+
+    def chunks(self, value: np.ndarray) -> tuple:
+        return self.chunk_shape(value.shape, value.dtype)
+
+    def chunk_shape(self, shape: tuple, dtype) -> tuple:
+        """
+        get the chunk shape of an array, which is at most chunk_size rows and chunk_bytes.
+
+        :param shape: the shape of the array, the first axis can be 0 for a resizable dataset.
+        :param dtype: the dtype of the array.
+        :return: the chunk shape.
+        """
+        itemsize = np.dtype(dtype).itemsize
+        tail = tuple(shape[1:])
+        if tail:
+            inner = int(np.prod(tail[1:])) * itemsize
+            tail = (max(1, min(tail[0], self.chunk_bytes // max(inner, 1))),) + tail[1:]
+        row_bytes = int(np.prod(tail)) * itemsize
+        n_rows = min(self.chunk_size, max(1, self.chunk_bytes // max(row_bytes, 1)))
+        if shape[0] > 0:
+            n_rows = min(n_rows, shape[0])
+        return (max(1, n_rows),) + tail
+
+    def compress(self, chunk: np.ndarray) -> bytes:
+        """
+        compress a chunk like the hdf5 shuffle and deflate filters.
+        """
+        buf = np.ascontiguousarray(chunk).reshape(-1)
+        if self.shuffle and buf.dtype.itemsize > 1:
+            buf = buf.view(np.uint8).reshape(-1, buf.dtype.itemsize).T
+        return zlib.compress(np.ascontiguousarray(buf).tobytes(), self.compression_opts)
+
+
+def write_array_by_profile(f, key, value, profile: WriteProfile, maxshape=None):
+    """
+    write the numeric array with the chunk and compression settings of the profile. The chunks are compressed in
+    parallel if profile.n_jobs > 1 and the compression is gzip.
+
+    :param f: the h5 file or group.
+    :param key: the key of the dataset.
+    :param value: the numeric array.
+    :param profile: the WriteProfile.
+    :param maxshape: the maxshape of the dataset.
+    :return:
+    """
+    value = profile.prepare(value)
+    chunks = profile.chunks(value)
+    dset = f.create_dataset(key, shape=value.shape, dtype=value.dtype, chunks=chunks, maxshape=maxshape,
+                            compression=profile.compression, compression_opts=profile.compression_opts,
+                            shuffle=profile.shuffle)
+    if value.shape[0] == 0:
+        return
+    if profile.compression != 'gzip' or profile.n_jobs <= 1:
+        dset[...] = value
+        return
+
+    def compress(start):
+        selection = tuple(slice(i, i + n) for i, n in zip(start, chunks))
+        chunk = value[selection]
+        if chunk.shape != chunks:
+            # the edge chunk is stored with the full chunk shape
+            padded = np.zeros(chunks, dtype=chunk.dtype)
+            padded[tuple(slice(0, n) for n in chunk.shape)] = chunk
+            chunk = padded
+        return profile.compress(chunk)
+
+    # the chunks along the first two axes, the other axes are never split
+    starts = [(i,) + (j,) * (value.ndim > 1) + (0,) * (value.ndim - 2) for i in range(0, value.shape[0], chunks[0])
+              for j in (range(0, value.shape[1], chunks[1]) if value.ndim > 1 else [0])]
+    batch = profile.n_jobs * 4
+    with ThreadPoolExecutor(max_workers=profile.n_jobs) as executor:
+        # compress a bounded batch of chunks at a time, and write them in order
+        for i in range(0, len(starts), batch):
+            batch_starts = starts[i:i + batch]
+            for start, compressed in zip(batch_starts, executor.map(compress, batch_starts)):
+                dset.id.write_direct_chunk(start, compressed)
+
+
+def write_array(f, key, value, dataset_kwargs=MappingProxyType({}), profile: WriteProfile = None):
+    if profile is not None and value.dtype.kind in {"b", "i", "u", "f"} and value.ndim > 0:
+        write_array_by_profile(f, key, value, profile, maxshape=dataset_kwargs.get('maxshape'))
+        return
     # Convert unicode to fixed length strings
     if value.dtype.kind in {"U", "O"}:
         value = value.astype(h5py.special_dtype(vlen=str))
@@ -79,18 +215,58 @@ def write_scalar(f, key, value, dataset_kwargs=MappingProxyType({})):
     write_array(f, key, np.array(value), dataset_kwargs=dataset_kwargs)
 
 
-def write_spmatrix(f, k, v, fmt: str, dataset_kwargs=MappingProxyType({})):
+def write_spmatrix(f, k, v, fmt: str, dataset_kwargs=MappingProxyType({}), profile: WriteProfile = None):
     g = f.create_group(k)
     g.attrs["encoding-type"] = f"{fmt}_matrix"
     g.attrs["shape"] = v.shape
     # Allow resizing
     if "maxshape" not in dataset_kwargs:
         dataset_kwargs = dict(maxshape=(None,), **dataset_kwargs)
+    if profile is not None:
+        for name in ("data", "indices", "indptr"):
+            write_array_by_profile(g, name, getattr(v, name), profile, maxshape=dataset_kwargs['maxshape'])
+        return
     g.create_dataset("data", data=v.data, **dataset_kwargs)
     g.create_dataset("indices", data=v.indices, **dataset_kwargs)
     g.create_dataset("indptr", data=v.indptr, **dataset_kwargs)
 
 
+def write_backed_csr(f, k, v: BackedCSRMatrix, profile: WriteProfile = None):
+    """
+    write the backed csr matrix as a csr group by streaming its chunks, so that the matrix is never loaded into memory.
+
+    :param f: the h5 file or group.
+    :param k: the key of the csr group.
+    :param v: the BackedCSRMatrix.
+    :param profile: the WriteProfile of the data and indices, default writes them without compression.
+    :return:
+    """
+    g = f.create_group(k)
+    g.attrs["encoding-type"] = "csr_matrix"
+    g.attrs["shape"] = v.shape
+    data_dtype = np.float32 if profile is not None and profile.float32 and v.dtype == np.float64 else v.dtype
+    dataset_kwargs = dict(shape=(0,), maxshape=(None,))
+    if profile is not None:
+        dataset_kwargs.update(chunks=profile.chunk_shape((0,), data_dtype), compression=profile.compression,
+                              compression_opts=profile.compression_opts, shuffle=profile.shuffle)
+    else:
+        dataset_kwargs.update(chunks=True)
+    data = g.create_dataset("data", dtype=data_dtype, **dataset_kwargs)
+    indices = g.create_dataset("indices", dtype=np.int32 if v.shape[1] < np.iinfo(np.int32).max else np.int64,
+                               **dataset_kwargs)
+    indptr = np.zeros(v.shape[0] + 1, dtype=np.int64)
+    nnz = 0
+    for start, end, chunk in v.iter_chunks():
+        chunk_nnz = chunk.indptr[-1]
+        data.resize((nnz + chunk_nnz,))
+        indices.resize((nnz + chunk_nnz,))
+        data[nnz:] = chunk.data[:chunk_nnz]
+        indices[nnz:] = chunk.indices[:chunk_nnz]
+        indptr[start + 1:end + 1] = nnz + chunk.indptr[1:]
+        nnz += chunk_nnz
+    g.create_dataset("indptr", data=indptr)
+
+
 def write_genes(f, k, v, dataset_kwargs=MappingProxyType({})):
     g = f.create_group(k)
     g.attrs["encoding-type"] = "gene"
@@ -101,6 +277,48 @@ def write_cells(f, k, v, dataset_kwargs=MappingProxyType({})):
     g = f.create_group(k)
     g.attrs["encoding-type"] = "cell"
     write_array(g, 'cell_name', v.cell_name, dataset_kwargs)
+    if v.sample is not None:
+        write_array(g, 'sample', np.asarray(v.sample), dataset_kwargs)
+
+
+def write_dict(f, k, v: dict):
+    """
+    write the dict as a group, each item is written by its type. The items whose type is not supported are skipped.
+
+    :param f: the h5 file or group.
+    :param k: the key of the group.
+    :param v: the dict to write.
+    :return:
+    """
+    g = f.create_group(k)
+    g.attrs["encoding-type"] = "dict"
+    for sub_key, sub_value in v.items():
+        sub_key = check_key(sub_key)
+        if sparse.issparse(sub_value):
+            sp_format = 'csr' if sparse.isspmatrix_csr(sub_value) else 'csc'
+            write(sparse.csr_matrix(sub_value) if sp_format == 'csr' else sparse.csc_matrix(sub_value),
+                  g, sub_key, sp_format)
+        elif isinstance(sub_value, _WRITABLE_TYPES):
+            write(sub_value, g, sub_key)
+        else:
+            logger.warning(f'the type {type(sub_value)} of {g.name}/{sub_key} is not supported to write, skip it.')
+
+
+def write_neighbors(f, k, v: Neighbors):
+    """
+    write the parameters of Neighbors object, the input matrix `x` is not written.
+
+    :param f: the h5 file or group.
+    :param k: the key of the group.
+    :param v: the Neighbors object.
+    :return:
+    """
+    g = f.create_group(k)
+    g.attrs["encoding-type"] = "neighbors"
+    for param in _NEIGHBORS_PARAMS:
+        value = getattr(v, param)
+        if isinstance(value, (str, int, float, bool, np.generic)):
+            g.attrs[param] = value
 
 
 def write_spmatrix_as_dense(f, key, value, dataset_kwargs=MappingProxyType({})):
@@ -116,7 +334,9 @@ def write_dataframe(f, key, df, dataset_kwargs=MappingProxyType({})):
         if reserved in df.columns:
             raise ValueError(f"{reserved!r} is a reserved name for dataframe columns.")
 
-    col_names = [check_key(c) for c in df.columns]
+    # the integer column names, such as the result of pca, are written as str
+    int_columns = len(df.columns) > 0 and all(isinstance(c, (int, np.integer)) for c in df.columns)
+    col_names = [str(c) for c in df.columns] if int_columns else [check_key(c) for c in df.columns]
 
     if df.index.name is not None:
         index_name = df.index.name
@@ -128,6 +348,8 @@ def write_dataframe(f, key, df, dataset_kwargs=MappingProxyType({})):
     group.attrs["encoding-type"] = "dataframe"
     group.attrs["column-order"] = col_names
     group.attrs["_index"] = index_name
+    if int_columns:
+        group.attrs["column-type"] = "int"
 
     write_series(group, index_name, df.index, dataset_kwargs=dataset_kwargs)
     for col_name, (_, series) in zip(col_names, df.items()):
@@ -146,7 +368,10 @@ def write_series(group, key, series, dataset_kwargs=MappingProxyType({})):
     elif is_categorical_dtype(series):
         # This should work for categorical Index and Series
         categorical: pd.Categorical = series.values
-        categories: np.ndarray = categorical.categories.values
+        categories: np.ndarray = np.asarray(categorical.categories.values)
+        if categories.dtype.kind == 'O' and not all(isinstance(c, str) for c in categories):
+            # such as the interval categories of pd.cut, which are written as their labels
+            categories = categories.astype(str)
         codes: np.ndarray = categorical.codes
         category_key = f"__categories/{key}"
 
@@ -197,6 +422,8 @@ def read_dataframe(group) -> pd.DataFrame:
     )
     if idx_key != "_index":
         df.index.name = idx_key
+    if group.attrs.get("column-type") == "int":
+        df.columns = [int(c) for c in df.columns]
     return df
 
 
@@ -211,18 +438,40 @@ def read_spmatrix(group) -> sparse.spmatrix:
     return mtx
 
 
+def _read_names(dataset: h5py.Dataset) -> np.ndarray:
+    if H5PY_V3 and h5py.check_string_dtype(dataset.dtype) is not None:
+        return dataset.asstr()[...].astype(str)
+    value = dataset[...]
+    return value.astype(str) if value.dtype.kind == 'S' else value
+
+
 def read_genes(group) -> Gene:
-    gene_name = group["gene_name"][...]
+    gene_name = _read_names(group["gene_name"])
     gene = Gene(gene_name=gene_name)
     return gene
 
 
 def read_cells(group) -> Cell:
-    cell_name = group["cell_name"][...]
+    cell_name = _read_names(group["cell_name"])
     cell = Cell(cell_name=cell_name)
+    if 'sample' in group:
+        cell.sample = _read_names(group['sample'])
     return cell
 
 
+def read_dict(group) -> dict:
+    d = dict()
+    for sub_key, sub_value in group.items():
+        d[sub_key] = read_group(sub_value) if isinstance(sub_value, h5py.Group) else read_dataset(sub_value)
+    return d
+
+
+def read_neighbors(group) -> Neighbors:
+    params = {param: group.attrs.get(param) for param in _NEIGHBORS_PARAMS}
+    params = {k: v.item() if isinstance(v, np.generic) else v for k, v in params.items()}
+    return Neighbors(x=None, **params)
+
+
 def read_series(dataset) -> Union[np.ndarray, pd.Categorical]:
     if "categories" in dataset.attrs:
         categories = dataset.attrs["categories"]
@@ -272,6 +521,10 @@ def read_group(group: h5py.Group) -> Union[dict, pd.DataFrame, sparse.spmatrix,
         return read_cells(group)
     elif encoding_type == "gene":
         return read_genes(group)
+    elif encoding_type == "dict":
+        return read_dict(group)
+    elif encoding_type == "neighbors":
+        return read_neighbors(group)
     else:
         raise ValueError(f"Unfamiliar `encoding-type`: {encoding_type}.")
     d = dict()
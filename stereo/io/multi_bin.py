@@ -0,0 +1,109 @@
+"""Read the stereo-seq file once at bin1, and derive the bigger bin sizes by sparse aggregation."""
+import os
+import time
+from pathlib import Path
+from typing import Optional, Sequence
+from ..core.stereo_exp_data import StereoExpData
+from ..log_manager import logger
+
+
+class MultiBinReader(object):
+    """
+    read the gem or gef file once at bin1, and derive the data of other bin sizes by `StereoExpData.rebin`. Each bin
+    size is derived from the biggest cached bin size it is a multiple of, and cached in memory, also on disk if the
+    cache_dir is set, so that switching the bin size does not re-read the file.
+
+    :param file_path: the path of gem or gef file.
+    :param file_format: 'gem' or 'gef'.
+    :param cache_dir: the directory to cache the data of each bin size as h5ad files, default only cached in memory.
+                      The cache files are reused while they are newer than the input file.
+    :param sep: separator string of the gem file.
+    :param is_sparse: the matrix is sparse matrix if is_sparse is True else np.ndarray
+    :param chunk_size: the chunk size of reading the gem file, see `read_gem`.
+    """
+    def __init__(self, file_path: str, file_format: str = 'gem', cache_dir: Optional[str] = None, sep: str = '\t',
+                 is_sparse: bool = True, chunk_size: Optional[int] = None):
+        if file_format not in ('gem', 'gef'):
+            raise ValueError(f"file_format must be 'gem' or 'gef', got {file_format}.")
+        self.file_path = str(file_path)
+        self.file_format = file_format
+        self.cache_dir = cache_dir
+        self.sep = sep
+        self.is_sparse = is_sparse
+        self.chunk_size = chunk_size
+        self.levels = dict()
+
+    def _cache_path(self, bin_size: int) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f'{Path(self.file_path).name}.bin{bin_size}.h5ad')
+
+    def _read_cache(self, bin_size: int) -> Optional[StereoExpData]:
+        cache_path = self._cache_path(bin_size)
+        if cache_path is None or not os.path.exists(cache_path) or \
+                os.path.getmtime(cache_path) < os.path.getmtime(self.file_path):
+            return None
+        from .reader import read_stereo_h5ad
+        data = read_stereo_h5ad(cache_path, use_raw=False, use_result=False)
+        data.bin_type = 'bins'
+        data.bin_size = bin_size
+        return data
+
+    def _write_cache(self, data: StereoExpData, bin_size: int):
+        cache_path = self._cache_path(bin_size)
+        if cache_path is None:
+            return
+        from .writer import write_h5ad
+        os.makedirs(self.cache_dir, exist_ok=True)
+        output = data.output
+        data.output = cache_path
+        write_h5ad(data, use_raw=False, use_result=False)
+        # set the private attribute to skip the check of output path
+        data._output = output
+
+    def _read_file(self) -> StereoExpData:
+        from .reader import read_gem, read_gef
+        if self.file_format == 'gem':
+            return read_gem(self.file_path, sep=self.sep, bin_type='bins', bin_size=1, is_sparse=self.is_sparse,
+                            chunk_size=self.chunk_size)
+        return read_gef(self.file_path, bin_type='bins', bin_size=1, is_sparse=self.is_sparse)
+
+    def _get_level(self, bin_size: int) -> StereoExpData:
+        if bin_size in self.levels:
+            return self.levels[bin_size]
+        start = time.time()
+        data = self._read_cache(bin_size)
+        if data is not None:
+            logger.info(f'read bin{bin_size} from the cache in {time.time() - start:.2f}s.')
+        elif bin_size == 1:
+            data = self._read_file()
+            self._write_cache(data, bin_size)
+            logger.info(f'read bin1 from {self.file_path} in {time.time() - start:.2f}s.')
+        else:
+            source_size = max([s for s in self.levels if bin_size % s == 0], default=1)
+            data = self._get_level(source_size).rebin(bin_size)
+            self._write_cache(data, bin_size)
+            logger.info(f'derive bin{bin_size} from bin{source_size} in {time.time() - start:.2f}s.')
+        self.levels[bin_size] = data
+        return data
+
+    def read(self, bin_size: int = 100, copy_data: bool = True) -> StereoExpData:
+        """
+        get the data of the bin size.
+
+        :param bin_size: the size of bin to merge.
+        :param copy_data: return a copy-on-write view of the cached data, so that the analysis does not change the cache.
+        :return: an object of StereoExpData.
+        """
+        data = self._get_level(int(bin_size))
+        return data.view() if copy_data else data
+
+    def read_many(self, bin_sizes: Sequence[int] = (20, 50, 100, 200), copy_data: bool = True) -> dict:
+        """
+        get the data of several bin sizes, the smaller bin sizes are derived first and reused by the bigger ones.
+
+        :param bin_sizes: the sizes of bin to merge.
+        :param copy_data: return the copy-on-write views of the cached data.
+        :return: a dict from the bin size to the StereoExpData.
+        """
+        return {bin_size: self.read(bin_size, copy_data) for bin_size in sorted(bin_sizes)}
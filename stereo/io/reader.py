@@ -15,21 +15,26 @@ change log:
     2021/08/20
 
 """
+import time
+import inspect
 import pandas as pd
 from ..core.stereo_exp_data import StereoExpData
 from ..log_manager import logger
 import h5py
 from stereo.io import h5ad
 from scipy.sparse import csr_matrix
-from ..core.cell import Cell
+from ..core.cell import Cell, encode_coor_id, decode_coor_id
 from ..core.gene import Gene
+from ..core.backed_matrix import BackedCSRMatrix
 import numpy as np
 from anndata import AnnData
-from shapely.geometry import Point, MultiPoint
-from typing import Optional
+from shapely.geometry import MultiPoint
+from typing import Optional, Union
+from ..utils.spmatrix_helper import SparseMatrixBuilder
 
 
-def read_gem(file_path, sep='\t', bin_type="bins", bin_size=100, is_sparse=True):
+def read_gem(file_path, sep='\t', bin_type="bins", bin_size=100, is_sparse=True, chunk_size: Optional[int] = None,
+             cell_hull: Optional[str] = None, n_jobs: int = 1):
     """
     read the stereo-seq file, and generate the object of StereoExpData.
 
@@ -39,10 +44,20 @@ def read_gem(file_path, sep='\t', bin_type="bins", bin_size=100, is_sparse=True)
     :param bin_size: the size of bin to merge. The parameter only takes effect
                      when the value of data.bin_type is 'bins'.
     :param is_sparse: the matrix is sparse matrix if is_sparse is True else np.ndarray
+    :param chunk_size: if set, read the file in streaming mode, `chunk_size` rows per chunk, so that the peak memory
+                       scales with the output matrix instead of the text file.
+    :param cell_hull: the convex hulls of the cell_bins, which are stored in `data.cells.cell_point`. None (default)
+                      only computes the centroids, 'lazy' builds the hull of a cell when it is accessed, and 'eager'
+                      builds all hulls in `n_jobs` worker processes.
+    :param n_jobs: the number of worker processes to build the hulls if cell_hull is 'eager'.
 
     :return: an object of StereoExpData.
     """
-    data = StereoExpData(file_path=file_path, bin_type=bin_type)
+    if cell_hull not in (None, 'lazy', 'eager'):
+        raise ValueError(f"cell_hull must be None, 'lazy' or 'eager', got {cell_hull}.")
+    data = StereoExpData(file_path=file_path, bin_type=bin_type, bin_size=bin_size)
+    if chunk_size is not None:
+        return _read_gem_by_chunk(data, sep, bin_size, chunk_size, is_sparse, cell_hull, n_jobs)
     df = pd.read_csv(str(data.file), sep=sep, comment='#', header=0)
     if 'MIDCounts' in df.columns:
         df.rename(columns={'MIDCounts': 'UMICount'}, inplace=True)
@@ -55,12 +70,9 @@ def read_gem(file_path, sep='\t', bin_type="bins", bin_size=100, is_sparse=True)
         gdf = parse_cell_bin_coor(df)
     else:
         df = parse_bin_coor(df, bin_size)
-    cells = df['cell_id'].unique()
-    genes = df['geneID'].unique()
-    cells_dict = dict(zip(cells, range(0, len(cells))))
-    genes_dict = dict(zip(genes, range(0, len(genes))))
-    rows = df['cell_id'].map(cells_dict)
-    cols = df['geneID'].map(genes_dict)
+    rows, cells = pd.factorize(df['cell_id'])
+    cols, genes = pd.factorize(df['geneID'])
+    cells, genes = np.asarray(cells), np.asarray(genes)
     logger.info(f'the martrix has {len(cells)} cells, and {len(genes)} genes.')
     exp_matrix = csr_matrix((df['UMICount'], (rows, cols)), shape=(cells.shape[0], genes.shape[0]), dtype=np.int32)
     data.cells = Cell(cell_name=cells)
@@ -68,16 +80,122 @@ def read_gem(file_path, sep='\t', bin_type="bins", bin_size=100, is_sparse=True)
     data.exp_matrix = exp_matrix if is_sparse else exp_matrix.toarray()
     if data.bin_type == 'bins':
         data.position = df.loc[:, ['x_center', 'y_center']].drop_duplicates().values
+        data.bin_origin = np.array([df['x'].min(), df['y'].min()], dtype=np.int64)
     else:
-        data.position = gdf.loc[cells][['x_center', 'y_center']].values
-        data.cells.cell_point = gdf.loc[cells]['cell_point'].values
+        data.position = gdf[['x_center', 'y_center']].values
+        if cell_hull is not None:
+            data.cells.cell_point = parse_cell_bin_hull(df, cell_hull, n_jobs)
+    return data
+
+
+def _get_gem_columns(file_path, sep):
+    """
+    get the column names of the gem file, and the name of the count column.
+
+    :param file_path: input file
+    :param sep: separator string
+    :return: the column names and the name of the count column.
+    """
+    columns = pd.read_csv(file_path, sep=sep, comment='#', header=0, nrows=0).columns
+    count_col = [c for c in ('MIDCounts', 'MIDCount', 'UMICount') if c in columns]
+    if not count_col:
+        raise ValueError(f'can not find the count column in {file_path}, please check!')
+    return columns, count_col[0]
+
+
+def _map_to_index(keys, index_dict: dict):
+    """
+    map the keys to the positions of index_dict, the new keys are appended to the end of index_dict.
+
+    :param keys: the unique keys.
+    :param index_dict: the dict from key to position, which will be updated inplace.
+    :return: a numpy array of positions.
+    """
+    return np.fromiter((index_dict.setdefault(k, len(index_dict)) for k in keys), dtype=np.int64, count=len(keys))
+
+
+def _read_gem_by_chunk(data, sep, bin_size, chunk_size, is_sparse, cell_hull=None, n_jobs=1):
+    """
+    read the gem file chunk by chunk with compact dtypes. The (cell, gene, count) triplets of each chunk are
+    accumulated into a SparseMatrixBuilder with integer cell and gene dicts.
+
+    :param data: the StereoExpData object to fill.
+    :param sep: separator string
+    :param bin_size: the size of bin to merge.
+    :param chunk_size: the number of rows per chunk.
+    :param is_sparse: the matrix is sparse matrix if is_sparse is True else np.ndarray
+    :param cell_hull: the convex hulls of the cell_bins, see `read_gem`.
+    :param n_jobs: the number of worker processes to build the hulls.
+    :return: an object of StereoExpData.
+    """
+    file_path = str(data.file)
+    _, count_col = _get_gem_columns(file_path, sep)
+    is_cell_bin = data.bin_type == 'cell_bins'
+    # the numbers are read as float64 to keep the blank values as NaN, the rows with a blank value in any column are
+    # dropped as the in-memory reading does, and the numbers are converted back after that
+    dtype = {'geneID': 'category', 'x': np.float64, 'y': np.float64, count_col: np.float64}
+    if is_cell_bin:
+        dtype['label'] = np.float64
+    reader_kwargs = dict(sep=sep, comment='#', header=0, chunksize=chunk_size, dtype=dtype)
+    start = time.time()
+    if not is_cell_bin:
+        x_min = y_min = np.iinfo(np.int32).max
+        for chunk in pd.read_csv(file_path, **reader_kwargs):
+            chunk = chunk.dropna()
+            if chunk.shape[0] > 0:
+                x_min = min(x_min, int(chunk['x'].min()))
+                y_min = min(y_min, int(chunk['y'].min()))
+    builder = SparseMatrixBuilder(dtype=np.int32)
+    cells_dict, genes_dict = dict(), dict()
+    coor_x, coor_y, coor_cell = [], [], []
+    n_rows = 0
+    for chunk in pd.read_csv(file_path, **reader_kwargs):
+        n_rows += chunk.shape[0]
+        chunk = chunk.dropna()
+        gene_codes, uniq_genes = pd.factorize(chunk['geneID'])
+        cols = _map_to_index(np.asarray(uniq_genes), genes_dict)[gene_codes]
+        x, y = chunk['x'].to_numpy(np.int32), chunk['y'].to_numpy(np.int32)
+        if is_cell_bin:
+            keys = chunk['label'].to_numpy(np.uint32)
+        else:
+            keys = encode_coor_id(merge_bin_coor(x, x_min, bin_size), merge_bin_coor(y, y_min, bin_size))
+        cell_codes, uniq_keys = pd.factorize(keys)
+        rows = _map_to_index(uniq_keys, cells_dict)[cell_codes]
+        builder.add(rows, cols, chunk[count_col].to_numpy(np.int32))
+        if is_cell_bin:
+            coor_x.append(x)
+            coor_y.append(y)
+            coor_cell.append(rows.astype(np.uint32))
+        logger.debug(f'read {n_rows} rows, {n_rows / (time.time() - start):.0f} rows per second.')
+    cost = time.time() - start
+    logger.info(f'read {n_rows} rows in {cost:.2f}s, {n_rows / max(cost, 1e-9):.0f} rows per second.')
+    cell_keys = np.array(list(cells_dict.keys()))
+    genes = np.array(list(genes_dict.keys()))
+    logger.info(f'the martrix has {len(cell_keys)} cells, and {len(genes)} genes.')
+    exp_matrix = builder.to_csr(shape=(len(cell_keys), len(genes)))
+    data.genes = Gene(gene_name=genes)
+    data.exp_matrix = exp_matrix if is_sparse else exp_matrix.toarray()
+    if is_cell_bin:
+        df = pd.DataFrame({'x': np.concatenate(coor_x), 'y': np.concatenate(coor_y),
+                           'cell_id': np.concatenate(coor_cell)})
+        gdf = parse_cell_bin_coor(df)
+        data.cells = Cell(cell_name=cell_keys)
+        data.position = gdf[['x_center', 'y_center']].values
+        if cell_hull is not None:
+            data.cells.cell_point = parse_cell_bin_hull(df, cell_hull, n_jobs)
+    else:
+        bin_x, bin_y = decode_coor_id(cell_keys)
+        data.cells = Cell(cell_name=cell_keys.astype(np.uint64))
+        data.position = np.vstack([get_bin_center(bin_x, x_min, bin_size),
+                                   get_bin_center(bin_y, y_min, bin_size)]).T
+        data.bin_origin = np.array([x_min, y_min], dtype=np.int64)
     return data
 
 
 def parse_bin_coor(df, bin_size):
     """
     merge bins to a bin unit according to the bin size, also calculate the center coordinate of bin unit,
-    and generate cell id of bin unit using the coordinate after merged.
+    and generate cell id of bin unit by packing the coordinate after merged into uint64.
 
     :param df: a dataframe of the bin file.
     :param bin_size: the size of bin to merge.
@@ -87,64 +205,179 @@ def parse_bin_coor(df, bin_size):
     y_min = df['y'].min()
     df['bin_x'] = merge_bin_coor(df['x'].values, x_min, bin_size)
     df['bin_y'] = merge_bin_coor(df['y'].values, y_min, bin_size)
-    df['cell_id'] = df['bin_x'].astype(str) + '_' + df['bin_y'].astype(str)
+    df['cell_id'] = encode_coor_id(df['bin_x'].values, df['bin_y'].values)
     df['x_center'] = get_bin_center(df['bin_x'], x_min, bin_size)
     df['y_center'] = get_bin_center(df['bin_y'], y_min, bin_size)
     return df
 
 
 def parse_cell_bin_coor(df):
-    gdf = df.groupby('cell_id').apply(lambda x: make_multipoint(x))
+    """
+    calculate the centroid of each cell as the mean coordinate of its points, by the grouped array reductions.
+
+    :param df: a dataframe with the columns of x, y and cell_id.
+    :return: a dataframe indexed by the cell ids in order of appearance, with the columns of x_center and y_center.
+    """
+    codes, cells = pd.factorize(df['cell_id'])
+    counts = np.bincount(codes, minlength=len(cells))
+    gdf = pd.DataFrame({
+        'x_center': np.bincount(codes, weights=df['x'].values, minlength=len(cells)) / counts,
+        'y_center': np.bincount(codes, weights=df['y'].values, minlength=len(cells)) / counts,
+    }, index=cells)
     return gdf
 
 
-def make_multipoint(x):
-    p = [Point(i) for i in zip(x['x'], x['y'])]
-    mlp = MultiPoint(p).convex_hull
-    x_center = mlp.centroid.x
-    y_center = mlp.centroid.y
-    return pd.Series({'cell_point': mlp, 'x_center': x_center, 'y_center': y_center})
+def parse_cell_bin_hull(df, cell_hull: str = 'lazy', n_jobs: int = 1):
+    """
+    get the convex hull of each cell, the cells are in order of appearance like `parse_cell_bin_coor`.
+
+    :param df: a dataframe with the columns of x, y and cell_id.
+    :param cell_hull: 'lazy' builds the hull of a cell when it is accessed, and 'eager' builds all hulls in `n_jobs`
+                      worker processes.
+    :param n_jobs: the number of worker processes to build the hulls if cell_hull is 'eager'.
+    :return: a CellHulls object if cell_hull is 'lazy' else a numpy array of hulls.
+    """
+    codes, cells = pd.factorize(df['cell_id'])
+    hulls = CellHulls(df['x'].values, df['y'].values, codes, len(cells))
+    return hulls.build(n_jobs) if cell_hull == 'eager' else hulls
+
+
+def _build_hulls(coor: np.ndarray, offsets: np.ndarray) -> list:
+    return [MultiPoint(coor[offsets[i]:offsets[i + 1]]).convex_hull for i in range(len(offsets) - 1)]
+
+
+class CellHulls(object):
+    """
+    the convex hulls of the cells, which are built from the points of each cell when they are accessed.
+
+    :param x: the x coordinates of the points.
+    :param y: the y coordinates of the points.
+    :param codes: the cell position of each point.
+    :param n_cells: the number of cells.
+    """
+    def __init__(self, x: np.ndarray, y: np.ndarray, codes: np.ndarray, n_cells: int):
+        # only the leftmost and rightmost points of each row of a cell can be the vertices of its hull
+        order = np.lexsort((x, y, codes))
+        x, y, codes = x[order], y[order], codes[order]
+        is_edge = np.ones(len(codes), dtype=bool)
+        same_row = (codes[1:] == codes[:-1]) & (y[1:] == y[:-1])
+        is_edge[1:-1] = ~(same_row[:-1] & same_row[1:])
+        self.coor = np.column_stack([x[is_edge], y[is_edge]]).astype(np.float64)
+        self.offsets = np.zeros(n_cells + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(codes[is_edge], minlength=n_cells))
+        self._hulls = np.empty(n_cells, dtype=object)
+
+    def __len__(self):
+        return len(self._hulls)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            index = int(index)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f'cell index out of range for {len(self)} cells.')
+            if self._hulls[index] is None:
+                self._hulls[index] = MultiPoint(self.coor[self.offsets[index]:self.offsets[index + 1]]).convex_hull
+            return self._hulls[index]
+        positions = np.arange(len(self))[index]
+        hulls = np.empty(len(positions), dtype=object)
+        hulls[:] = [self[int(i)] for i in positions]
+        return hulls
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def build(self, n_jobs: int = 1, n_chunks: int = 64) -> np.ndarray:
+        """
+        build all hulls.
+
+        :param n_jobs: the number of worker processes.
+        :param n_chunks: the cells are split into n_chunks * n_jobs chunks which are built by the workers.
+        :return: a numpy array of hulls.
+        """
+        todo = np.where(pd.isnull(self._hulls))[0]
+        if n_jobs <= 1 or len(todo) < n_jobs:
+            for i in todo:
+                self[int(i)]
+            return self._hulls
+        from concurrent.futures import ProcessPoolExecutor
+        bounds = np.linspace(0, len(self), n_chunks * n_jobs + 1).astype(np.int64)
+        bounds = np.unique(bounds)
+        tasks = [(self.coor[self.offsets[begin]:self.offsets[end]], self.offsets[begin:end + 1] - self.offsets[begin])
+                 for begin, end in zip(bounds[:-1], bounds[1:])]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            for begin, end, hulls in zip(bounds[:-1], bounds[1:], executor.map(_build_hulls, *zip(*tasks))):
+                self._hulls[begin:end] = hulls
+        return self._hulls
 
 
 def merge_bin_coor(coor: np.ndarray, coor_min: int, bin_size: int):
-    return np.floor((coor - coor_min) / bin_size).astype(np.int)
+    return np.floor((coor - coor_min) / bin_size).astype(int)
 
 
 def get_bin_center(bin_coor: np.ndarray, coor_min: int, bin_size: int):
     return bin_coor * bin_size + coor_min + int(bin_size / 2)
 
 
-def read_stereo_h5ad(file_path):
+def read_stereo_h5ad(file_path, backed: Optional[str] = None, use_raw=True, use_result=True):
     """
     read the h5ad file, and generate the object of StereoExpData.
 
     :param file_path: the path of input file.
+    :param backed: if 'r', the exp_matrix is a lazy csr view over the file instead of being loaded into memory, so
+                   that slicing and qc stream the chunks from disk. Only the csr exp_matrix supports backed mode.
+    :param use_raw: whether to restore the `data.tl.raw` if it is in the file.
+    :param use_result: whether to restore the `data.tl.result` if it is in the file.
     :return:
     """
+    if backed not in (None, 'r'):
+        raise ValueError(f"backed must be None or 'r', got {backed}.")
     data = StereoExpData(file_path=file_path)
     if not data.file.exists():
         logger.error('the input file is not exists, please check!')
         raise FileExistsError('the input file is not exists, please check!')
     with h5py.File(data.file, mode='r') as f:
-        for k in f.keys():
-            if k == 'cells':
-                data.cells = h5ad.read_group(f[k])
-            elif k == 'genes':
-                data.genes = h5ad.read_group(f[k])
-            elif k == 'position':
-                data.position = h5ad.read_dataset(f[k])
-            elif k == 'bin_type':
-                data.bin_type = h5ad.read_dataset(f[k])
-            elif k == 'exp_matrix':
-                if isinstance(f[k], h5py.Group):
-                    data.exp_matrix = h5ad.read_group(f[k])
-                else:
-                    data.exp_matrix = h5ad.read_dataset(f[k])
-            else:
-                pass
+        _read_one_h5ad(f, data, backed)
+        if use_raw and 'tl_raw' in f.keys():
+            raw = StereoExpData(file_path=file_path)
+            _read_one_h5ad(f['tl_raw'], raw, backed)
+            # set the private attribute to avoid the deepcopy of raw setter
+            data.tl._raw = raw
+        if use_result and 'tl_result' in f.keys():
+            data.tl.result = h5ad.read_group(f['tl_result'])
     return data
 
 
+def _read_one_h5ad(f, data, backed):
+    for k in f.keys():
+        if k == 'cells':
+            data.cells = h5ad.read_group(f[k])
+        elif k == 'genes':
+            data.genes = h5ad.read_group(f[k])
+        elif k == 'position':
+            data.position = h5ad.read_dataset(f[k])
+        elif k == 'bin_type':
+            data.bin_type = h5ad.read_dataset(f[k])
+        elif k == 'bin_size':
+            data.bin_size = int(h5ad.read_dataset(f[k]))
+        elif k == 'bin_origin':
+            data.bin_origin = h5ad.read_dataset(f[k])
+        elif k == 'exp_matrix':
+            if backed == 'r' and f[k].attrs.get('encoding-type') == 'csr_matrix':
+                data.exp_matrix = BackedCSRMatrix(data.file, key=f[k].name)
+                continue
+            if backed == 'r':
+                logger.warning('only the csr exp_matrix supports backed mode, it will be loaded into memory.')
+            if isinstance(f[k], h5py.Group):
+                data.exp_matrix = h5ad.read_group(f[k])
+            else:
+                data.exp_matrix = h5ad.read_dataset(f[k])
+        else:
+            pass
+
+
 def read_ann_h5ad(file_path, spatial_key: Optional[str] = None):
     """
     read the h5ad file in Anndata format, and generate the object of StereoExpData.
@@ -228,8 +461,11 @@ def stereo_to_anndata(stereo_data: StereoExpData,spatial_key:str='spatial'):
     :param spatial_key: add position information to obsm[spatial_key]. Default '`spatial`'.
     :return: anndata object.
     """
+    obs = stereo_data.cells.to_df()
+    if stereo_data.cell_names is not None:
+        obs.index = stereo_data.cells.get_str_names()
     andata = AnnData(X=stereo_data.exp_matrix,
-                     obs=stereo_data.cells.to_df(),
+                     obs=obs,
                      var=stereo_data.genes.to_df(),
                      )
     if stereo_data.position is not None:
@@ -299,7 +535,8 @@ def stereo_to_anndata(stereo_data: StereoExpData,spatial_key:str='spatial'):
 #     adata.obs_names = pd.read_csv(barcodesfile, header=None)[0].values
 #     return adata
 
-def read_gef(file_path: str, bin_type="bins", bin_size=100, is_sparse=True, gene_list: list = None, region: list = None):
+def read_gef(file_path: str, bin_type="bins", bin_size=100, is_sparse=True, gene_list: list = None, region: list = None,
+             tile_index: Union[bool, str] = False):
     """
     read the gef(.h5) file, and generate the object of StereoExpData.
 
@@ -310,6 +547,9 @@ def read_gef(file_path: str, bin_type="bins", bin_size=100, is_sparse=True, gene
     :param is_sparse: the matrix is sparse matrix if is_sparse is True else np.ndarray
     :param gene_list: restrict to this gene list
     :param region: restrict to this region, [minX, maxX, minY, maxY]
+    :param tile_index: only takes effect when the region is set. If True, read the region through the spatial tile
+                       index saved in `{file_path}.tile_index.h5`, or the index file path if a str is given. The index
+                       is built on the first query, then the region read only touches the tiles overlapping the region.
 
     :return: an object of StereoExpData.
     """
@@ -325,7 +565,13 @@ def read_gef(file_path: str, bin_type="bins", bin_size=100, is_sparse=True, gene
         data.genes = Gene(gene_name=cell_bin_gef.genes)
         data.exp_matrix = exp_matrix if is_sparse else exp_matrix.toarray()
     else:
-        if gene_list is not None or region is not None:
+        if region is not None and tile_index:
+            from stereo.io.gef import GEFTileIndex
+            index_path = tile_index if isinstance(tile_index, str) else None
+            gef_index = GEFTileIndex(file_path=file_path, bin_size=bin_size, index_path=index_path,
+                                     is_sparse=is_sparse)
+            data = gef_index.query(region=region, gene_lst=gene_list)
+        elif gene_list is not None or region is not None:
             from stereo.io.gef import GEF
             gef = GEF(file_path=file_path, bin_size=bin_size, is_sparse=is_sparse)
             gef.build(gene_lst=gene_list, region=region)
@@ -346,6 +592,122 @@ def read_gef(file_path: str, bin_type="bins", bin_size=100, is_sparse=True, gene
             data.cells = Cell(cell_name=uniq_cells)
             data.genes = Gene(gene_name=uniq_genes)
             data.exp_matrix = exp_matrix if is_sparse else exp_matrix.toarray()
+        data.bin_size = bin_size
     logger.info(f'read_gef end.')
 
     return data
+
+
+def _reader_kwargs(file_format: str, kwargs: dict) -> dict:
+    """
+    get the kwargs taken by the reader of the file format, so that the files of mixed formats share the kwargs.
+    """
+    readers = {'gef': read_gef, 'gem': read_gem, 'h5ad': read_stereo_h5ad}
+    if file_format not in readers:
+        raise ValueError(f"file_format must be 'gem', 'gef' or 'h5ad', got {file_format}.")
+    params = inspect.signature(readers[file_format]).parameters
+    return {k: v for k, v in kwargs.items() if k in params}
+
+
+def _read_sample(file_path: str, file_format: str, kwargs: dict):
+    """
+    read one file for read_many, the parts of StereoExpData are returned to be sent back from the worker process.
+    """
+    start = time.time()
+    kwargs = _reader_kwargs(file_format, kwargs)
+    if file_format == 'gef':
+        data = read_gef(file_path, **kwargs)
+    elif file_format == 'gem':
+        data = read_gem(file_path, **kwargs)
+    else:
+        data = read_stereo_h5ad(file_path, use_raw=False, use_result=False, **kwargs)
+    exp_matrix = data.exp_matrix.tocsr() if data.is_backed else csr_matrix(data.exp_matrix)
+    return exp_matrix, data.cell_names, data.gene_names, data.position, data.bin_type, time.time() - start
+
+
+def read_many(paths: list, file_format: Optional[str] = None, sample_names: Optional[list] = None, n_jobs: int = 1,
+              position_gap: float = 1000, index_unique: Optional[str] = '-', **kwargs):
+    """
+    read the files in a process pool, and merge them into one StereoExpData. The genes are aligned with the union of
+    genes in order of appearance, the express matrices are stacked as a csr matrix, and the positions of each sample
+    are shifted along x to be placed side by side.
+
+    :param paths: the paths of input files.
+    :param file_format: 'gem', 'gef' or 'h5ad', default is inferred from the suffix of each file.
+    :param sample_names: the label of each sample, which is kept in `data.cells.sample`, default is the file name.
+    :param n_jobs: the number of worker processes.
+    :param position_gap: the gap between the samples along x.
+    :param index_unique: the cell names are made unique by appending this separator and the sample name, e.g.
+                         `12_9-chip1`. If None, the names of multiple samples are kept as the `x_y` strings of their
+                         own bins, which no longer match the shifted positions, and the duplicated names across the
+                         samples are warned, since only the first of them is found by name.
+    :param kwargs: the other parameters of the readers, such as bin_type and bin_size, each reader only takes the
+                   parameters it has.
+    :return: an object of StereoExpData.
+    """
+    from pathlib import Path
+    from scipy.sparse import vstack
+    from concurrent.futures import ProcessPoolExecutor
+    paths = [str(p) for p in paths]
+    if sample_names is None:
+        sample_names = [Path(p).name for p in paths]
+    if len(sample_names) != len(paths):
+        raise ValueError('the length of sample_names must be the same as paths.')
+    if file_format is not None:
+        file_formats = [file_format] * len(paths)
+    else:
+        suffix_format = {'.gef': 'gef', '.h5': 'gef', '.h5ad': 'h5ad'}
+        file_formats = [suffix_format.get(Path(p).suffix.lower(), 'gem') for p in paths]
+    unknown = set(kwargs) - set().union(*[_reader_kwargs(f, kwargs) for f in set(file_formats)])
+    if unknown:
+        raise TypeError(f'read_many got unexpected keyword arguments {sorted(unknown)}.')
+    start = time.time()
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_read_sample, paths, file_formats, [kwargs] * len(paths)))
+    else:
+        results = [_read_sample(p, f, kwargs) for p, f in zip(paths, file_formats)]
+    for sample, path, res in zip(sample_names, paths, results):
+        logger.info(f'read {sample} ({path}): {res[0].shape[0]} cells, {res[0].shape[1]} genes in {res[-1]:.2f}s.')
+    costs = [res[-1] for res in results]
+    logger.info(f'read {len(paths)} files in {time.time() - start:.2f}s, the slowest is {sample_names[np.argmax(costs)]}'
+                f' ({max(costs):.2f}s).')
+
+    genes_dict = dict()
+    col_maps = [_map_to_index(res[2], genes_dict) for res in results]
+    n_genes = len(genes_dict)
+    exp_matrix = vstack([csr_matrix((m.data, col_map[m.indices], m.indptr), shape=(m.shape[0], n_genes))
+                         for (m, *_), col_map in zip(results, col_maps)], format='csr')
+    exp_matrix.sort_indices()
+    positions, x_offset = [], None
+    for res in results:
+        position = res[3]
+        if position is None:
+            continue
+        position = np.array(position, dtype=np.float64)
+        if len(position) > 0:
+            # the first sample keeps its coordinates, the next one starts after the gap
+            if x_offset is not None:
+                position[:, 0] += x_offset - position[:, 0].min()
+            x_offset = position[:, 0].max() + position_gap
+        positions.append(position)
+    cell_names = [res[1] for res in results]
+    sample = np.repeat(np.array(sample_names, dtype=str), [len(names) for names in cell_names])
+    if index_unique is not None:
+        cell_names = [np.char.add(np.char.add(Cell(cell_name=names).get_str_names(), index_unique), s)
+                      for names, s in zip(cell_names, sample_names)]
+    elif len(cell_names) > 1:
+        # the packed ids are decoded as positions, which are shifted for the samples after the first
+        cell_names = [Cell(cell_name=names).get_str_names() for names in cell_names]
+        n_duplicated = int(pd.Index(np.concatenate(cell_names)).duplicated().sum())
+        if n_duplicated > 0:
+            logger.warning(f'{n_duplicated} cell names are duplicated across the samples, only the first of them is '
+                           f'found by name, set index_unique to make them unique.')
+    data = StereoExpData(bin_type=results[0][4], exp_matrix=exp_matrix, genes=np.array(list(genes_dict.keys())),
+                         cells=np.concatenate(cell_names),
+                         position=np.concatenate(positions) if len(positions) == len(results) else None)
+    data.cells.sample = sample
+    if kwargs.get('bin_size') is not None:
+        data.bin_size = kwargs['bin_size']
+    logger.info(f'the merged martrix has {data.exp_matrix.shape[0]} cells, and {n_genes} genes.')
+    return data
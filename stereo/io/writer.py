@@ -11,38 +11,76 @@ change log:
     2021/07/05  create file.
 """
 from ..core.stereo_exp_data import StereoExpData
+from ..core.backed_matrix import BackedCSRMatrix
 from ..log_manager import logger
 from scipy.sparse import csr_matrix, issparse
 import h5py
 from stereo.io import h5ad
+from stereo.io.h5ad import WriteProfile
+from typing import Optional
+import numpy as np
 import pickle
+import os
 
-def write_h5ad(data):
+def write_h5ad(data, use_raw=True, use_result=True, profile: Optional[WriteProfile] = None):
     """
     write the SetreoExpData into h5ad file.
+
+    :param data: the StereoExpData object.
+    :param use_raw: whether to write the `data.tl.raw`.
+    :param use_result: whether to write the `data.tl.result`. The DataFrame, array, sparse matrix and Neighbors
+                       results are written into typed groups, the other types are skipped with a warning.
+    :param profile: the WriteProfile of the express matrix and position, which sets the chunk size, compression and
+                    float32 downcast. Default writes them contiguously without compression.
     :return:
     """
     if data.output is None:
         logger.error("the output path must be set before writting.")
+    for one in [data, data.tl.raw]:
+        if data.output is not None and one is not None and isinstance(one.exp_matrix, BackedCSRMatrix) and \
+                _same_file(data.output, one.exp_matrix.file_path):
+            raise ValueError(f'the output {data.output} is the backing file of the exp_matrix, which would be truncated '
+                             f'before it is read, please write to another path.')
     with h5py.File(data.output, mode='w') as f:
-        h5ad.write(data.genes, f, 'genes')
-        h5ad.write(data.cells, f, 'cells')
+        _write_one_h5ad(f, data, profile)
+        if use_raw and data.tl.raw is not None:
+            _write_one_h5ad(f.create_group('tl_raw'), data.tl.raw, profile)
+        if use_result and data.tl.result:
+            h5ad.write(data.tl.result, f, 'tl_result')
+
+
+def _write_one_h5ad(f, data, profile=None):
+    h5ad.write(data.genes, f, 'genes')
+    h5ad.write(data.cells, f, 'cells')
+    if isinstance(data.position, np.ndarray):
+        h5ad.write(data.position, f, 'position', profile=profile)
+    else:
         h5ad.write(data.position, f, 'position')
-        sp_format = 'csr' if isinstance(data.exp_matrix, csr_matrix) else 'csc'
-        if issparse(data.exp_matrix):
-            h5ad.write(data.exp_matrix, f, 'exp_matrix', sp_format)
-        else:
-            h5ad.write(data.exp_matrix, f, 'exp_matrix')
-        h5ad.write(data.bin_type, f, 'bin_type')
+    sp_format = 'csr' if isinstance(data.exp_matrix, (csr_matrix, BackedCSRMatrix)) else 'csc'
+    if issparse(data.exp_matrix) or isinstance(data.exp_matrix, BackedCSRMatrix):
+        h5ad.write(data.exp_matrix, f, 'exp_matrix', sp_format, profile=profile)
+    else:
+        h5ad.write(data.exp_matrix, f, 'exp_matrix', profile=profile)
+    h5ad.write(data.bin_type, f, 'bin_type')
+    h5ad.write(data.bin_size, f, 'bin_size')
+    if data.bin_origin is not None:
+        h5ad.write(np.asarray(data.bin_origin), f, 'bin_origin')
+
+
+def _same_file(path1, path2):
+    if os.path.exists(path1) and os.path.exists(path2):
+        return os.path.samefile(path1, path2)
+    return os.path.abspath(path1) == os.path.abspath(path2)
 
 
-def write(data, output=None, output_type='h5ad'):
+def write(data, output=None, output_type='h5ad', profile: Optional[WriteProfile] = None):
     """
     write the data as a h5ad file.
 
     :param data: the StereoExpData object.
     :param output: the output path. StereoExpData's output will be reset if the output is not None.
     :param output: the output type. StereoExpData's output will be written in output_type. Default setting is h5ad.
+    :param profile: the WriteProfile of the express matrix, see `write_h5ad`.
     :return:
     """
     if not isinstance(data, StereoExpData):
@@ -50,7 +88,7 @@ def write(data, output=None, output_type='h5ad'):
     if output is not None:
         data.output = output
         if output_type == 'h5ad':
-            write_h5ad(data)
+            write_h5ad(data, profile=profile)
 
 
 def save_pkl(obj, output):
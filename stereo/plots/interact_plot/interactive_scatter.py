@@ -16,7 +16,6 @@ import io
 from typing import Optional
 import holoviews.operation.datashader as hd
 from stereo.log_manager import logger
-import copy
 from stereo.config import StereoConfig
 
 conf = StereoConfig()
@@ -77,9 +76,7 @@ class InteractiveScatter:
         if selected_pos is not None:
             # selected_index = np.isin(self.data.cell_names, selected_pos)
             selected_index = self.scatter_df.index.drop(selected_pos) if drop else selected_pos
-            data_temp = copy.deepcopy(self.data)
-            self.selected_exp_data = data_temp.sub_by_index(
-                cell_index=selected_index)
+            self.selected_exp_data = self.data.view(cell_index=np.asarray(selected_index))
         else:
             self.selected_exp_data = None
 
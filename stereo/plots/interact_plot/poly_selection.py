@@ -74,12 +74,10 @@ class PolySelection(object):
         self.download.loading = False
 
     def generate_selected_expr_matrix(self, selected_pos, drop=False):
-        import copy
         if selected_pos is not None:
             # selected_index = np.isin(self.data.cell_names, selected_pos)
             selected_index = self.scatter_df.index.drop(selected_pos) if drop else selected_pos
-            data_temp = copy.deepcopy(self.data)
-            self.selected_exp_data = data_temp.sub_by_index(cell_index=selected_index)
+            self.selected_exp_data = self.data.view(cell_index=np.asarray(selected_index))
         else:
             self.selected_exp_data = None
 
@@ -11,10 +11,71 @@ change log:
     2021/07/06  create file.
 """
 import numpy as np
-import copy
+import pandas as pd
+from ..log_manager import logger
 from .qc import cal_total_counts, cal_pct_counts_mt, cal_n_genes_by_counts, cal_n_cells_by_counts, cal_n_cells
 
 
+class FilterPlan(object):
+    """
+    a filter plan over the cells or genes. The predicates are combined into one mask, so that the data is sliced only
+    once however many thresholds are set, and the number of items removed by each predicate is reported.
+
+    :param n: the number of cells or genes.
+    :param kind: 'cells' or 'genes', which is used in the report.
+    """
+    def __init__(self, n: int, kind: str = 'cells'):
+        self.kind = kind
+        self.mask = np.ones(n, dtype=bool)
+        self.criteria = []
+        self.n_failed = []
+        self.n_removed = []
+
+    def add(self, criterion: str, passed: np.ndarray):
+        """
+        add a predicate to the plan.
+
+        :param criterion: the description of the predicate.
+        :param passed: a bool array, True for the items passing the predicate.
+        :return:
+        """
+        passed = np.asarray(passed, dtype=bool)
+        self.criteria.append(criterion)
+        self.n_failed.append(int((~passed).sum()))
+        self.n_removed.append(int((self.mask & ~passed).sum()))
+        self.mask &= passed
+
+    @property
+    def report(self) -> pd.DataFrame:
+        """
+        the report of the plan, `n_failed` is the number of items failing each predicate, and `n_removed` is the number
+        of items removed by each predicate after the previous ones, which sums to the total number of removed items.
+
+        :return: a dataframe indexed by the criteria.
+        """
+        return pd.DataFrame({'n_failed': self.n_failed, 'n_removed': self.n_removed},
+                            index=pd.Index(self.criteria, name='criterion'))
+
+    def apply(self, data):
+        """
+        slice the data by the combined mask once, and log the report.
+
+        :param data: StereoExpData object.
+        :return: StereoExpData object.
+        """
+        n_removed = int((~self.mask).sum())
+        for criterion, n in zip(self.criteria, self.n_removed):
+            logger.info(f'filter {self.kind}: {criterion} removed {n} {self.kind}.')
+        logger.info(f'filter {self.kind}: {n_removed} of {len(self.mask)} {self.kind} are removed.')
+        if n_removed > 0:
+            if self.kind == 'cells':
+                data.sub_by_index(cell_index=self.mask)
+            else:
+                data.sub_by_index(gene_index=self.mask)
+        data.tl.result[f'filter_{self.kind}_report'] = self.report
+        return data
+
+
 def filter_cells(
         data,
         min_gene=None,
@@ -25,7 +86,8 @@ def filter_cells(
         cell_list=None,
         inplace=True):
     """
-    filter cells based on numbers of genes expressed.
+    filter cells based on numbers of genes expressed. All thresholds are combined into one mask and the data is sliced
+    once, the number of cells removed by each threshold is saved in `data.tl.result['filter_cells_report']`.
 
     :param data: StereoExpData object
     :param min_gene: Minimum number of genes expressed for a cell pass filtering.
@@ -37,43 +99,39 @@ def filter_cells(
     :param inplace: whether inplace the original data or return a new data.
     :return: StereoExpData object.
     """
-    data = data if inplace else copy.deepcopy(data)
+    data = data if inplace else data.view()
     if min_gene is None and max_gene is None and cell_list is None and min_n_genes_by_counts is None \
             and max_n_genes_by_counts is None and pct_counts_mt is None:
         raise ValueError('At least one filter must be set.')
     if data.cells.total_counts is None:
         total_counts = cal_total_counts(data.exp_matrix)
         data.cells.total_counts = total_counts
+    if (min_n_genes_by_counts or max_n_genes_by_counts) and data.cells.n_genes_by_counts is None:
+        data.cells.n_genes_by_counts = cal_n_genes_by_counts(data.exp_matrix)
+    if pct_counts_mt and data.cells.pct_counts_mt is None:
+        data.cells.pct_counts_mt = cal_pct_counts_mt(data, data.exp_matrix, data.cells.total_counts)
+    plan = FilterPlan(len(data.cells.total_counts), kind='cells')
     if min_gene:
-        cell_subset = data.cells.total_counts >= min_gene
-        data.sub_by_index(cell_index=cell_subset)
+        plan.add(f'total_counts >= {min_gene}', data.cells.total_counts >= min_gene)
     if max_gene:
-        cell_subset = data.cells.total_counts <= max_gene
-        data.sub_by_index(cell_index=cell_subset)
+        plan.add(f'total_counts <= {max_gene}', data.cells.total_counts <= max_gene)
     if min_n_genes_by_counts:
-        if data.cells.n_genes_by_counts is None:
-            data.cells.n_genes_by_counts = cal_n_genes_by_counts(data.exp_matrix)
-        cell_subset = data.cells.n_genes_by_counts >= min_n_genes_by_counts
-        data.sub_by_index(cell_index=cell_subset)
+        plan.add(f'n_genes_by_counts >= {min_n_genes_by_counts}',
+                 data.cells.n_genes_by_counts >= min_n_genes_by_counts)
     if max_n_genes_by_counts:
-        if data.cells.n_genes_by_counts is None:
-            data.cells.n_genes_by_counts = cal_n_genes_by_counts(data.exp_matrix)
-        cell_subset = data.cells.n_genes_by_counts <= max_n_genes_by_counts
-        data.sub_by_index(cell_index=cell_subset)
+        plan.add(f'n_genes_by_counts <= {max_n_genes_by_counts}',
+                 data.cells.n_genes_by_counts <= max_n_genes_by_counts)
     if pct_counts_mt:
-        if data.cells.pct_counts_mt is None:
-            data.cells.pct_counts_mt = cal_pct_counts_mt(data, data.exp_matrix, data.cells.total_counts)
-        cell_subset = data.cells.pct_counts_mt <= pct_counts_mt
-        data.sub_by_index(cell_index=cell_subset)
+        plan.add(f'pct_counts_mt <= {pct_counts_mt}', data.cells.pct_counts_mt <= pct_counts_mt)
     if cell_list:
-        cell_subset = np.isin(data.cells.cell_name, cell_list)
-        data.sub_by_index(cell_index=cell_subset)
-    return data
+        plan.add('cell_list', np.isin(data.cells.cell_name, data.cells.encode_names(cell_list)))
+    return plan.apply(data)
 
 
 def filter_genes(data, min_cell=None, max_cell=None, gene_list=None, inplace=True):
     """
-    filter genes based on the numbers of cells.
+    filter genes based on the numbers of cells. All thresholds are combined into one mask and the data is sliced
+    once, the number of genes removed by each threshold is saved in `data.tl.result['filter_genes_report']`.
 
     :param data: StereoExpData object.
     :param min_cell: Minimum number of cells for a gene pass filtering.
@@ -82,21 +140,19 @@ def filter_genes(data, min_cell=None, max_cell=None, gene_list=None, inplace=Tru
     :param inplace: whether inplace the original data or return a new data.
     :return: StereoExpData object.
     """
-    data = data if inplace else copy.deepcopy(data)
+    data = data if inplace else data.view()
     if min_cell is None and max_cell is None and gene_list is None:
         raise ValueError('please set `min_cell` or `max_cell` or `gene_list` or both of them.')
     if data.genes.n_cells is None:
         data.genes.n_cells = cal_n_cells(data.exp_matrix)
+    plan = FilterPlan(len(data.gene_names), kind='genes')
     if min_cell:
-        gene_subset = data.genes.n_cells >= min_cell
-        data.sub_by_index(gene_index=gene_subset)
+        plan.add(f'n_cells >= {min_cell}', data.genes.n_cells >= min_cell)
     if max_cell:
-        gene_subset = data.genes.n_cells <= max_cell
-        data.sub_by_index(gene_index=gene_subset)
+        plan.add(f'n_cells <= {max_cell}', data.genes.n_cells <= max_cell)
     if gene_list:
-        gene_subset = np.isin(data.gene_names, gene_list)
-        data.sub_by_index(gene_index=gene_subset)
-    return data
+        plan.add('gene_list', np.isin(data.gene_names, gene_list))
+    return plan.apply(data)
 
 
 def filter_coordinates(data, min_x=None, max_x=None, min_y=None, max_y=None, inplace=True):
@@ -111,20 +167,20 @@ def filter_coordinates(data, min_x=None, max_x=None, min_y=None, max_y=None, inp
     :param inplace: whether inplace the original data or return a new data.
     :return: StereoExpData object
     """
-    data = data if inplace else copy.deepcopy(data)
+    data = data if inplace else data.view()
     none_param = [i for i in [min_x, min_y, max_x, max_y] if i is None]
     if len(none_param) == 4:
         raise ValueError('Only provide one of the optional parameters `min_x`, `min_y`, `max_x`, `max_y` per call.')
     pos = data.position
-    obs_subset = np.full(pos.shape[0], True)
+    plan = FilterPlan(pos.shape[0], kind='cells')
     if min_x:
-        obs_subset &= pos[:, 0] >= min_x
+        plan.add(f'x >= {min_x}', pos[:, 0] >= min_x)
     if min_y:
-        obs_subset &= pos[:, 1] >= min_y
+        plan.add(f'y >= {min_y}', pos[:, 1] >= min_y)
     if max_x:
-        obs_subset &= pos[:, 0] <= max_x
+        plan.add(f'x <= {max_x}', pos[:, 0] <= max_x)
     if max_y:
-        obs_subset &= pos[:, 1] <= max_y
-    data.sub_by_index(cell_index=obs_subset)
+        plan.add(f'y <= {max_y}', pos[:, 1] <= max_y)
+    plan.apply(data)
     data.genes.n_cells = cal_n_cells(data.exp_matrix)
     return data
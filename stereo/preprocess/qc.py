@@ -7,18 +7,25 @@
 @time:2021/03/26
 """
 from scipy.sparse import issparse
+import numba
 import numpy as np
+from ..core.backed_matrix import BackedCSRMatrix
 
 
 def cal_qc(data):
     """
     calculate three qc index including the number of genes expressed in the count matrix, the total counts per cell
-    and the percentage of counts in mitochondrial genes.
+    and the percentage of counts in mitochondrial genes. The number of cells and the total counts per gene are also
+    calculated for the sparse matrix, which are computed together in one pass over the matrix.
 
     :param data: the StereoExpData object.
     :return: StereoExpData object storing quality control results.
     """
     exp_matrix = data.exp_matrix
+    if isinstance(exp_matrix, BackedCSRMatrix):
+        return _cal_backed_qc(data, exp_matrix)
+    if issparse(exp_matrix):
+        return _cal_sparse_qc(data, exp_matrix.tocsr())
     total_count = cal_total_counts(exp_matrix)
     n_gene_by_count = cal_n_genes_by_counts(exp_matrix)
     pct_counts_mt = cal_pct_counts_mt(data, exp_matrix, total_count)
@@ -28,6 +35,99 @@ def cal_qc(data):
     return data
 
 
+@numba.njit(cache=True, parallel=True)
+def _csr_qc_kernel(data, indices, indptr, is_mt, total_count, mt_count, n_gene_by_count, n_cells, n_counts):
+    """
+    walk the csr arrays once in parallel over the row blocks. Each block accumulates the per gene index into its own
+    row of n_cells and n_counts, which are summed by the caller.
+    """
+    n_rows = len(indptr) - 1
+    n_blocks = n_cells.shape[0]
+    block_size = (n_rows + n_blocks - 1) // n_blocks
+    for b in numba.prange(n_blocks):
+        for i in range(b * block_size, min((b + 1) * block_size, n_rows)):
+            total = total_count.dtype.type(0)
+            mt = total_count.dtype.type(0)
+            for j in range(indptr[i], indptr[i + 1]):
+                value = data[j]
+                gene = indices[j]
+                total += value
+                if is_mt[gene]:
+                    mt += value
+                n_cells[b, gene] += 1
+                n_counts[b, gene] += value
+            total_count[i] = total
+            mt_count[i] = mt
+            n_gene_by_count[i] = indptr[i + 1] - indptr[i]
+
+
+def cal_csr_qc(exp_matrix, is_mt: np.ndarray):
+    """
+    calculate the qc index of a csr matrix in one pass.
+
+    :param exp_matrix: the csr express matrix.
+    :param is_mt: a bool array, True for the mitochondrial genes.
+    :return: total counts, mitochondrial counts and the number of genes per cell, the number of cells and the total
+             counts per gene.
+    """
+    n_rows, n_genes = exp_matrix.shape
+    acc_dtype = np.float64 if exp_matrix.dtype.kind == 'f' else np.int64
+    n_blocks = max(1, min(numba.get_num_threads() * 4, n_rows))
+    total_count = np.zeros(n_rows, dtype=acc_dtype)
+    mt_count = np.zeros(n_rows, dtype=acc_dtype)
+    n_gene_by_count = np.zeros(n_rows, dtype=np.int64)
+    n_cells = np.zeros((n_blocks, n_genes), dtype=np.int64)
+    n_counts = np.zeros((n_blocks, n_genes), dtype=acc_dtype)
+    _csr_qc_kernel(exp_matrix.data, exp_matrix.indices, exp_matrix.indptr, np.asarray(is_mt, dtype=np.bool_),
+                   total_count, mt_count, n_gene_by_count, n_cells, n_counts)
+    return total_count, mt_count, n_gene_by_count, n_cells.sum(0), n_counts.sum(0)
+
+
+def _cal_sparse_qc(data, exp_matrix):
+    total_count, mt_count, n_gene_by_count, n_cells, n_counts = cal_csr_qc(exp_matrix, _get_mt_index(data))
+    data.cells.total_counts = total_count
+    data.cells.pct_counts_mt = mt_count / total_count * 100
+    data.cells.n_genes_by_counts = n_gene_by_count
+    data.genes.n_cells = n_cells
+    data.genes.n_counts = n_counts
+    return data
+
+
+def _cal_backed_qc(data, exp_matrix):
+    """
+    calculate the qc index of the backed express matrix in one pass over the chunks.
+
+    :param data: the StereoExpData object.
+    :param exp_matrix: the backed express matrix.
+    :return: StereoExpData object storing quality control results.
+    """
+    mt_index = _get_mt_index(data)
+    total_count = np.zeros(exp_matrix.shape[0], dtype=np.float64 if exp_matrix.dtype.kind == 'f' else np.int64)
+    mt_count = np.zeros_like(total_count)
+    n_gene_by_count = np.zeros(exp_matrix.shape[0], dtype=np.int64)
+    n_cells = np.zeros(exp_matrix.shape[1], dtype=np.int64)
+    n_counts = np.zeros(exp_matrix.shape[1], dtype=total_count.dtype)
+    for start, end, chunk in exp_matrix.iter_chunks():
+        res = cal_csr_qc(chunk.tocsr(), mt_index)
+        total_count[start:end], mt_count[start:end], n_gene_by_count[start:end] = res[:3]
+        n_cells += res[3]
+        n_counts += res[4]
+    data.cells.total_counts = total_count
+    data.cells.pct_counts_mt = mt_count / total_count * 100
+    data.cells.n_genes_by_counts = n_gene_by_count
+    data.genes.n_cells = n_cells
+    data.genes.n_counts = n_counts
+    return data
+
+
+def _get_mt_index(data):
+    return np.char.startswith(np.char.lower(data.gene_names), prefix='mt-')
+
+
+def _is_sparse(exp_matrix):
+    return issparse(exp_matrix) or isinstance(exp_matrix, BackedCSRMatrix)
+
+
 def cal_total_counts(exp_matrix):
     """
     calculate the total gene counts of per cell.
@@ -68,19 +168,19 @@ def cal_n_cells(exp_matrix):
     :param exp_matrix: the express matrix.
     :return:
     """
-    n_cells = exp_matrix.getnnz(axis=0) if issparse(exp_matrix) else np.count_nonzero(exp_matrix, axis=0)
+    n_cells = exp_matrix.getnnz(axis=0) if _is_sparse(exp_matrix) else np.count_nonzero(exp_matrix, axis=0)
     return n_cells
 
 
 def cal_n_genes_by_counts(exp_matrix):
-    n_genes_by_counts = exp_matrix.getnnz(axis=1) if issparse(exp_matrix) else np.count_nonzero(exp_matrix, axis=1)
+    n_genes_by_counts = exp_matrix.getnnz(axis=1) if _is_sparse(exp_matrix) else np.count_nonzero(exp_matrix, axis=1)
     return n_genes_by_counts
 
 
 def cal_pct_counts_mt(data, exp_matrix, total_count):
     if total_count is None:
         total_count = cal_total_counts(exp_matrix)
-    mt_index = np.char.startswith(np.char.lower(data.gene_names), prefix='mt-')
+    mt_index = _get_mt_index(data)
     mt_count = np.array(exp_matrix[:, mt_index].sum(1)).reshape(-1)
     pct_counts_mt = mt_count / total_count * 100
     return pct_counts_mt
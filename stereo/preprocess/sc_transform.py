@@ -4,7 +4,9 @@
 @author: qindanhua@genomics.cn
 @time:2021/08/24
 """
-from stereo.algorithm.pysctransform import get_hvg_residuals, vst
+from stereo.algorithm.pysctransform import vst, SCTModel
+from stereo.algorithm.pysctransform.pysctransform import stream_residuals, get_clip_range
+from stereo.core.gene import Gene
 # from stereo.core.stereo_exp_data import StereoExpData
 from scipy.sparse import issparse, csr_matrix
 import numpy as np
@@ -18,7 +20,10 @@ def sc_transform(
         filter_hvgs=False,
         res_clip_range="seurat",
         var_features_n=3000,
-        threads=4
+        threads=4,
+        residual_path=None,
+        residual_batch_size=None,
+        model=None,
 ):
     """
     python version sc transform
@@ -36,12 +41,27 @@ def sc_transform(
                     only used when filter_hvgs is true
     :param var_features_n: int
                     Number of variable features to select (for calculating a subset of pearson residuals)
+    :param residual_path: the path of a .npy file to write the residuals incrementally, the express matrix is then a
+                    read-only memmap of the file; default keeps the residuals in memory.
+    :param residual_batch_size: the number of genes per block when computing the residuals.
+    :param model: a fitted SCTModel, only the residuals of its features are computed with its parameters, the
+                  parameters are not fitted again. The features missing in the data are taken as zero counts.
 
     :return: stereoExpData object
     """
     if not issparse(data.exp_matrix):
         data.exp_matrix = csr_matrix(data.exp_matrix)
+    if model is not None:
+        residuals, features = model.apply(
+            data.exp_matrix, data.gene_names, data.cell_names, res_clip_range=res_clip_range if filter_hvgs else None,
+            batch_size=residual_batch_size, residual_path=residual_path
+        )
+        data.exp_matrix = residuals
+        # the features missing in the sample are zero counts in the residuals, so they are not looked up in the sample
+        data.genes = Gene(gene_name=np.asarray(features))
+        return data, {'model': model}
     exclude_poisson = False
+    # only the residual variance of the genes is needed to select the hvgs, so no residuals are stored by vst
     vst_out = vst(
         data.exp_matrix.T,
         gene_names=data.gene_names.tolist(),
@@ -51,16 +71,26 @@ def sc_transform(
         n_genes=n_genes,
         threads=4,
         exclude_poisson=exclude_poisson,
+        residual_features=None if filter_hvgs else "all",
+        residual_batch_size=residual_batch_size,
+        residual_path=None if filter_hvgs else residual_path,
     )
-    residuals = vst_out['residuals'].T
+    genes = vst_out['gene_attr'].index
     if filter_hvgs:
-        residuals = get_hvg_residuals(vst_out, var_features_n, res_clip_range)
-    # return_data = StereoExpData(
-    #     exp_matrix=residuals.values,
-    #     position=data.partitions,
-    #
-    # )
-    data.exp_matrix = residuals.values
-    gene_index = np.isin(data.gene_names, np.array(residuals.columns))
-    data.genes = data.genes.sub_set(gene_index)
+        gene_attr = vst_out['gene_attr'].sort_values(by=['residual_variance'], ascending=False)
+        features = gene_attr.index[:var_features_n]
+        umi = data.exp_matrix[:, data.genes.get_indexer(genes)].T.tocsr()
+        residuals, _, _ = stream_residuals(
+            umi, vst_out['model_matrix'], vst_out['model_parameters_fit'], genes.get_indexer(features),
+            clip_range=get_clip_range(res_clip_range, vst_out['total_cells']), batch_size=residual_batch_size,
+            residual_path=residual_path
+        )
+    else:
+        features = vst_out['residual_genes']
+        residuals = vst_out['residuals']
+        if residual_path is None:
+            residuals = residuals.values.T
+    vst_out['model'] = SCTModel.from_vst(vst_out, features)
+    data.exp_matrix = residuals
+    data.genes = data.genes.sub_set(data.genes.get_indexer(features))
     return data, vst_out
@@ -8,8 +8,9 @@ from ..core.tool_base import ToolBase
 from typing import Optional
 import numpy as np
 import pandas as pd
-from ..algorithm.highly_variable_genes import highly_variable_genes_seurat_v3, highly_variable_genes_single_batch
-from ..utils.hvg_utils import filter_genes
+from ..algorithm.highly_variable_genes import highly_variable_genes_seurat_v3, highly_variable_genes_single_batch, \
+    highly_variable_genes_from_mean_var
+from ..utils.hvg_utils import get_mean_var_grouped
 
 
 class HighlyVariableGenes(ToolBase):
@@ -106,20 +107,19 @@ class HighlyVariableGenes(ToolBase):
                 )
                 df.index = self.data.gene_names
             else:
-                # print('groups not none')
-                batches = set(group_info)
+                # the statistics of all batches are got in one pass over the matrix
+                means, variances, n_cells, batch_sizes = get_mean_var_grouped(
+                    self.data.exp_matrix, group_info.cat.codes.values, len(group_info.cat.categories)
+                )
+                columns = ['means', 'dispersions', 'dispersions_norm', 'highly_variable']
                 df = []
                 gene_list = self.data.gene_names
-                for batch in batches:
-                    data_subset = self.data.exp_matrix[group_info == batch]
-                    # Filter to genes that are in the dataset
-                    # with settings.verbosity.override(Verbosity.error):
-                    #
-                    filt = filter_genes(data_subset, min_cells=1)[0]
-                    data_subset = data_subset[:, filt]
-
-                    hvg = highly_variable_genes_single_batch(
-                        data_subset,
+                for i in np.flatnonzero(batch_sizes):
+                    # Filter to genes that are in the batch
+                    filt = n_cells[i] >= 1
+                    hvg = highly_variable_genes_from_mean_var(
+                        means[i, filt],
+                        variances[i, filt],
                         min_disp=self.min_disp,
                         max_disp=self.max_disp,
                         min_mean=self.min_mean,
@@ -128,23 +128,11 @@ class HighlyVariableGenes(ToolBase):
                         n_bins=self.n_bins,
                         method=self.method,
                     )
-                    hvg.index = gene_list[filt]
-                    # hvg.index = gene_list
                     # Add 0 values for genes that were filtered out
-                    missing_hvg = pd.DataFrame(
-                        np.zeros((np.sum(~filt), len(hvg.columns))),
-                        columns=hvg.columns,
-                    )
-                    missing_hvg['highly_variable'] = missing_hvg['highly_variable'].astype(bool)
-                    missing_hvg['gene'] = gene_list[~filt]
-                    hvg['gene'] = gene_list[filt]
-                    hvg = hvg.append(missing_hvg, ignore_index=True)
-
-                    # Order as before filtering
-                    idxs = np.concatenate((np.where(filt)[0], np.where(~filt)[0]))
-                    hvg = hvg.loc[np.argsort(idxs)]
-
-                    df.append(hvg)
+                    batch_hvg = pd.DataFrame(np.zeros((len(gene_list), len(columns))), columns=columns)
+                    batch_hvg.loc[filt, columns] = hvg[columns].values.astype(np.float64)
+                    batch_hvg['gene'] = gene_list
+                    df.append(batch_hvg)
 
                 df = pd.concat(df, axis=0)
                 df['highly_variable'] = df['highly_variable'].astype(int)
@@ -159,8 +147,8 @@ class HighlyVariableGenes(ToolBase):
                 df.rename(
                     columns=dict(highly_variable='highly_variable_nbatches'), inplace=True
                 )
-                df['highly_variable_intersection'] = df['highly_variable_nbatches'] == len(
-                    batches
+                df['highly_variable_intersection'] = df['highly_variable_nbatches'] == np.count_nonzero(
+                    batch_sizes
                 )
 
                 if self.n_top_genes is not None:
@@ -173,7 +161,7 @@ class HighlyVariableGenes(ToolBase):
                         inplace=True,
                     )
                     df['highly_variable'] = False
-                    df.highly_variable.iloc[:self.n_top_genes] = True
+                    df.iloc[:self.n_top_genes, df.columns.get_loc('highly_variable')] = True
                     df = df.loc[self.data.gene_names]
                 else:
                     df = df.loc[self.data.gene_names]
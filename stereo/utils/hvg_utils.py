@@ -55,71 +55,192 @@ def sparse_mean_variance_axis(mtx: spmatrix, axis: int):
         return sparse_mean_var_minor_axis(mtx.data, mtx.indices, *shape, np.float64)
 
 
-@numba.njit(cache=True)
+@numba.njit(cache=True, parallel=True)
 def sparse_mean_var_major_axis(data, indices, indptr, major_len, minor_len, dtype):
     """
     Computes mean and variance for a sparse array for the major axis.
 
     Given arrays for a csr matrix, returns the means and variances for each
-    row back.
+    row back. The rows are computed in parallel.
     """
     means = np.zeros(major_len, dtype=dtype)
     variances = np.zeros_like(means, dtype=dtype)
 
-    for i in range(major_len):
+    for i in numba.prange(major_len):
         startptr = indptr[i]
         endptr = indptr[i + 1]
         counts = endptr - startptr
 
+        mean = 0.0
         for j in range(startptr, endptr):
-            means[i] += data[j]
-        means[i] /= minor_len
+            mean += data[j]
+        mean /= minor_len
 
+        variance = 0.0
         for j in range(startptr, endptr):
-            diff = data[j] - means[i]
-            variances[i] += diff * diff
+            diff = data[j] - mean
+            variance += diff * diff
 
-        variances[i] += (minor_len - counts) * means[i] ** 2
-        variances[i] /= minor_len
+        variance += (minor_len - counts) * mean ** 2
+        means[i] = mean
+        variances[i] = variance / minor_len
 
     return means, variances
 
 
-@numba.njit(cache=True)
+@numba.njit(cache=True, parallel=True)
 def sparse_mean_var_minor_axis(data, indices, major_len, minor_len, dtype):
     """
     Computes mean and variance for a sparse matrix for the minor axis.
 
     Given arrays for a csr matrix, returns the means and variances for each
-    column back.
+    column back. The non-zero entries are split into one chunk per thread, each
+    chunk is accumulated into its own row and the rows are summed at the end.
     """
     non_zero = indices.shape[0]
+    n_chunks = max(min(numba.get_num_threads(), non_zero), 1)
+    step = (non_zero + n_chunks - 1) // n_chunks
 
-    means = np.zeros(minor_len, dtype=dtype)
-    variances = np.zeros_like(means, dtype=dtype)
-
-    counts = np.zeros(minor_len, dtype=np.int64)
-
-    for i in range(non_zero):
-        col_ind = indices[i]
-        means[col_ind] += data[i]
+    sums = np.zeros((n_chunks, minor_len), dtype=dtype)
+    counts = np.zeros((n_chunks, minor_len), dtype=np.int64)
+    for c in numba.prange(n_chunks):
+        for i in range(c * step, min((c + 1) * step, non_zero)):
+            col_ind = indices[i]
+            sums[c, col_ind] += data[i]
+            counts[c, col_ind] += 1
 
+    means = np.zeros(minor_len, dtype=dtype)
+    for c in range(n_chunks):
+        for i in range(minor_len):
+            means[i] += sums[c, i]
     for i in range(minor_len):
         means[i] /= major_len
 
-    for i in range(non_zero):
-        col_ind = indices[i]
-        diff = data[i] - means[col_ind]
-        variances[col_ind] += diff * diff
-        counts[col_ind] += 1
+    sums[:] = 0
+    for c in numba.prange(n_chunks):
+        for i in range(c * step, min((c + 1) * step, non_zero)):
+            col_ind = indices[i]
+            diff = data[i] - means[col_ind]
+            sums[c, col_ind] += diff * diff
 
+    variances = np.zeros_like(means, dtype=dtype)
     for i in range(minor_len):
-        variances[i] += (major_len - counts[i]) * means[i] ** 2
+        count = 0
+        for c in range(n_chunks):
+            variances[i] += sums[c, i]
+            count += counts[c, i]
+        variances[i] += (major_len - count) * means[i] ** 2
         variances[i] /= major_len
 
     return means, variances
 
 
+@numba.njit(cache=True, parallel=True)
+def sparse_mean_var_grouped(data, indices, indptr, groups, n_groups, minor_len, dtype):
+    """
+    Computes the mean and variance of each column within each group of rows in one pass over a csr matrix.
+
+    The rows are split into one chunk of about the same number of non-zero entries per thread, and each chunk is
+    accumulated into its own (group, column) table. The rows of negative group are skipped.
+
+    Returns the means and variances of shape (n_groups, minor_len), the number of positive entries of each column
+    within each group and the number of rows of each group.
+    """
+    major_len = indptr.shape[0] - 1
+    non_zero = indptr[major_len]
+    n_chunks = max(min(numba.get_num_threads(), major_len), 1)
+    bounds = np.searchsorted(indptr, np.linspace(0, non_zero, n_chunks + 1)).astype(np.int64)
+    bounds[0] = 0
+    bounds[n_chunks] = major_len
+
+    group_sizes = np.zeros(n_groups, dtype=np.int64)
+    for i in range(major_len):
+        if groups[i] >= 0:
+            group_sizes[groups[i]] += 1
+
+    sums = np.zeros((n_chunks, n_groups, minor_len), dtype=dtype)
+    counts = np.zeros((n_chunks, n_groups, minor_len), dtype=np.int64)
+    n_positive = np.zeros((n_chunks, n_groups, minor_len), dtype=np.int64)
+    for c in numba.prange(n_chunks):
+        for i in range(bounds[c], bounds[c + 1]):
+            g = groups[i]
+            if g < 0:
+                continue
+            for j in range(indptr[i], indptr[i + 1]):
+                col_ind = indices[j]
+                sums[c, g, col_ind] += data[j]
+                counts[c, g, col_ind] += 1
+                if data[j] > 0:
+                    n_positive[c, g, col_ind] += 1
+
+    means = np.zeros((n_groups, minor_len), dtype=dtype)
+    for c in range(n_chunks):
+        means += sums[c]
+    for g in range(n_groups):
+        if group_sizes[g] > 0:
+            means[g] /= group_sizes[g]
+
+    sums[:] = 0
+    for c in numba.prange(n_chunks):
+        for i in range(bounds[c], bounds[c + 1]):
+            g = groups[i]
+            if g < 0:
+                continue
+            for j in range(indptr[i], indptr[i + 1]):
+                col_ind = indices[j]
+                diff = data[j] - means[g, col_ind]
+                sums[c, g, col_ind] += diff * diff
+
+    variances = np.zeros((n_groups, minor_len), dtype=dtype)
+    n_cells = np.zeros((n_groups, minor_len), dtype=np.int64)
+    for c in range(n_chunks):
+        variances += sums[c]
+        n_cells += n_positive[c]
+    for g in range(n_groups):
+        for i in range(minor_len):
+            count = 0
+            for c in range(n_chunks):
+                count += counts[c, g, i]
+            variances[g, i] += (group_sizes[g] - count) * means[g, i] ** 2
+            if group_sizes[g] > 0:
+                variances[g, i] /= group_sizes[g]
+
+    return means, variances, n_cells, group_sizes
+
+
+def get_mean_var_grouped(X, groups: np.ndarray, n_groups: int):
+    """
+    get the mean and variance of each gene within each group of cells, with one pass over the matrix.
+
+    :param X: the matrix of cells x genes, csr, csc or np.ndarray.
+    :param groups: the group code of each cell, from 0 to n_groups - 1, negative codes are ignored.
+    :param n_groups: the number of groups.
+
+    :return: the means and the unbiased variances of shape (n_groups, n_genes), the number of cells expressed of
+             each gene within each group and the number of cells of each group.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    if issparse(X):
+        X = X if isinstance(X, csr_matrix) else csr_matrix(X)
+        means, variances, n_cells, group_sizes = sparse_mean_var_grouped(
+            X.data, X.indices, X.indptr, groups, n_groups, X.shape[1], np.float64
+        )
+    else:
+        means = np.zeros((n_groups, X.shape[1]), dtype=np.float64)
+        variances = np.zeros_like(means)
+        n_cells = np.zeros((n_groups, X.shape[1]), dtype=np.int64)
+        group_sizes = np.bincount(groups[groups >= 0], minlength=n_groups)
+        for g in np.flatnonzero(group_sizes):
+            X_group = X[groups == g]
+            means[g] = np.mean(X_group, axis=0, dtype=np.float64)
+            variances[g] = np.multiply(X_group, X_group).mean(axis=0, dtype=np.float64) - means[g] ** 2
+            n_cells[g] = np.sum(X_group > 0, axis=0)
+    # enforce R convention (unbiased estimator) for variance
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variances *= (group_sizes / (group_sizes - 1))[:, None]
+    return means, variances, n_cells, group_sizes
+
+
 def materialize_as_ndarray(a):
     try:
         import dask.array as da
@@ -10,6 +10,8 @@
 change log:
     2021/06/24  create file.
 """
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
 
 
 def idx_chunks_along_axis(shape: tuple, axis: int, chunk_size: int):
@@ -30,3 +32,83 @@ def idx_chunks_along_axis(shape: tuple, axis: int, chunk_size: int):
         cur += chunk_size
     mutable_idx[axis] = slice(cur, None)
     yield tuple(mutable_idx)
+
+
+class SparseMatrixBuilder(object):
+    """
+    accumulate the (row, col, value) triplets chunk by chunk, and build a csr matrix at the end. The duplicated
+    entries are summed inside each chunk and the buffered triplets are compacted whenever they grow beyond twice of the
+    last compacted size, so the peak memory scales with the number of nonzero entries of the output matrix.
+
+    :param dtype: the dtype of the values.
+    :param min_compact_nnz: do not compact the buffer before it holds this number of triplets.
+    """
+    def __init__(self, dtype=np.int32, min_compact_nnz: int = 1 << 22):
+        self.dtype = dtype
+        self.min_compact_nnz = min_compact_nnz
+        self.n_rows = 0
+        self.n_cols = 0
+        self._rows = []
+        self._cols = []
+        self._data = []
+        self._nnz = 0
+        self._compact_nnz = 0
+
+    @property
+    def nnz(self):
+        """
+        get the number of buffered triplets, which is the upper bound of the nnz of the output matrix.
+
+        :return:
+        """
+        return self._nnz
+
+    def add(self, rows: np.ndarray, cols: np.ndarray, values: np.ndarray):
+        """
+        add a chunk of triplets to the builder.
+
+        :param rows: the row indexes of the chunk.
+        :param cols: the column indexes of the chunk.
+        :param values: the values of the chunk.
+        :return:
+        """
+        if len(rows) == 0:
+            return
+        self.n_rows = max(self.n_rows, int(rows.max()) + 1)
+        self.n_cols = max(self.n_cols, int(cols.max()) + 1)
+        chunk = coo_matrix((values.astype(self.dtype, copy=False), (rows, cols)), shape=(self.n_rows, self.n_cols))
+        chunk.sum_duplicates()
+        self._append(chunk)
+        if self._nnz > 2 * max(self._compact_nnz, self.min_compact_nnz):
+            self._compact()
+
+    def _append(self, mtx: coo_matrix):
+        index_dtype = np.int32 if max(self.n_rows, self.n_cols) < np.iinfo(np.int32).max else np.int64
+        self._rows.append(mtx.row.astype(index_dtype, copy=False))
+        self._cols.append(mtx.col.astype(index_dtype, copy=False))
+        self._data.append(mtx.data)
+        self._nnz += mtx.nnz
+
+    def _to_coo(self, shape):
+        mtx = coo_matrix((np.concatenate(self._data) if self._data else np.empty(0, dtype=self.dtype),
+                          (np.concatenate(self._rows) if self._rows else np.empty(0, dtype=np.int32),
+                           np.concatenate(self._cols) if self._cols else np.empty(0, dtype=np.int32))),
+                         shape=shape, dtype=self.dtype)
+        self._rows, self._cols, self._data, self._nnz = [], [], [], 0
+        return mtx
+
+    def _compact(self):
+        mtx = self._to_coo(shape=(self.n_rows, self.n_cols))
+        mtx.sum_duplicates()
+        self._append(mtx)
+        self._compact_nnz = self._nnz
+
+    def to_csr(self, shape: tuple = None) -> csr_matrix:
+        """
+        build the csr matrix from the buffered triplets, the buffer will be released.
+
+        :param shape: the shape of the output matrix, default is the shape grown by the added chunks.
+        :return: a csr matrix.
+        """
+        shape = (self.n_rows, self.n_cols) if shape is None else shape
+        return self._to_coo(shape=shape).tocsr()
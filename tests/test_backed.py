@@ -0,0 +1,77 @@
+"""Tests of the backed exp_matrix read from the h5ad file."""
+import numpy as np
+import pytest
+from scipy import sparse
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.core.backed_matrix import BackedCSRMatrix
+from stereo.io.writer import write_h5ad
+from stereo.io.reader import read_stereo_h5ad
+from stereo.preprocess.qc import cal_qc
+from stereo.preprocess.filter import filter_cells, filter_genes
+
+
+def make_data(out_path):
+    np.random.seed(1)
+    exp_matrix = sparse.random(2000, 100, density=0.1, format='csr', random_state=1)
+    exp_matrix.data = np.ceil(exp_matrix.data * 10)
+    exp_matrix = exp_matrix.astype(np.int32)
+    genes = np.array(['g' + str(i) for i in range(95)] + ['mt-' + str(i) for i in range(5)])
+    cells = np.array(['c' + str(i) for i in range(2000)])
+    position = np.random.randint(0, 100, (len(cells), 2))
+    data = StereoExpData(bin_type='bins', exp_matrix=exp_matrix, genes=genes, cells=cells, position=position,
+                         output=out_path)
+    write_h5ad(data)
+    return data
+
+
+def test_backed_qc_filter(tmp_path):
+    out_path = str(tmp_path / 'test.h5ad')
+    make_data(out_path)
+    data = read_stereo_h5ad(out_path)
+    backed_data = read_stereo_h5ad(out_path, backed='r')
+    assert isinstance(backed_data.exp_matrix, BackedCSRMatrix)
+    backed_data.exp_matrix.chunk_size = 300
+    cal_qc(data)
+    cal_qc(backed_data)
+    for key in ['total_counts', 'pct_counts_mt', 'n_genes_by_counts']:
+        assert np.allclose(data.cells.get_property(key), backed_data.cells.get_property(key))
+    filter_cells(data, min_gene=5, max_gene=30)
+    filter_cells(backed_data, min_gene=5, max_gene=30)
+    filter_genes(data, min_cell=20)
+    filter_genes(backed_data, min_cell=20)
+    assert isinstance(backed_data.exp_matrix, BackedCSRMatrix)
+    assert (backed_data.exp_matrix.to_memory() != data.exp_matrix).nnz == 0
+    assert (backed_data.cell_names == data.cell_names).all()
+    assert (backed_data.gene_names == data.gene_names).all()
+
+
+def test_backed_slice(tmp_path):
+    out_path = str(tmp_path / 'test.h5ad')
+    data = make_data(out_path)
+    backed = BackedCSRMatrix(out_path, chunk_size=7)
+    rows, cols = [5, 3, 3, 1999, 10], [1, 2, 99]
+    assert (backed[rows, :][:, cols].to_memory() != data.exp_matrix[rows][:, cols]).nnz == 0
+    assert np.allclose(backed[100:300].sum(0), data.exp_matrix[100:300].sum(0))
+    assert backed.nnz == data.exp_matrix.nnz
+
+
+def test_backed_write(tmp_path):
+    out_path = str(tmp_path / 'test.h5ad')
+    data = make_data(out_path)
+    backed_data = read_stereo_h5ad(out_path, backed='r')
+    backed_data.exp_matrix.chunk_size = 300
+    filter_cells(backed_data, min_gene=5, max_gene=30)
+    filter_genes(backed_data, min_cell=20)
+    expected = backed_data.exp_matrix.to_memory()
+    # the backing file is not truncated
+    backed_data.output = out_path
+    with pytest.raises(ValueError):
+        write_h5ad(backed_data)
+    assert read_stereo_h5ad(out_path).exp_matrix.shape == data.exp_matrix.shape
+    backed_data.output = str(tmp_path / 'filtered.h5ad')
+    write_h5ad(backed_data)
+    res = read_stereo_h5ad(backed_data.output)
+    assert sparse.isspmatrix_csr(res.exp_matrix) and res.exp_matrix.dtype == expected.dtype
+    assert (res.exp_matrix != expected).nnz == 0
+    assert (res.cell_names == backed_data.cell_names).all()
+    assert (res.gene_names == backed_data.gene_names).all()
@@ -0,0 +1,98 @@
+"""Tests and benchmark of projecting new samples onto a reference embedding."""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.algorithm.embedding import EmbeddingModel
+
+
+def make_data(n_cells=1000, n_genes=200, n_types=5, seed=1, prefix='c'):
+    """log counts of a few cell types, the profiles of the types are the same for every seed."""
+    profiles = np.random.default_rng(0).gamma(0.3, 2, (n_types, n_genes))
+    rng = np.random.default_rng(seed)
+    types = rng.integers(0, n_types, n_cells)
+    exp_matrix = sparse.csr_matrix(rng.poisson(profiles[types]).astype(np.float32))
+    exp_matrix.data = np.log1p(exp_matrix.data)
+    data = StereoExpData(bin_type='bins', exp_matrix=exp_matrix,
+                         genes=np.array(['g' + str(i) for i in range(n_genes)]),
+                         cells=np.array([prefix + str(i) for i in range(n_cells)]),
+                         position=rng.integers(0, 100, (n_cells, 2)))
+    return data, types.astype(str)
+
+
+def fit_reference(n_cells=1000, n_genes=200, metric='euclidean'):
+    ref, types = make_data(n_cells, n_genes)
+    ref.tl.pca(use_highly_genes=False, n_pcs=10)
+    ref.tl.neighbors(pca_res_key='pca', n_neighbors=15, metric=metric)
+    ref.tl.umap(pca_res_key='pca', neighbors_res_key='neighbors')
+    return ref, types
+
+
+def test_project(tmp_path):
+    ref, ref_types = fit_reference()
+    model = ref.tl.result['umap_model']
+    assert model.x_umap.shape == (1000, 2) and model.n_neighbors == 15
+    # the reference is projected onto itself
+    assert np.allclose(model.project(ref.exp_matrix, ref.gene_names), ref.tl.result['pca'].values, atol=1e-3)
+
+    query, query_types = make_data(300, seed=2, prefix='q')
+    # the genes in another order, some genes are missing
+    gene_index = np.random.default_rng(3).permutation(200)[:190]
+    query = query.sub_by_index(gene_index=gene_index)
+    query.tl.project(model, labels=ref_types)
+    assert query.tl.result['pca'].shape == (300, 10)
+    assert (query.tl.result['cluster']['bins'] == query.cell_names).all()
+    assert (query.tl.result['cluster']['group'].astype(str).values == query_types).mean() > 0.95
+
+    # the query cells are placed next to the reference cells of the same type
+    x_umap = ref.tl.result['umap'].values
+    centers = pd.DataFrame(x_umap).groupby(ref_types).mean()
+    query_umap = query.tl.result['umap'].values
+    nearest = centers.index[np.argmin(((query_umap[:, None] - centers.values[None]) ** 2).sum(-1), axis=1)]
+    assert (nearest == query_types).mean() > 0.95
+
+    model.save(str(tmp_path / 'model.h5'))
+    loaded = EmbeddingModel.load(str(tmp_path / 'model.h5'))
+    res = loaded.transform(query, labels=ref_types)
+    assert np.allclose(res['pca'].values, query.tl.result['pca'].values)
+    assert np.allclose(res['umap'].values, query_umap)
+    assert loaded.n_pcs == model.n_pcs and loaded.metric == model.metric
+
+    # the pca model has no umap
+    res = ref.tl.result['pca_model'].transform(query)
+    assert set(res.keys()) == {'pca'}
+
+
+def test_cosine_reference():
+    ref, ref_types = fit_reference(metric='cosine')
+    assert ref.tl.result['neighbors']['neighbor'].metric == 'cosine'
+    model = ref.tl.result['umap_model']
+    assert model.metric == 'cosine'
+    # the query cells are searched by the metric of the reference graph
+    x_pca = ref.tl.result['pca'].values
+    indices, _ = model.kneighbors(x_pca[:100])
+    expected = NearestNeighbors(n_neighbors=15, metric='cosine').fit(x_pca).kneighbors(x_pca[:100],
+                                                                                      return_distance=False)
+    assert (np.sort(indices, axis=1) == np.sort(expected, axis=1)).mean() > 0.99
+    query, query_types = make_data(300, seed=2, prefix='q')
+    query.tl.project(model, labels=ref_types)
+    assert (query.tl.result['cluster']['group'].astype(str).values == query_types).mean() > 0.95
+
+
+def benchmark(n_ref=50000, n_query=5000):
+    start = time.time()
+    ref, ref_types = fit_reference(n_ref, 500)
+    print(f'fit the reference of {n_ref} cells: {time.time() - start:.2f}s')
+    model = ref.tl.result['umap_model']
+    query, _ = make_data(n_query, 500, seed=2, prefix='q')
+    for i in range(2):
+        start = time.time()
+        query.tl.project(model, labels=ref_types)
+        print(f'project {n_query} cells: {time.time() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    benchmark(*[int(i) for i in sys.argv[1:]])
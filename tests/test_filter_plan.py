@@ -0,0 +1,62 @@
+"""Tests of filtering cells and genes by one combined mask."""
+import copy
+import numpy as np
+from scipy import sparse
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.preprocess.filter import filter_cells, filter_genes, filter_coordinates
+from stereo.preprocess.qc import cal_qc
+
+
+def make_data(n_cells=2000, n_genes=100):
+    np.random.seed(1)
+    exp_matrix = sparse.random(n_cells, n_genes, density=0.1, format='csr', random_state=1)
+    exp_matrix.data = np.ceil(exp_matrix.data * 10)
+    genes = np.array(['g' + str(i) for i in range(n_genes - 5)] + ['mt-' + str(i) for i in range(5)])
+    cells = np.array(['c' + str(i) for i in range(n_cells)])
+    position = np.random.randint(0, 100, (n_cells, 2))
+    return StereoExpData(bin_type='bins', exp_matrix=exp_matrix, genes=genes, cells=cells, position=position)
+
+
+def test_filter_cells():
+    data = make_data()
+    params = dict(min_gene=30, max_gene=70, min_n_genes_by_counts=6, max_n_genes_by_counts=14, pct_counts_mt=15,
+                  cell_list=list(data.cell_names[100:1800]))
+    expected = copy.deepcopy(data)
+    for key, value in params.items():
+        filter_cells(expected, **{key: value})
+    res = filter_cells(data, **params)
+    assert (res.exp_matrix != expected.exp_matrix).nnz == 0
+    assert (res.cell_names == expected.cell_names).all()
+    assert (res.position == expected.position).all()
+    assert np.allclose(res.cells.pct_counts_mt, expected.cells.pct_counts_mt)
+    report = res.tl.result['filter_cells_report']
+    assert len(report) == len(params)
+    assert report['n_removed'].sum() == 2000 - len(res.cell_names)
+    assert (report['n_failed'] >= report['n_removed']).all()
+    assert report['n_failed'].iloc[-1] == 300
+
+
+def test_filter_genes():
+    data = make_data()
+    expected = copy.deepcopy(data)
+    filter_genes(expected, min_cell=195)
+    filter_genes(expected, max_cell=210)
+    res = filter_genes(data, min_cell=195, max_cell=210)
+    assert (res.exp_matrix != expected.exp_matrix).nnz == 0
+    assert (res.gene_names == expected.gene_names).all()
+    assert res.tl.result['filter_genes_report']['n_removed'].sum() == 100 - len(res.gene_names)
+    res = filter_coordinates(make_data(), min_x=10, max_y=80)
+    assert (res.position[:, 0] >= 10).all() and (res.position[:, 1] <= 80).all()
+
+
+def test_gene_qc_after_cell_subset():
+    data = make_data()
+    cal_qc(data)
+    sub_data = copy.deepcopy(data).sub_by_index(cell_index=np.arange(10))
+    view = data.view(cell_index=np.arange(10))
+    named_view = data.sub_by_name(cell_name=data.cell_names[:10])
+    for res in [sub_data, view, named_view]:
+        assert res.genes.n_cells is None and res.genes.n_counts is None
+        filter_genes(res, min_cell=2)
+        assert (res.gene_names == data.gene_names[data.exp_matrix[:10].getnnz(axis=0) >= 2]).all()
+    assert (data.genes.n_cells == data.exp_matrix.getnnz(axis=0)).all()
@@ -0,0 +1,139 @@
+"""Check the vectorized GEF build path and the tile index against the per-element loop, and benchmark them."""
+import sys
+import time
+import h5py
+import numpy as np
+from stereo.io.gef import GEF, GEFTileIndex
+
+
+def make_gef(path, n_genes=200, n_exp=100000, width=2000, bin_size=100):
+    """
+    write a synthetic gef file, the expression records of each gene are stored contiguously.
+    """
+    np.random.seed(1)
+    gene_count = np.random.multinomial(n_exp, np.ones(n_genes) / n_genes).astype('uint32')
+    gene_offset = (np.cumsum(gene_count) - gene_count).astype('uint32')
+    gene = np.zeros(n_genes, dtype=[('gene', 'S32'), ('offset', 'uint32'), ('count', 'uint32')])
+    gene['gene'] = [f'g{i}'.encode() for i in range(n_genes)]
+    gene['offset'] = gene_offset
+    gene['count'] = gene_count
+    exp = np.zeros(n_exp, dtype=[('x', 'uint32'), ('y', 'uint32'), ('count', 'uint16')])
+    exp['x'] = np.random.randint(0, width, n_exp)
+    exp['y'] = np.random.randint(0, width, n_exp)
+    exp['count'] = np.random.randint(1, 10, n_exp)
+    with h5py.File(path, mode='w') as h5f:
+        grp = h5f.create_group(f'geneExp/bin{bin_size}')
+        grp.create_dataset('expression', data=exp)
+        grp.create_dataset('gene', data=gene)
+    return path
+
+
+class LoopGEF(GEF):
+    """
+    the GEF build path with per-element python loops, which is used as the reference.
+    """
+    def build(self, gene_lst: list = None, region: list = None):
+        if gene_lst is not None:
+            self._restrict_to_genes(gene_lst)
+        if region is not None:
+            self._restrict_to_region(region)
+        if gene_lst is None and region is None:
+            self.genes = self.df_gene['gene'].values
+            self.gene_num = len(self.genes)
+            cols = np.zeros((self.df_exp.shape[0],), dtype='uint32')
+            exp_index = 0
+            for gene_index, count in enumerate(self.df_gene['count']):
+                for i in range(count):
+                    cols[exp_index] = gene_index
+                    exp_index += 1
+            self.df_exp['gene_index'] = cols
+        self.df_exp['cell_id'] = np.bitwise_or(
+            np.left_shift(self.df_exp['x'].astype('uint64'), 32), self.df_exp['y'])
+        self.cells = self.df_exp['cell_id'].unique()
+        self.cell_num = len(self.cells)
+        rows = np.zeros((self.df_exp.shape[0],), dtype='uint32')
+        grp = self.df_exp.groupby('cell_id').groups
+        for i, cell_id in enumerate(self.cells):
+            for j in grp[cell_id]:
+                rows[j] = i
+        self.df_exp['cell_index'] = rows
+
+    def _restrict_to_region(self, region):
+        gene_col = []
+        for row in self.df_gene.itertuples():
+            for i in range(getattr(row, 'count')):
+                gene_col.append(getattr(row, 'gene'))
+        self.df_exp['gene'] = gene_col
+        self.df_exp = self.df_exp.query(f'{region[0]} <= x <= {region[1]} and {region[2]} <= y <= {region[3]}')
+        self.genes = self.df_exp['gene'].unique()
+        self.gene_num = len(self.genes)
+        genes_dict = dict(zip(self.genes, range(0, self.gene_num)))
+        self.df_exp['gene_index'] = self.df_exp['gene'].map(genes_dict)
+        self.df_exp = self.df_exp.reset_index(drop=True)
+
+    def _restrict_to_genes(self, gene_lst):
+        cols = np.zeros((self.df_exp.shape[0],), dtype='uint32')
+        offset_indexes = np.zeros((self.df_exp.shape[0],), dtype='uint32')
+        self.df_gene = self.df_gene.set_index('gene').loc[gene_lst].reset_index()
+        self.genes = self.df_gene['gene'].values
+        self.gene_num = len(self.genes)
+        exp_index = 0
+        for gene_index, row in enumerate(self.df_gene.itertuples()):
+            for i in range(getattr(row, 'count')):
+                cols[exp_index] = gene_index
+                offset_indexes[exp_index] = getattr(row, 'offset') + i
+                exp_index += 1
+        self.df_exp = self.df_exp.loc[offset_indexes[:exp_index]]
+        self.df_exp['gene_index'] = cols[:exp_index]
+        self.df_exp = self.df_exp.reset_index(drop=True)
+
+
+def build(gef_class, path, gene_lst=None, region=None):
+    start = time.time()
+    gef = gef_class(file_path=path, bin_size=100)
+    gef.build(gene_lst=gene_lst, region=region)
+    data = gef.to_stereo_exp_data()
+    return data, time.time() - start
+
+
+def compare(path, gene_lst=None, region=None):
+    data, cost = build(GEF, path, gene_lst, region)
+    loop_data, loop_cost = build(LoopGEF, path, gene_lst, region)
+    assert (data.exp_matrix != loop_data.exp_matrix).nnz == 0
+    assert (data.cell_names == loop_data.cell_names).all()
+    assert (data.gene_names == loop_data.gene_names).all()
+    assert (data.position == loop_data.position).all()
+    return cost, loop_cost
+
+
+def test_build(tmp_path):
+    path = make_gef(str(tmp_path / 'test.gef'), n_exp=20000)
+    gene_lst = [b'g3', b'g10', b'g7']
+    region = [100, 900, 300, 1200]
+    compare(path)
+    compare(path, gene_lst=gene_lst)
+    compare(path, region=region)
+    compare(path, gene_lst=gene_lst, region=region)
+
+
+def test_tile_index(tmp_path):
+    path = make_gef(str(tmp_path / 'test.gef'), n_exp=20000)
+    gef_index = GEFTileIndex(path, bin_size=100, tile_size=100)
+    assert not gef_index.is_valid()
+    for region, gene_lst in [([100, 900, 300, 1200], None), ([0, 2000, 0, 2000], None),
+                             ([150, 420, 0, 380], [b'g3', b'g10', b'g7']), ([5000, 6000, 0, 10], None)]:
+        data, _ = build(GEF, path, gene_lst, region)
+        index_data = gef_index.query(region=region, gene_lst=gene_lst)
+        assert gef_index.is_valid()
+        # the cells are in the same order as the full scan
+        assert (data.exp_matrix != index_data.exp_matrix).nnz == 0
+        assert (data.position == index_data.position).all()
+        assert (data.cell_names == index_data.cell_names).all()
+        assert (data.gene_names == index_data.gene_names).all()
+
+
+if __name__ == '__main__':
+    path = make_gef(sys.argv[1], n_genes=2000, n_exp=int(sys.argv[2]) if len(sys.argv) > 2 else 2000000)
+    for params in [{}, {'region': [0, 1000, 0, 1000]}, {'gene_lst': [f'g{i}'.encode() for i in range(0, 2000, 2)]}]:
+        vectorized_cost, loop_cost = compare(path, **params)
+        print(f'{", ".join(params) or "all"}: vectorized {vectorized_cost:.2f}s, loop {loop_cost:.2f}s')
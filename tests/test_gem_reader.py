@@ -0,0 +1,192 @@
+"""Tests and benchmark of reading gem files by chunk, the cell hulls, rebinning and reading many files."""
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point, MultiPoint
+from stereo.io.reader import read_gem, read_stereo_h5ad, read_many, parse_cell_bin_coor, parse_cell_bin_hull
+from stereo.io.multi_bin import MultiBinReader
+from stereo.io.writer import write_h5ad
+
+
+def make_gem(path, n=20000, genes=None, seed=1):
+    np.random.seed(seed)
+    genes = ['g' + str(i) for i in range(50)] if genes is None else genes
+    df = pd.DataFrame({
+        'geneID': np.random.choice(genes, n),
+        'x': np.random.randint(100, 1000, n),
+        'y': np.random.randint(50, 800, n),
+        'MIDCount': np.random.randint(1, 5, n),
+    })
+    df['label'] = (df['x'] // 40) * 100 + df['y'] // 40
+    with open(path, 'w') as f:
+        f.write('#FileFormat=GEMv0.1\n')
+        df.to_csv(f, sep='\t', index=False)
+    return path
+
+
+def compare_data(data, chunk_data):
+    assert (data.exp_matrix != chunk_data.exp_matrix).nnz == 0
+    assert (data.cell_names == chunk_data.cell_names).all()
+    assert (data.gene_names == chunk_data.gene_names).all()
+    assert np.allclose(data.position, chunk_data.position)
+
+
+def test_read_gem_by_chunk(tmp_path):
+    path = make_gem(str(tmp_path / 'test.gem'))
+    data = read_gem(path, bin_type='bins', bin_size=100)
+    chunk_data = read_gem(path, bin_type='bins', bin_size=100, chunk_size=3000)
+    compare_data(data, chunk_data)
+
+
+def test_read_gem_with_blank_values(tmp_path):
+    path = make_gem(str(tmp_path / 'test.gem'))
+    lines = open(path).read().splitlines()
+    # a blank geneID, a blank count and a blank label
+    lines[5] = '\t' + lines[5].split('\t', 1)[1]
+    lines[10] = '\t'.join(lines[10].split('\t')[:3] + ['', lines[10].split('\t')[4]])
+    lines[15] = '\t'.join(lines[15].split('\t')[:4] + [''])
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    for bin_type in ['bins', 'cell_bins']:
+        data = read_gem(path, bin_type=bin_type, bin_size=100)
+        chunk_data = read_gem(path, bin_type=bin_type, bin_size=100, chunk_size=3000)
+        compare_data(data, chunk_data)
+        assert data.exp_matrix.sum() == pd.read_csv(path, sep='\t', comment='#').dropna()['MIDCount'].sum()
+
+
+def test_read_cell_bin_gem_by_chunk(tmp_path):
+    path = make_gem(str(tmp_path / 'test.gem'))
+    data = read_gem(path, bin_type='cell_bins')
+    chunk_data = read_gem(path, bin_type='cell_bins', chunk_size=3000)
+    compare_data(data, chunk_data)
+
+
+def test_coor_id(tmp_path):
+    path = make_gem(str(tmp_path / 'test.gem'))
+    data = read_gem(path, bin_type='bins', bin_size=20)
+    assert data.cell_names.dtype == np.uint64
+    names = data.cells.get_str_names()
+    df = pd.read_csv(path, sep='\t', comment='#')
+    bin_names = ((df['x'] - df['x'].min()) // 20).astype(str) + '_' + ((df['y'] - df['y'].min()) // 20).astype(str)
+    assert (names == bin_names.unique()).all()
+    sub_data = data.sub_by_name(cell_name=names[[5, 1, 3]])
+    assert (sub_data.cell_names == data.cell_names[[5, 1, 3]]).all()
+
+
+def test_rebin(tmp_path):
+    path = make_gem(str(tmp_path / 'test.gem'))
+    bin1 = read_gem(path, bin_type='bins', bin_size=1)
+    for bin_size in [20, 50, 100]:
+        compare_data(read_gem(path, bin_type='bins', bin_size=bin_size), bin1.rebin(bin_size))
+    compare_data(read_gem(path, bin_type='bins', bin_size=200),
+                 read_gem(path, bin_type='bins', bin_size=50).rebin(200))
+
+    # the grid starts at the min coordinates of the file after the filtering and the round trip through h5ad
+    expected = read_gem(path, bin_type='bins', bin_size=100)
+    expected200 = read_gem(path, bin_type='bins', bin_size=200)
+    for chunk_size in [None, 3000]:
+        bin1 = read_gem(path, bin_type='bins', bin_size=1, chunk_size=chunk_size)
+        bin1.sub_by_index(cell_index=np.flatnonzero((bin1.position[:, 0] > 250) & (bin1.position[:, 1] > 170)))
+        bin1.output = str(tmp_path / 'bin1.h5ad')
+        write_h5ad(bin1)
+        res = read_stereo_h5ad(bin1.output)
+        assert res.bin_size == 1 and (res.bin_origin == [100, 50]).all()
+        for data in [bin1, res, res.view()]:
+            rebinned = data.rebin(100)
+            index = expected.cells.get_indexer(rebinned.cell_names)
+            assert (index >= 0).all()
+            assert (rebinned.position == expected.position[index]).all()
+        rebinned.output = str(tmp_path / 'bin100.h5ad')
+        write_h5ad(rebinned)
+        res = read_stereo_h5ad(rebinned.output)
+        assert res.bin_size == 100
+        rebinned = res.rebin(200)
+        index = expected200.cells.get_indexer(rebinned.cell_names)
+        assert (index >= 0).all() and (rebinned.position == expected200.position[index]).all()
+
+
+def test_multi_bin_reader(tmp_path):
+    path = make_gem(str(tmp_path / 'test.gem'))
+    reader = MultiBinReader(path, cache_dir=str(tmp_path / 'cache'))
+    levels = reader.read_many((20, 100, 200))
+    assert sorted(reader.levels) == [1, 20, 100, 200]
+    for bin_size, data in levels.items():
+        compare_data(read_gem(path, bin_type='bins', bin_size=bin_size), data)
+    cached = MultiBinReader(path, cache_dir=str(tmp_path / 'cache')).read(100)
+    compare_data(levels[100], cached)
+
+
+def test_read_many(tmp_path):
+    paths = [make_gem(str(tmp_path / 'a.gem')),
+             make_gem(str(tmp_path / 'b.gem'), n=5000, genes=['g' + str(i) for i in range(30, 80)], seed=2)]
+    samples = [read_gem(path, bin_size=50) for path in paths]
+    for n_jobs in [1, 2]:
+        data = read_many(paths, sample_names=['a', 'b'], n_jobs=n_jobs, position_gap=100, bin_size=50)
+        assert data.exp_matrix.shape == (sum(s.exp_matrix.shape[0] for s in samples), 80)
+        assert (data.cells.sample == np.repeat(['a', 'b'], [s.exp_matrix.shape[0] for s in samples])).all()
+        start = 0
+        for sample, name in zip(samples, ['a', 'b']):
+            end = start + sample.exp_matrix.shape[0]
+            sub_matrix = data.exp_matrix[start:end][:, [list(data.gene_names).index(g) for g in sample.gene_names]]
+            assert (sub_matrix != sample.exp_matrix).nnz == 0
+            assert data.exp_matrix[start:end].sum() == sample.exp_matrix.sum()
+            assert (data.cell_names[start:end] == np.char.add(sample.cells.get_str_names(), '-' + name)).all()
+            start = end
+        n_a = samples[0].exp_matrix.shape[0]
+        assert (data.position[:n_a] == samples[0].position).all()
+        assert data.position[n_a:, 0].min() == data.position[:n_a, 0].max() + 100
+    assert data.cells.get_indexer([data.cell_names[-1]])[0] == len(data.cell_names) - 1
+    data = read_many(paths, sample_names=['a', 'b'], index_unique=None, bin_size=50)
+    assert (data.cell_names == np.concatenate([s.cells.get_str_names() for s in samples])).all()
+    # the files of mixed formats share the kwargs
+    samples[0].output = str(tmp_path / 'a.h5ad')
+    write_h5ad(samples[0])
+    data = read_many([samples[0].output, paths[1]], bin_size=50)
+    assert data.exp_matrix.shape[0] == sum(s.exp_matrix.shape[0] for s in samples)
+    with pytest.raises(TypeError):
+        read_many(paths, bin_size=50, binsize=50)
+
+
+def groupby_hull(df):
+    """
+    the per-cell shapely path, which is used as the reference.
+    """
+    return df.groupby('cell_id', sort=False).apply(
+        lambda x: MultiPoint([Point(i) for i in zip(x['x'], x['y'])]).convex_hull)
+
+
+def test_cell_bin_hull(tmp_path):
+    path = make_gem(str(tmp_path / 'test.gem'))
+    df = pd.read_csv(path, sep='\t', comment='#').rename(columns={'label': 'cell_id'})
+    data = read_gem(path, bin_type='cell_bins')
+    assert not hasattr(data.cells, 'cell_point')
+    gdf = parse_cell_bin_coor(df)
+    mean = df.groupby('cell_id', sort=False)[['x', 'y']].mean()
+    assert np.allclose(gdf.values, mean.values)
+    assert np.allclose(data.position, mean.values)
+    expected = groupby_hull(df).values
+    lazy = parse_cell_bin_hull(df, 'lazy')
+    assert lazy[3].equals(expected[3])
+    assert lazy[-1].equals(expected[-1]) and lazy[-len(lazy)].equals(expected[0])
+    assert all(hull.equals(e) for hull, e in zip(lazy[-3:], expected[-3:]))
+    for index in [len(lazy), -len(lazy) - 1]:
+        with pytest.raises(IndexError):
+            lazy[index]
+    eager = parse_cell_bin_hull(df, 'eager', n_jobs=2)
+    assert all(hull.equals(e) for hull, e in zip(eager, expected))
+    chunk_data = read_gem(path, bin_type='cell_bins', chunk_size=3000, cell_hull='lazy')
+    assert all(hull.equals(e) for hull, e in zip(chunk_data.cells.cell_point, expected))
+
+
+if __name__ == '__main__':
+    path = make_gem(sys.argv[1], n=int(sys.argv[2]) if len(sys.argv) > 2 else 5000000)
+    df = pd.read_csv(path, sep='\t', comment='#').rename(columns={'label': 'cell_id'})
+    for name, func in [('centroids', lambda: parse_cell_bin_coor(df)),
+                       ('hulls', lambda: parse_cell_bin_hull(df, 'eager')),
+                       ('hulls x4 processes', lambda: parse_cell_bin_hull(df, 'eager', n_jobs=4)),
+                       ('groupby hulls', lambda: groupby_hull(df))]:
+        start = time.time()
+        func()
+        print(f'{name}: {time.time() - start:.2f}s')
@@ -0,0 +1,122 @@
+"""Tests and benchmark of writing the results and the write profile into the stereo h5ad file."""
+import os
+import sys
+import time
+import h5py
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.algorithm.neighbors import Neighbors
+from stereo.io.writer import write_h5ad
+from stereo.io.h5ad import WriteProfile
+from stereo.io.reader import read_stereo_h5ad
+
+
+def make_data(out_path):
+    np.random.seed(1)
+    exp_matrix = sparse.random(100, 20, density=0.2, format='csr', random_state=1)
+    genes = np.array(['g' + str(i) for i in range(20)])
+    cells = np.array(['c' + str(i) for i in range(100)])
+    position = np.random.randint(0, 100, (len(cells), 2))
+    data = StereoExpData(bin_type='bins', exp_matrix=exp_matrix, genes=genes, cells=cells, position=position,
+                         output=out_path)
+    return data
+
+
+def test_write_result(tmp_path):
+    data = make_data(str(tmp_path / 'test.h5ad'))
+    data.tl.raw_checkpoint()
+    data.exp_matrix = data.exp_matrix.log1p()
+    neighbor = Neighbors(x=None, n_neighbors=10, n_pcs=None, method='umap', metric='euclidean', knn=True,
+                         random_state=0)
+    connectivities = sparse.random(100, 100, density=0.1, format='csr', random_state=2)
+    data.tl.result = {
+        'pca': pd.DataFrame(np.random.rand(100, 5)),
+        'neighbors': {'neighbor': neighbor, 'connectivities': connectivities, 'nn_dist': connectivities},
+        'cluster': pd.DataFrame({'bins': data.cell_names, 'group': pd.Categorical(np.random.choice(['1', '2'], 100))}),
+        'marker_genes': {'1.vs.rest': pd.DataFrame({'scores': np.random.rand(20), 'genes': data.gene_names})},
+        'unsupported': object(),
+    }
+    write_h5ad(data)
+
+    res = read_stereo_h5ad(data.output)
+    assert set(res.tl.result.keys()) == {'pca', 'neighbors', 'cluster', 'marker_genes'}
+    pd.testing.assert_frame_equal(res.tl.result['pca'], data.tl.result['pca'])
+    assert (res.tl.result['neighbors']['connectivities'] != connectivities).nnz == 0
+    assert res.tl.result['neighbors']['neighbor'].n_neighbors == 10
+    assert (res.tl.result['cluster']['group'] == data.tl.result['cluster']['group']).all()
+    assert (res.tl.result['marker_genes']['1.vs.rest']['genes'] == data.gene_names).all()
+    assert (res.tl.raw.exp_matrix != data.tl.raw.exp_matrix).nnz == 0
+    assert (res.exp_matrix != data.exp_matrix).nnz == 0
+
+    res = read_stereo_h5ad(data.output, use_raw=False, use_result=False)
+    assert res.tl.raw is None and not res.tl.result
+
+
+def test_write_profile(tmp_path):
+    data = make_data(str(tmp_path / 'test.h5ad'))
+    data.exp_matrix = sparse.random(5000, 20, density=0.2, format='csr', random_state=1)
+    data.cells = data.cells.__class__(np.array(['c' + str(i) for i in range(5000)]))
+    data.position = np.random.randint(0, 1000, (5000, 2))
+    for profile in [WriteProfile(chunk_size=1000, n_jobs=1), WriteProfile(chunk_size=1000, n_jobs=4),
+                    WriteProfile(chunk_size=1000, compression_opts=9, shuffle=False, n_jobs=4),
+                    WriteProfile(chunk_size=777, compression='lzf', float32=True)]:
+        write_h5ad(data, profile=profile)
+        with h5py.File(data.output, mode='r') as f:
+            assert f['exp_matrix/data'].chunks == (profile.chunk_size,)
+            assert f['exp_matrix/data'].compression == profile.compression
+            assert f['exp_matrix/data'].dtype == (np.float32 if profile.float32 else np.float64)
+        res = read_stereo_h5ad(data.output)
+        assert np.allclose(res.exp_matrix.toarray(), data.exp_matrix.toarray())
+        assert (res.position == data.position).all()
+        backed = read_stereo_h5ad(data.output, backed='r')
+        assert np.allclose(backed.exp_matrix[100:2000].toarray(), data.exp_matrix[100:2000].toarray())
+
+
+def test_write_profile_dense(tmp_path):
+    # the chunk of a big dense matrix is capped by bytes, under the 4GB limit of hdf5
+    chunks = WriteProfile().chunk_shape((70000, 20000), np.float32)
+    assert np.prod(chunks) * 4 <= 1 << 20 and chunks[1] == 20000
+    chunks = WriteProfile().chunk_shape((100, 1 << 20), np.float64)
+    assert chunks == (1, 1 << 17)
+    data = make_data(str(tmp_path / 'test.h5ad'))
+    data.exp_matrix = np.random.default_rng(1).random((300, 3000))
+    data.cells = data.cells.__class__(np.array(['c' + str(i) for i in range(300)]))
+    data.genes = data.genes.__class__(np.array(['g' + str(i) for i in range(3000)]))
+    data.position = np.random.randint(0, 1000, (300, 2))
+    for profile in [WriteProfile(chunk_bytes=10000, n_jobs=1), WriteProfile(chunk_bytes=10000, n_jobs=4),
+                    WriteProfile(chunk_bytes=100000, n_jobs=4)]:
+        write_h5ad(data, profile=profile)
+        with h5py.File(data.output, mode='r') as f:
+            chunks = f['exp_matrix'].chunks
+            assert np.prod(chunks) * 8 <= profile.chunk_bytes
+        assert chunks == ((1, 1250) if profile.chunk_bytes == 10000 else (4, 3000))
+        res = read_stereo_h5ad(data.output)
+        assert (res.exp_matrix == data.exp_matrix).all()
+        assert (res.position == data.position).all()
+
+
+def benchmark(out_path, n_cells=200000, n_genes=2000):
+    data = make_data(out_path)
+    data.exp_matrix = sparse.random(n_cells, n_genes, density=0.05, format='csr', random_state=1)
+    data.exp_matrix.data = np.ceil(data.exp_matrix.data * 10)
+    data.cells = data.cells.__class__(np.array(['c' + str(i) for i in range(n_cells)]))
+    data.genes = data.genes.__class__(np.array(['g' + str(i) for i in range(n_genes)]))
+    data.position = np.random.randint(0, 30000, (n_cells, 2))
+    profiles = {
+        'contiguous': None,
+        'gzip4': WriteProfile(n_jobs=1),
+        'gzip4 x8 threads': WriteProfile(n_jobs=8),
+        'gzip1 x8 threads': WriteProfile(compression_opts=1, n_jobs=8),
+        'gzip4 float32 x8 threads': WriteProfile(float32=True, n_jobs=8),
+        'lzf': WriteProfile(compression='lzf'),
+    }
+    for name, profile in profiles.items():
+        start = time.time()
+        write_h5ad(data, profile=profile)
+        print(f'{name}: {time.time() - start:.2f}s, {os.path.getsize(out_path) / 1024 ** 2:.1f}MB')
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
@@ -0,0 +1,105 @@
+"""Tests and benchmark of the mean and variance kernels of the highly variable genes."""
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.tools.highly_variable_genes import HighlyVariableGenes
+from stereo.algorithm.highly_variable_genes import highly_variable_genes_single_batch
+from stereo.utils.hvg_utils import get_mean_var, get_mean_var_grouped, filter_genes
+
+
+def make_data(n_cells=3000, n_genes=500, n_batches=4):
+    rng = np.random.default_rng(1)
+    exp_matrix = sparse.random(n_cells, n_genes, density=0.05, format='csr', random_state=rng)
+    exp_matrix.data = np.log1p(np.ceil(exp_matrix.data * 10))
+    batch = rng.integers(0, n_batches, n_cells)
+    # the first genes are not expressed in the first batch
+    mask = np.ones((n_cells, n_genes))
+    mask[batch == 0, :5] = 0
+    exp_matrix = exp_matrix.multiply(mask).tocsr()
+    exp_matrix.eliminate_zeros()
+    genes = np.array(['g' + str(i) for i in range(n_genes)])
+    cells = np.array(['c' + str(i) for i in range(n_cells)])
+    data = StereoExpData(bin_type='bins', exp_matrix=exp_matrix, genes=genes, cells=cells,
+                         position=rng.integers(0, 100, (n_cells, 2)))
+    groups = pd.DataFrame({'group': batch.astype(str)}, index=cells)
+    return data, groups
+
+
+def hvg_by_batch(data, groups, **kwargs):
+    """the per-batch loop of HighlyVariableGenes.fit before the grouped pass."""
+    group_info = groups['group'].astype('category')
+    df = []
+    gene_list = data.gene_names
+    for batch in set(group_info):
+        data_subset = data.exp_matrix[(group_info == batch).values]
+        filt = filter_genes(data_subset, min_cells=1)[0]
+        hvg = highly_variable_genes_single_batch(data_subset[:, filt], **kwargs)
+        hvg.index = gene_list[filt]
+        missing_hvg = pd.DataFrame(np.zeros((np.sum(~filt), len(hvg.columns))), columns=hvg.columns)
+        missing_hvg['highly_variable'] = missing_hvg['highly_variable'].astype(bool)
+        missing_hvg['gene'] = gene_list[~filt]
+        hvg['gene'] = gene_list[filt]
+        hvg = pd.concat([hvg.drop(columns='mean_bin'), missing_hvg.drop(columns='mean_bin')], ignore_index=True)
+        df.append(hvg)
+    df = pd.concat(df, axis=0)
+    df['highly_variable'] = df['highly_variable'].astype(int)
+    df = df.groupby('gene').agg(dict(means=np.nanmean, dispersions=np.nanmean, dispersions_norm=np.nanmean,
+                                     highly_variable=np.nansum))
+    return df.loc[gene_list]
+
+
+@pytest.mark.parametrize('fmt', ['csr', 'csc', 'dense'])
+def test_mean_var(fmt):
+    data, groups = make_data()
+    x = data.exp_matrix.toarray()
+    mtx = x if fmt == 'dense' else data.exp_matrix.asformat(fmt)
+    for axis in (0, 1):
+        mean, var = get_mean_var(mtx, axis=axis)
+        assert np.allclose(mean, x.mean(axis=axis))
+        assert np.allclose(var, x.var(axis=axis, ddof=1))
+
+    codes = groups['group'].astype('category').cat.codes.values.copy()
+    codes[:10] = -1
+    means, variances, n_cells, group_sizes = get_mean_var_grouped(mtx, codes, 5)
+    assert (group_sizes == np.bincount(codes[codes >= 0], minlength=5)).all()
+    for g in range(4):
+        x_group = x[codes == g]
+        assert np.allclose(means[g], x_group.mean(axis=0))
+        assert np.allclose(variances[g], x_group.var(axis=0, ddof=1))
+        assert (n_cells[g] == (x_group > 0).sum(axis=0)).all()
+    assert (means[4] == 0).all() and (n_cells[4] == 0).all()
+
+
+@pytest.mark.parametrize('method', ['seurat', 'cell_ranger'])
+@pytest.mark.parametrize('n_top_genes', [100, None])
+def test_hvg_groups(method, n_top_genes):
+    data, groups = make_data()
+    hvg = HighlyVariableGenes(data, groups=groups, method=method, n_top_genes=n_top_genes)
+    hvg.fit()
+    expected = hvg_by_batch(data, groups, method=method, n_top_genes=n_top_genes)
+    assert (hvg.result.index == data.gene_names).all()
+    for column in ['means', 'dispersions', 'dispersions_norm']:
+        assert np.allclose(hvg.result[column], expected[column], equal_nan=True)
+    assert (hvg.result['highly_variable_nbatches'] == expected['highly_variable']).all()
+    if n_top_genes is not None:
+        assert hvg.result['highly_variable'].sum() == n_top_genes
+
+
+def benchmark(n_cells=200000, n_genes=2000, n_batches=8):
+    import numba
+    data, groups = make_data(n_cells, n_genes, n_batches)
+    print(f'{numba.get_num_threads()} threads')
+    for name, func in [('per batch', lambda: hvg_by_batch(data, groups, n_top_genes=2000)),
+                       ('grouped', lambda: HighlyVariableGenes(data, groups=groups, n_top_genes=2000).fit())]:
+        func()
+        start = time.time()
+        func()
+        print(f'{name}: {time.time() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    benchmark(*[int(i) for i in sys.argv[1:]])
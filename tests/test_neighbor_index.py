@@ -0,0 +1,87 @@
+"""Tests and benchmark of the reusable nearest-neighbor index."""
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.algorithm.neighbors import NeighborIndex, find_neighbors
+
+
+def make_pcs(n_cells=3000, n_pcs=20, n_types=8, seed=1):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 5, (n_types, n_pcs))
+    return (centers[rng.integers(0, n_types, n_cells)] + rng.normal(0, 1, (n_cells, n_pcs))).astype(np.float32)
+
+
+def make_data(x_pca):
+    n_cells = x_pca.shape[0]
+    data = StereoExpData(bin_type='bins', exp_matrix=sparse.random(n_cells, 10, density=0.1, format='csr'),
+                         genes=np.array(['g' + str(i) for i in range(10)]),
+                         cells=np.array(['c' + str(i) for i in range(n_cells)]),
+                         position=np.random.randint(0, 100, (n_cells, 2)))
+    data.tl.result['pca'] = pd.DataFrame(x_pca)
+    return data
+
+
+def recall(indices, expected):
+    return np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(indices, expected)])
+
+
+@pytest.mark.parametrize('algorithm', ['exact', 'nndescent', 'hnsw'])
+def test_index(algorithm):
+    if algorithm == 'hnsw':
+        pytest.importorskip('hnswlib')
+    x = make_pcs()
+    expected = NearestNeighbors(n_neighbors=40).fit(x).kneighbors(x, 40, return_distance=False)
+    index = NeighborIndex(x, algorithm=algorithm, n_neighbors=30)
+    for n_neighbors in [10, 40]:
+        indices, distances = index.kneighbors(n_neighbors)
+        assert indices.shape == distances.shape == (3000, n_neighbors)
+        assert (np.diff(distances, axis=1) >= -1e-5).all()
+        assert np.allclose(distances, np.linalg.norm(x[indices] - x[:, None], axis=-1), atol=1e-3)
+        assert recall(indices, expected[:, :n_neighbors]) > 0.95
+    query = x[:100] + np.random.default_rng(2).normal(0, 0.5, (100, x.shape[1])).astype(np.float32)
+    indices, _ = index.kneighbors(10, query)
+    assert recall(indices, NearestNeighbors(n_neighbors=10).fit(x).kneighbors(query, return_distance=False)) > 0.95
+    assert index.match(x, algorithm, 'euclidean') and not index.match(x[:, :10], algorithm, 'euclidean')
+
+
+@pytest.mark.parametrize('method', ['umap', 'gauss'])
+def test_pipeline_neighbors(method):
+    data = make_data(make_pcs())
+    data.tl.neighbors(pca_res_key='pca', method=method, n_neighbors=15, res_key='auto')
+    data.tl.neighbors(pca_res_key='pca', method=method, n_neighbors=15, algorithm='exact', res_key='exact')
+    index = data.tl.result['neighbors_index']
+    # the exact index gives the same graph as the dense distances
+    assert abs(data.tl.result['exact']['connectivities'] - data.tl.result['auto']['connectivities']).max() < 1e-5
+    assert abs(data.tl.result['exact']['nn_dist'] - data.tl.result['auto']['nn_dist']).max() < 1e-4
+    # the index is reused for the other number of neighbors, and rebuilt for the other pcs
+    data.tl.neighbors(pca_res_key='pca', method=method, n_neighbors=30, algorithm='exact', res_key='exact30')
+    assert data.tl.result['neighbors_index'] is index
+    assert data.tl.result['exact30']['nn_dist'].getnnz(axis=1).max() == 29
+    data.tl.neighbors(pca_res_key='pca', method=method, n_pcs=10, n_neighbors=15, algorithm='exact')
+    assert data.tl.result['neighbors_index'] is not index
+    # the index is not built without knn, the dense distances are used
+    index = data.tl.result.pop('neighbors_index')
+    data.tl.neighbors(pca_res_key='pca', method='gauss', knn=False, n_pcs=10, algorithm='exact', res_key='dense')
+    assert 'neighbors_index' not in data.tl.result
+    data.tl.neighbors(pca_res_key='pca', method='gauss', knn=False, n_pcs=10, res_key='dense_auto')
+    assert np.array_equal(data.tl.result['dense']['connectivities'], data.tl.result['dense_auto']['connectivities'])
+    with pytest.raises(ValueError):
+        find_neighbors(data.tl.result['pca'].values, method='gauss', knn=False, index=index)
+
+
+def benchmark(n_cells=200000, n_pcs=30):
+    data = make_data(make_pcs(n_cells, n_pcs))
+    for algorithm in ['auto', 'exact', 'nndescent']:
+        for n_neighbors in [15, 30]:
+            start = time.time()
+            data.tl.neighbors(pca_res_key='pca', n_neighbors=n_neighbors, algorithm=algorithm)
+            print(f'{algorithm}, n_neighbors {n_neighbors}: {time.time() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    benchmark(*[int(i) for i in sys.argv[1:]])
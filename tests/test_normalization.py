@@ -0,0 +1,180 @@
+"""Tests of the in-place normalization and log1p of the sparse matrix."""
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pytest
+from scipy import sparse
+from stereo.core.stereo_exp_data import StereoExpData
+import scipy.spatial as spatial
+from scipy import stats
+from stereo.algorithm.normalization import normalize_total, normalize_log1p, log1p, zscore_disksmooth, quantile_norm
+
+
+def make_matrix(n_cells=300, n_genes=50, seed=1):
+    exp_matrix = sparse.random(n_cells, n_genes, density=0.1, format='csr', random_state=seed)
+    exp_matrix.data = np.ceil(exp_matrix.data * 10)
+    # keep an empty cell
+    keep = np.ones(n_cells, dtype=np.int32)
+    keep[5] = 0
+    exp_matrix = (sparse.diags(keep) @ exp_matrix).tocsr().astype(np.int32)
+    exp_matrix.eliminate_zeros()
+    return exp_matrix
+
+
+def reference(x, target_sum=10000):
+    x = x.toarray().astype(np.float64)
+    counts = x.sum(1)
+    counts[counts == 0] = 1
+    return x * target_sum / counts[:, None]
+
+
+@pytest.mark.parametrize('fmt', ['csr', 'csc', 'dense'])
+@pytest.mark.parametrize('dtype', [np.int32, np.float32, np.float64])
+def test_normalize(fmt, dtype):
+    mtx = make_matrix().astype(dtype)
+    expected = reference(mtx)
+    x = mtx.toarray() if fmt == 'dense' else mtx.asformat(fmt)
+    work_dtype = np.dtype(dtype) if np.issubdtype(dtype, np.floating) else np.float32
+    res = normalize_total(x, 10000, dtype=np.float32)
+    assert res is not x and res.dtype == work_dtype
+    res = np.nan_to_num(res.toarray() if sparse.issparse(res) else res)
+    assert np.allclose(res, expected, rtol=1e-5)
+    assert np.allclose(np.nan_to_num(log1p(normalize_total(x, 10000, dtype=np.float32))
+                                     if fmt == 'dense' else log1p(normalize_total(x, 10000)).toarray()),
+                       np.log1p(expected), rtol=1e-5)
+    res = normalize_log1p(x, 10000, inplace=True, dtype=np.float32)
+    assert res.dtype == work_dtype
+    if np.issubdtype(dtype, np.floating) and fmt != 'dense':
+        assert res is x
+    res = np.nan_to_num(res.toarray() if sparse.issparse(res) else res)
+    assert np.allclose(res, np.log1p(expected), rtol=1e-5)
+
+
+def test_pipeline_inplace():
+    mtx = make_matrix()
+    genes = np.array(['g' + str(i) for i in range(mtx.shape[1])])
+    cells = np.array(['c' + str(i) for i in range(mtx.shape[0])])
+    data = StereoExpData(bin_type='bins', exp_matrix=mtx, genes=genes, cells=cells,
+                         position=np.random.randint(0, 100, (mtx.shape[0], 2)))
+    view = data.view()
+    view.tl.normalize_total(log=True)
+    assert view.exp_matrix.dtype == np.float32
+    assert np.allclose(view.exp_matrix.toarray(), np.log1p(reference(mtx)), rtol=1e-5)
+    # the parent of the view is not changed
+    assert data.exp_matrix.dtype == np.int32 and (data.exp_matrix != mtx).nnz == 0
+    data.tl.normalize_total()
+    data.tl.log1p()
+    assert np.allclose(data.exp_matrix.toarray(), view.exp_matrix.toarray())
+    data.tl.log1p(inplace=False)
+    assert np.allclose(data.tl.result['log1p'].toarray(), np.log1p(view.exp_matrix.toarray()))
+
+
+def zscore_disksmooth_loop(x, position, r):
+    """
+    the former implementation, which queries the neighbors of each position one by one.
+    """
+    position = position.astype(np.int32)
+    point_tree = spatial.cKDTree(position)
+    x = x.astype(np.float32)
+    mean_bin = np.array(x.mean(1))
+    std_bin = np.std(x, axis=1)
+    zscore = []
+    for i in range(len(position)):
+        current_neighbor = point_tree.query_ball_point(position[i], r)
+        current_neighbor.remove(i)
+        if len(current_neighbor) > 0:
+            mean_bins = np.mean(mean_bin[current_neighbor])
+            std_bins = np.mean(std_bin[current_neighbor])
+        else:
+            mean_bins = mean_bin[i]
+            std_bins = std_bin[i]
+        zscore.append((x[i] - mean_bins) / std_bins + 1)
+    return np.array(zscore)
+
+
+@pytest.mark.parametrize('fmt', ['csr', 'dense'])
+def test_zscore_disksmooth(fmt):
+    mtx = make_matrix(n_cells=400)
+    position = np.random.default_rng(1).integers(0, 60, (400, 2))
+    # the duplicated and isolated positions
+    position[1] = position[0]
+    position[2] = [1000, 1000]
+    x = mtx if fmt == 'csr' else mtx.toarray()
+    expected = zscore_disksmooth_loop(mtx.toarray(), position, 5)
+    res = zscore_disksmooth(x, position, 5, chunk_size=70)
+    assert res.dtype == np.float32 and res.shape == mtx.shape
+    assert np.allclose(res, expected, rtol=1e-4, atol=1e-4, equal_nan=True)
+
+
+def quantile_norm_loop(x):
+    """
+    the former implementation, which ranks the dense columns one by one.
+    """
+    quantiles = np.mean(np.sort(x, axis=0), axis=1)
+    ranks = np.apply_along_axis(stats.rankdata, 0, x)
+    return quantiles[ranks.astype(int) - 1]
+
+
+@pytest.mark.parametrize('density', [0.1, 0.95])
+def test_quantile_norm(density):
+    mtx = sparse.random(300, 40, density=density, format='csr', random_state=1)
+    mtx.data = np.ceil(mtx.data * 5)
+    # the zeros of the sparse first column rank above the zeros of the dense columns
+    mtx = mtx.multiply(np.where(np.arange(300) < 60, 1, 0)[:, None] | (np.arange(40) > 0)).tocsr()
+    expected = quantile_norm_loop(mtx.toarray())
+    assert np.allclose(quantile_norm(mtx.toarray()), expected)
+    res = quantile_norm(mtx)
+    # the zeros are normalized to zero in the sparse columns, so the result stays sparse
+    assert sparse.issparse(res) == (density == 0.1)
+    assert np.allclose(res.toarray() if sparse.issparse(res) else res, expected)
+
+
+def benchmark_quantile(n_cells=20000, n_genes=2000):
+    mtx = sparse.random(n_cells, n_genes, density=0.05, format='csc', random_state=np.random.default_rng(1))
+    mtx.data = np.ceil(mtx.data * 10)
+    start = time.time()
+    quantile_norm_loop(mtx.toarray())
+    print(f'dense, rank column by column: {time.time() - start:.2f}s')
+    start = time.time()
+    quantile_norm(mtx)
+    print(f'sparse, rank the non-zeros: {time.time() - start:.2f}s')
+
+
+def benchmark_disksmooth(n_cells=20000, n_genes=2000):
+    mtx = sparse.random(n_cells, n_genes, density=0.05, format='csr', random_state=np.random.default_rng(1),
+                        dtype=np.float32)
+    side = int(np.sqrt(n_cells)) + 1
+    position = np.stack([np.arange(n_cells) % side, np.arange(n_cells) // side], axis=1)
+    start = time.time()
+    zscore_disksmooth_loop(mtx.toarray(), position, 5)
+    print(f'dense, query each position: {time.time() - start:.2f}s')
+    start = time.time()
+    zscore_disksmooth(mtx, position, 5)
+    print(f'sparse, radius neighbor graph: {time.time() - start:.2f}s')
+
+
+def benchmark(n_cells=200000, n_genes=2000):
+    mtx = sparse.random(n_cells, n_genes, density=0.05, format='csr', random_state=np.random.default_rng(1),
+                        dtype=np.float32)
+    mtx.data = np.ceil(mtx.data * 10).astype(np.int32)
+    for name, func in [('astype float64 + log1p copy', lambda x: np.log1p(normalize_total(x, 10000))),
+                       ('in place float32 + log1p', lambda x: log1p(normalize_total(x, 10000, True, np.float32))),
+                       ('fused in place float32', lambda x: normalize_log1p(x, 10000, True, np.float32))]:
+        x = mtx.copy()
+        tracemalloc.start()
+        start = time.time()
+        func(x)
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{name}: {elapsed:.2f}s, peak {peak / 1024 ** 2:.0f}MB above the input')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'disksmooth':
+        benchmark_disksmooth(*[int(i) for i in sys.argv[2:]])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'quantile':
+        benchmark_quantile(*[int(i) for i in sys.argv[2:]])
+    else:
+        benchmark(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,130 @@
+"""Tests and benchmark of the sparse and incremental pca."""
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from sklearn.decomposition import PCA
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.algorithm.dim_reduce import pca, incremental_pca
+from stereo.io.writer import write_h5ad
+from stereo.io.reader import read_stereo_h5ad
+
+
+def make_matrix(n_cells=2000, n_genes=300, n_types=6, seed=1, scale=2.0):
+    """counts of a few cell types with different expression profiles, log1p normalized."""
+    rng = np.random.default_rng(seed)
+    profiles = rng.gamma(0.3, scale, (n_types, n_genes))
+    types = rng.integers(0, n_types, n_cells)
+    counts = sparse.csr_matrix(rng.poisson(profiles[types]).astype(np.float32))
+    counts.data = np.log1p(counts.data)
+    return counts
+
+
+@pytest.mark.parametrize('svd_solver', ['randomized', 'arpack'])
+def test_sparse_pca(svd_solver):
+    x = make_matrix()
+    res = pca(x, 10, svd_solver=svd_solver)
+    expected = PCA(n_components=10, svd_solver='full').fit(x.toarray().astype(np.float64))
+    assert res['x_pca'].shape == (x.shape[0], 10) and res['pcs'].shape == (x.shape[1], 10)
+    # the components of the cell types are well separated
+    assert np.allclose(res['variance'][:5], expected.explained_variance_[:5], rtol=1e-3)
+    assert np.allclose(res['variance_ratio'][:5], expected.explained_variance_ratio_[:5], rtol=1e-3)
+    assert np.allclose(np.abs(res['pcs'][:, :5].T @ expected.components_[:5].T), np.eye(5), atol=1e-3)
+    x_pca = expected.transform(x.toarray())[:, :5]
+    assert np.allclose(np.abs(res['x_pca'][:, :5]), np.abs(x_pca), atol=1e-2 * np.abs(x_pca).max())
+
+
+def test_pipeline_pca(tmp_path):
+    x = make_matrix(500, 100)
+    genes = np.array(['g' + str(i) for i in range(100)])
+    cells = np.array(['c' + str(i) for i in range(500)])
+    data = StereoExpData(bin_type='bins', exp_matrix=x, genes=genes, cells=cells,
+                         position=np.random.randint(0, 100, (500, 2)), output=str(tmp_path / 'test.h5ad'))
+    data.tl.result['hvg'] = pd.DataFrame({'highly_variable': np.arange(100) < 60}, index=genes)
+    data.tl.pca(use_highly_genes=True, n_pcs=5, hvg_res_key='hvg')
+    assert sparse.issparse(data.exp_matrix) and data.exp_matrix.shape == (500, 100)
+    assert data.tl.result['pca'].shape == (500, 5)
+    assert (data.tl.result['pca_pcs'].index == genes[:60]).all()
+    assert data.tl.result['pca_variance'].shape == data.tl.result['pca_variance_ratio'].shape == (5,)
+    write_h5ad(data)
+    res = read_stereo_h5ad(data.output)
+    assert np.allclose(res.tl.result['pca_pcs'].values, data.tl.result['pca_pcs'].values)
+    assert np.allclose(res.tl.result['pca_variance_ratio'], data.tl.result['pca_variance_ratio'])
+
+
+def test_incremental_pca(tmp_path):
+    x = make_matrix(1007, 100)
+    expected = pca(x, 10)
+    for matrix in [x, x.toarray()]:
+        res = incremental_pca(matrix, 10, chunk_size=100)
+        assert res['x_pca'].shape == (1007, 10)
+        assert np.allclose(res['variance'][:5], expected['variance'][:5], rtol=1e-4)
+        assert np.allclose(res['variance_ratio'][:5], expected['variance_ratio'][:5], rtol=1e-4)
+        assert np.allclose(np.abs(res['pcs'][:, :5].T @ expected['pcs'][:, :5]), np.eye(5), atol=1e-3)
+        assert np.allclose(np.abs(res['x_pca'][:, :5]), np.abs(expected['x_pca'][:, :5]), atol=1e-3)
+
+    genes = np.array(['g' + str(i) for i in range(100)])
+    cells = np.array(['c' + str(i) for i in range(1007)])
+    data = StereoExpData(bin_type='bins', exp_matrix=x, genes=genes, cells=cells,
+                         position=np.random.randint(0, 100, (1007, 2)), output=str(tmp_path / 'test.h5ad'))
+    write_h5ad(data)
+    hvg = pd.DataFrame({'highly_variable': np.arange(100) % 2 == 0}, index=genes)
+    data.tl.result['hvg'] = hvg
+    data.tl.pca(use_highly_genes=True, n_pcs=5, hvg_res_key='hvg', chunk_size=200)
+    backed = read_stereo_h5ad(data.output, backed='r')
+    backed.exp_matrix.chunk_size = 200
+    backed.tl.result['hvg'] = hvg
+    backed.tl.pca(use_highly_genes=True, n_pcs=5, hvg_res_key='hvg')
+    assert (backed.tl.result['pca_pcs'].index == genes[::2]).all()
+    assert np.allclose(backed.tl.result['pca'].values, data.tl.result['pca'].values, atol=1e-4)
+    assert np.allclose(backed.tl.result['pca_variance'], data.tl.result['pca_variance'])
+
+    # the gram matrix of 100 genes needs 80000 bytes
+    with pytest.raises(ValueError):
+        incremental_pca(x, 10, chunk_size=100, max_gram_memory=70000 / 1024 ** 3)
+    with pytest.raises(ValueError):
+        backed.tl.pca(use_highly_genes=False, n_pcs=5, res_key='pca_all', max_gram_memory=70000 / 1024 ** 3)
+    assert 'pca_all' not in backed.tl.result
+
+
+def benchmark(n_cells=100000, n_genes=2000):
+    # about 5% of the entries are non-zero, as the bins of stereo-seq
+    x = sparse.vstack([make_matrix(10000, n_genes, seed=i, scale=0.2) for i in range(n_cells // 10000)], format='csr')
+    print(f'density {x.nnz / x.shape[0] / x.shape[1]:.3f}')
+    for name, func in [('dense sklearn', lambda: PCA(n_components=50, random_state=0).fit_transform(x.toarray())),
+                       ('sparse randomized', lambda: pca(x, 50)),
+                       ('sparse arpack', lambda: pca(x, 50, svd_solver='arpack'))]:
+        tracemalloc.start()
+        start = time.time()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name}: {time.time() - start:.2f}s, peak {peak / 1024 ** 2:.0f}MB')
+
+
+def benchmark_incremental(out_path, n_cells=200000, n_genes=2000, chunk_size=20000):
+    x = sparse.vstack([make_matrix(10000, n_genes, seed=i, scale=0.2) for i in range(n_cells // 10000)], format='csr')
+    data = StereoExpData(bin_type='bins', exp_matrix=x, genes=np.array(['g' + str(i) for i in range(n_genes)]),
+                         cells=np.array(['c' + str(i) for i in range(n_cells)]),
+                         position=np.random.randint(0, 30000, (n_cells, 2)), output=out_path)
+    write_h5ad(data)
+    del data, x
+    for name, backed in [('in memory', None), ('backed', 'r')]:
+        data = read_stereo_h5ad(out_path, backed=backed, use_raw=False, use_result=False)
+        for solver_chunk in [None, chunk_size] if backed is None else [chunk_size]:
+            tracemalloc.start()
+            start = time.time()
+            data.tl.pca(use_highly_genes=False, n_pcs=50, chunk_size=solver_chunk)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'{name}, chunk_size {solver_chunk}: {time.time() - start:.2f}s, peak {peak / 1024 ** 2:.0f}MB')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['incremental']:
+        benchmark_incremental(*sys.argv[2:3], *[int(i) for i in sys.argv[3:]])
+    else:
+        benchmark(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,51 @@
+"""Tests and benchmark of the one-pass qc kernel."""
+import sys
+import time
+import numpy as np
+import pytest
+from scipy import sparse
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.preprocess.qc import cal_qc
+
+
+def make_data(n_cells=3000, n_genes=200, density=0.1, dtype=np.int32):
+    np.random.seed(1)
+    exp_matrix = sparse.random(n_cells, n_genes, density=density, format='csr', random_state=np.random.default_rng(1))
+    exp_matrix.data = np.ceil(exp_matrix.data * 10)
+    genes = np.array(['g' + str(i) for i in range(n_genes - 13)] + ['MT-' + str(i) for i in range(13)])
+    cells = np.array(['c' + str(i) for i in range(n_cells)])
+    return StereoExpData(bin_type='bins', exp_matrix=exp_matrix.astype(dtype), genes=genes, cells=cells)
+
+
+def separate_qc(exp_matrix, gene_names):
+    mt_index = np.char.startswith(np.char.lower(gene_names), prefix='mt-')
+    total_count = np.ravel(exp_matrix.sum(1))
+    return (total_count, np.ravel(exp_matrix[:, mt_index].sum(1)) / total_count * 100, exp_matrix.getnnz(axis=1),
+            exp_matrix.getnnz(axis=0), np.ravel(exp_matrix.sum(0)))
+
+
+@pytest.mark.parametrize('dtype', [np.int32, np.float32, np.float64])
+def test_cal_qc(dtype):
+    data = make_data(dtype=dtype)
+    expected = separate_qc(data.exp_matrix, data.gene_names)
+    cal_qc(data)
+    res = (data.cells.total_counts, data.cells.pct_counts_mt, data.cells.n_genes_by_counts, data.genes.n_cells,
+           data.genes.n_counts)
+    for r, e in zip(res, expected):
+        assert np.allclose(r, e)
+    assert data.cells.total_counts.dtype == (np.int64 if dtype == np.int32 else np.float64)
+    data = make_data(dtype=dtype)
+    data.exp_matrix = data.exp_matrix.tocsc()
+    cal_qc(data)
+    assert np.allclose(data.cells.total_counts, expected[0])
+
+
+if __name__ == '__main__':
+    data = make_data(n_cells=int(sys.argv[1]) if len(sys.argv) > 1 else 1000000, n_genes=2000, density=0.02)
+    cal_qc(data)
+    start = time.time()
+    separate_qc(data.exp_matrix, data.gene_names)
+    print(f'separate passes: {time.time() - start:.2f}s')
+    start = time.time()
+    cal_qc(data)
+    print(f'one pass kernel: {time.time() - start:.2f}s')
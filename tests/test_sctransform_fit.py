@@ -0,0 +1,148 @@
+"""Tests and benchmark of fitting and applying the sctransform gene models."""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from patsy import dmatrix
+from scipy import sparse
+from stereo.algorithm.pysctransform.fit import estimate_mu_poisson_batch, theta_ml_batch, theta_nb_score, \
+    theta_nb_hessian
+from stereo.algorithm.pysctransform.pysctransform import get_model_params_allgene, \
+    get_model_params_allgene_batch, make_cell_attr, vst, get_hvg_residuals
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.preprocess.sc_transform import sc_transform
+from stereo.algorithm.pysctransform import SCTModel
+import statsmodels.discrete.discrete_model as dm
+
+
+def make_umi(n_genes=60, n_cells=800, seed=1):
+    """
+    negative binomial counts of genes x cells, whose mean depends on the log10 umi of the cells.
+    """
+    rng = np.random.default_rng(seed)
+    depth = rng.lognormal(7, 0.5, n_cells)
+    gene_mean = rng.lognormal(-7, 1.5, n_genes)
+    theta = rng.uniform(0.5, 20, n_genes)
+    mu = gene_mean[:, None] * depth[None, :]
+    umi = rng.negative_binomial(theta[:, None], theta[:, None] / (theta[:, None] + mu))
+    umi[:, 0] = 1
+    umi = umi[(umi > 0).sum(1) >= 5]
+    cell_names = np.array(['c' + str(i) for i in range(n_cells)])
+    model_matrix = dmatrix('log10_umi', make_cell_attr(sparse.csr_matrix(umi), cell_names))
+    return sparse.csr_matrix(umi), model_matrix
+
+
+def theta_ml_reference(y, mu, max_iters=20, tol=1e-4):
+    """
+    the Newton steps of theta_ml, with the mean of each cell rather than a scalar mean.
+    """
+    theta = len(y) / np.sum((y / mu - 1) ** 2)
+    for _ in range(max_iters):
+        theta = abs(theta)
+        score = theta_nb_score(y, mu, theta, fast=False)
+        if score < 0:
+            return np.inf
+        delta = score / theta_nb_hessian(y, mu, theta, fast=False)
+        theta = theta - delta
+        if abs(delta) <= tol:
+            return theta
+    return np.inf if theta < 0 else theta
+
+
+def test_batch_fit():
+    umi, model_matrix = make_umi()
+    coef, mu = estimate_mu_poisson_batch(umi, model_matrix)
+    theta = theta_ml_batch(umi, mu)
+    for i in range(umi.shape[0]):
+        y = umi[i].toarray().ravel()
+        fit = dm.Poisson(y, np.asarray(model_matrix)).fit(disp=False)
+        assert np.allclose(coef[i], fit.params, rtol=1e-5, atol=1e-6)
+        assert np.allclose(mu[i], fit.predict(), rtol=1e-5)
+        expected = theta_ml_reference(y, mu[i])
+        assert (np.isinf(theta[i]) and np.isinf(expected)) or np.isclose(theta[i], expected, rtol=1e-3)
+    params = get_model_params_allgene_batch(umi, model_matrix, batch_size=7)
+    assert list(params.columns) == ['Intercept', 'log10_umi', 'theta']
+    assert np.allclose(params[['Intercept', 'log10_umi']].values, coef)
+    assert np.allclose(params['theta'].values, np.where(theta >= 1e5, np.inf, theta))
+
+
+def make_data(n_genes=300, n_cells=600):
+    umi, _ = make_umi(n_genes, n_cells)
+    genes = np.array(['g' + str(i) for i in range(umi.shape[0])])
+    cells = np.array(['c' + str(i) for i in range(umi.shape[1])])
+    return StereoExpData(bin_type='bins', exp_matrix=umi.T.tocsr(), genes=genes, cells=cells,
+                         position=np.random.randint(0, 100, (umi.shape[1], 2)))
+
+
+def test_stream_residuals(tmp_path):
+    data = make_data()
+    kwargs = dict(gene_names=data.gene_names.tolist(), cell_names=data.cell_names.tolist())
+    vst_out = vst(data.exp_matrix.T, **kwargs)
+    expected = get_hvg_residuals(vst_out, 50)
+    assert vst_out['residuals'].values.dtype == np.float32
+    # the same stats and hvg residuals without storing any residuals of vst
+    lite = vst(data.exp_matrix.T, residual_features=None, residual_batch_size=17, **kwargs)
+    assert lite['residuals'].shape == (0, len(data.cell_names))
+    assert np.allclose(lite['gene_attr']['residual_variance'], vst_out['gene_attr']['residual_variance'], rtol=1e-5)
+    umi = data.exp_matrix.T.tocsr()[data.genes.get_indexer(lite['gene_attr'].index)]
+    hvg = get_hvg_residuals(lite, 50, umi=umi)
+    assert (hvg.columns == expected.columns).all()
+    assert np.allclose(hvg.values, expected.values, atol=1e-5)
+    # the residuals of the given genes written to disk
+    out = vst(data.exp_matrix.T, residual_features=list(expected.columns), residual_path=str(tmp_path / 'r.npy'),
+              **kwargs)
+    assert isinstance(out['residuals'], np.memmap) and out['residuals'].shape == (len(data.cell_names), 50)
+    assert np.allclose(np.clip(out['residuals'], -np.sqrt(len(data.cell_names) / 30), np.sqrt(len(data.cell_names) / 30)),
+                       expected.values, atol=1e-5)
+    # the pipeline keeps the columns of the matrix and the gene names aligned
+    for path in [None, str(tmp_path / 'hvg.npy')]:
+        res, _ = sc_transform(make_data(), filter_hvgs=True, var_features_n=50, residual_path=path)
+        assert (res.gene_names == expected.columns).all()
+        assert np.allclose(res.exp_matrix, expected.values, atol=1e-5)
+
+
+def test_sct_model(tmp_path):
+    data = make_data()
+    data.tl.sctransform(filter_hvgs=True, var_features_n=50)
+    model = data.tl.result['sctransform_model']
+    assert list(model.features) == list(data.gene_names)
+    model.save(str(tmp_path / 'model.h5'))
+    loaded = SCTModel.load(str(tmp_path / 'model.h5'))
+    pd.testing.assert_frame_equal(loaded.model_parameters_fit, model.model_parameters_fit, check_index_type=False)
+    assert loaded.features == model.features and loaded.design == model.design
+    # applying the model to the fitted sample gets the same residuals
+    new = make_data()
+    new.tl.sctransform(filter_hvgs=True, model=loaded)
+    assert (new.gene_names == data.gene_names).all()
+    assert np.allclose(new.exp_matrix, data.exp_matrix, atol=1e-5)
+    # the genes of the new sample are in another order
+    new = make_data()
+    order = np.random.default_rng(0).permutation(len(new.gene_names))
+    residuals, features = loaded.apply(new.exp_matrix[:, order], new.gene_names[order], res_clip_range='seurat')
+    assert np.allclose(residuals, data.exp_matrix, atol=1e-5)
+    # the missing genes of the model are taken as zero counts
+    residuals, features = loaded.apply(new.exp_matrix[:, order[10:]], new.gene_names[order[10:]])
+    assert residuals.shape == data.exp_matrix.shape and np.isfinite(residuals).all()
+    # the pipeline keeps all the features of the model when some of them are missing in the sample
+    new = make_data()
+    keep = ~np.isin(new.gene_names, model.features[:5])
+    expected, _ = loaded.apply(new.exp_matrix[:, keep], new.gene_names[keep], res_clip_range='seurat')
+    new.sub_by_index(gene_index=np.flatnonzero(keep))
+    new.tl.sctransform(filter_hvgs=True, model=loaded)
+    assert (new.gene_names == np.asarray(model.features)).all()
+    assert np.allclose(new.exp_matrix, expected, atol=1e-5) and np.isfinite(new.exp_matrix).all()
+
+
+def benchmark(n_genes=2000, n_cells=5000):
+    umi, model_matrix = make_umi(n_genes, n_cells)
+    print(f'{umi.shape[0]} genes x {umi.shape[1]} cells')
+    start = time.time()
+    get_model_params_allgene(umi, model_matrix, 'theta_ml', threads=4)
+    print(f'per gene, 4 threads: {time.time() - start:.2f}s')
+    start = time.time()
+    get_model_params_allgene_batch(umi, model_matrix)
+    print(f'batched: {time.time() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    benchmark(*[int(i) for i in sys.argv[1:]])
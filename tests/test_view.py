@@ -0,0 +1,106 @@
+"""Tests of the copy-on-write views of StereoExpData."""
+import copy
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from stereo.core.stereo_exp_data import StereoExpData, StereoExpDataView
+from stereo.preprocess.filter import filter_cells, filter_genes
+
+
+def make_data(n_cells=500, n_genes=100, is_sparse=True):
+    np.random.seed(1)
+    exp_matrix = sparse.random(n_cells, n_genes, density=0.1, format='csr', random_state=1)
+    exp_matrix.data = np.ceil(exp_matrix.data * 10)
+    genes = np.array(['g' + str(i) for i in range(n_genes)])
+    cells = np.array(['c' + str(i) for i in range(n_cells)])
+    position = np.random.randint(0, 100, (n_cells, 2))
+    return StereoExpData(bin_type='bins', exp_matrix=exp_matrix if is_sparse else exp_matrix.toarray(), genes=genes,
+                         cells=cells, position=position)
+
+
+@pytest.mark.parametrize('is_sparse', [True, False])
+def test_view(is_sparse):
+    data = make_data(is_sparse=is_sparse)
+    origin = copy.deepcopy(data.exp_matrix)
+    view = data.view()
+    assert view.is_view and view.shape == data.exp_matrix.shape
+    with pytest.raises(ValueError):
+        if is_sparse:
+            view.exp_matrix.data[:] = 0
+        else:
+            view.exp_matrix[:] = 0
+    view.exp_matrix = view.exp_matrix * 2
+    assert not view.is_view
+    assert (data.exp_matrix != origin).sum() == 0
+
+    cell_index, gene_index = np.arange(0, 500, 3), np.random.rand(100) > 0.5
+    view = data.view(cell_index=cell_index).view(gene_index=gene_index).sub_by_index(cell_index=[5, 1, 1])
+    expected = origin[cell_index][:, gene_index][[5, 1, 1]]
+    assert view.is_view and view.shape == expected.shape
+    assert (view.exp_matrix != expected).sum() == 0
+    assert (view.cell_names == data.cell_names[cell_index][[5, 1, 1]]).all()
+    assert (view.gene_names == data.gene_names[gene_index]).all()
+    assert (view.position == data.position[cell_index][[5, 1, 1]]).all()
+    view.exp_matrix[0, 0] = -1
+    assert (data.exp_matrix != origin).sum() == 0
+    assert len(data.cell_names) == 500 and len(data.gene_names) == 100
+
+
+def test_sub_by_name():
+    data = make_data()
+    sub_data = data.sub_by_name(cell_name=['c3', 'c1'], gene_name=['g5', 'g2', 'g9'])
+    assert isinstance(sub_data, StereoExpDataView)
+    assert (sub_data.exp_matrix != data.exp_matrix[[3, 1]][:, [5, 2, 9]]).nnz == 0
+
+
+def test_filter_view():
+    data = make_data()
+    expected = copy.deepcopy(data)
+    filter_cells(expected, min_gene=8, max_gene=15, inplace=True)
+    filter_genes(expected, min_cell=40, inplace=True)
+    res = filter_cells(data, min_gene=8, max_gene=15, inplace=False)
+    res = filter_genes(res, min_cell=40, inplace=False)
+    assert isinstance(res, StereoExpDataView)
+    assert (res.exp_matrix != expected.exp_matrix).nnz == 0
+    assert (res.cell_names == expected.cell_names).all()
+    assert (res.gene_names == expected.gene_names).all()
+    assert data.exp_matrix.shape == (500, 100) and data.cells.n_genes_by_counts is None
+
+
+def test_name_index():
+    data = make_data()
+    data.cells.cell_name = np.array(['c' + str(i % 400) for i in range(500)])
+    assert (data.cells.get_indexer(['c3', 'c399', 'c0']) == [3, 399, 0]).all()
+    data.sub_by_index(cell_index=np.arange(100, 500))
+    assert (data.cells.get_indexer(['c3', 'c100']) == [303, 0]).all()
+    assert (data.genes.get_indexer(np.array(['g7', 'g1'])) == [7, 1]).all()
+    with pytest.raises(KeyError):
+        data.genes.get_indexer(['g1', 'x'])
+
+
+def test_view_result():
+    data = make_data()
+    connectivities = sparse.random(500, 500, density=0.01, format='csr', random_state=1)
+    cluster = pd.DataFrame({'bins': data.cell_names, 'group': np.zeros(500, dtype=int)})
+    data.tl.result['cluster'] = cluster
+    data.tl.result['neighbors'] = {'connectivities': connectivities}
+    data.tl.result['pca'] = np.ones((500, 5))
+    origin = copy.deepcopy(data.tl.result)
+    view = data.view()
+    view.tl.result['cluster']['group'] = 1
+    view.tl.result['neighbors']['connectivities'].data[:] = 0
+    view.tl.result['neighbors']['connectivities'] = None
+    view.tl.result.get('pca')[:] = 0
+    for key, value in view.tl.result.items():
+        assert value is view.tl.result[key]
+    assert data.tl.result['cluster'] is cluster and (cluster['group'] == 0).all()
+    assert data.tl.result['neighbors']['connectivities'] is connectivities
+    assert (connectivities != origin['neighbors']['connectivities']).nnz == 0
+    assert (data.tl.result['pca'] == 1).all()
+    assert (view.tl.result['cluster']['group'] == 1).all() and (view.tl.result['pca'] == 0).all()
+    view.tl.result['umap'] = np.zeros((500, 2))
+    assert 'umap' not in data.tl.result
+    # the result of a view of the view is copied from the view
+    sub_view = view.view(cell_index=np.arange(10))
+    assert (sub_view.tl.result['pca'] == 0).all() and sub_view.tl.result['pca'] is not view.tl.result['pca']